@@ -8,6 +8,7 @@ import json
 import pandas as pd
 from datetime import datetime
 import os
+from report_markdown import report_html
 
 # 配置页面
 st.set_page_config(
@@ -211,9 +212,9 @@ def new_patient_page():
     with result_container:
         if 'generated_report' in st.session_state:
             st.markdown('<h2 class="section-header">📋 生成的诊疗报告</h2>', unsafe_allow_html=True)
-            st.markdown('<div class="report-container">', unsafe_allow_html=True)
-            st.markdown(st.session_state.generated_report)
-            st.markdown('</div>', unsafe_allow_html=True)
+            # 与 PDF 共用 report_markdown 的解析结果，表格、多级列表和 "<20" 这类内容显示一致
+            st.markdown(f'<div class="report-container">{report_html(st.session_state.generated_report)}</div>',
+                        unsafe_allow_html=True)
             
             # 下载选项
             st.markdown('<h3 class="section-header">📥 下载选项</h3>', unsafe_allow_html=True)
@@ -327,7 +328,7 @@ def view_patient_details(patient_id):
                 st.markdown('<h3 class="section-header">📋 诊疗报告</h3>', unsafe_allow_html=True)
                 for i, report in enumerate(reports):
                     with st.expander(f"报告 {i+1} - {report.get('created_at', '未知')[:19]}"):
-                        st.markdown(report.get('content', '无内容'))
+                        st.markdown(report_html(report.get('content', '无内容'), report.get('id')), unsafe_allow_html=True)
         else:
             st.error("获取病人信息失败")
     except Exception as e:
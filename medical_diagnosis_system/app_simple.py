@@ -9,6 +9,8 @@ import json
 import pandas as pd
 from datetime import datetime
 import os
+import time
+import uuid
 from config import config
 
 # 配置页面
@@ -23,6 +25,38 @@ st.set_page_config(
 API_BASE_URL = config.API_BASE_URL
 MODEL_TRAINING_URL = config.MODEL_TRAINING_URL
 
+# 后台报告任务：提交超时（秒）、最长等待时间（秒）、轮询间隔（秒）
+JOB_SUBMIT_TIMEOUT = 10
+JOB_WAIT_TIMEOUT = 600
+JOB_POLL_INTERVAL = 2
+
+def run_report_job(api_request):
+    """提交后台报告任务并轮询结果，返回 (是否成功, 结果或错误信息)"""
+    # 同一次提交使用同一个幂等键，网络重试不会重复创建病人
+    idempotency_key = uuid.uuid4().hex
+    response = requests.post(f"{API_BASE_URL}/jobs/generate_report", json=api_request,
+                             headers={"Idempotency-Key": idempotency_key}, timeout=JOB_SUBMIT_TIMEOUT)
+    if response.status_code != 202:
+        return False, response.text
+    
+    job_id = response.json()["job_id"]
+    deadline = time.time() + JOB_WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(JOB_POLL_INTERVAL)
+        try:
+            job = requests.get(f"{API_BASE_URL}/jobs/{job_id}", timeout=JOB_SUBMIT_TIMEOUT).json()
+        except requests.exceptions.RequestException:
+            continue
+        if job["status"] == "succeeded":
+            return True, job["result"]
+        if job["status"] == "failed":
+            return False, job.get("error") or "报告生成失败"
+    return False, f"报告生成超时，可稍后通过任务 {job_id} 查询结果"
+
+# 历史记录列表只取展示用字段，报告正文按需加载
+HISTORY_PAGE_SIZE = 50
+HISTORY_LIST_FIELDS = "id,name,age,sex,chief_complaint,created_at,latest_report_id"
+
 # 现代化CSS样式 - 简化版，避免JavaScript问题
 st.markdown("""
 <style>
@@ -504,10 +538,9 @@ def new_patient_page():
                             },
                             "report_type": "comprehensive"
                         }
-                        response = requests.post(f"{API_BASE_URL}/generate_report", json=api_request)
+                        success, result = run_report_job(api_request)
                         
-                        if response.status_code == 200:
-                            result = response.json()
+                        if success:
                             
                             st.success("✅ 诊疗报告生成成功！")
                             
@@ -534,7 +567,7 @@ def new_patient_page():
                                     mime="text/plain"
                                 )
                         else:
-                            st.error(f"❌ 报告生成失败: {response.text}")
+                            st.error(f"❌ 报告生成失败: {result}")
                             
                     except Exception as e:
                         st.error(f"❌ 发生错误: {str(e)}")
@@ -543,9 +576,16 @@ def history_page():
     """历史记录页面"""
     st.markdown('<h2 class="section-header">📚 查看历史记录</h2>', unsafe_allow_html=True)
     
+    # 已访问页的游标栈，栈顶为当前页的游标（首页为 None）
+    if 'history_cursors' not in st.session_state:
+        st.session_state.history_cursors = [None]
+    
     try:
-        # 获取患者列表
-        response = requests.get(f"{API_BASE_URL}/patients")
+        # 获取当前页患者列表
+        params = {"limit": HISTORY_PAGE_SIZE, "fields": HISTORY_LIST_FIELDS}
+        if st.session_state.history_cursors[-1]:
+            params["after"] = st.session_state.history_cursors[-1]
+        response = requests.get(f"{API_BASE_URL}/patients", params=params, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -585,7 +625,8 @@ def history_page():
                     filtered_patients = [p for p in patients if search_term.lower() in p.get('name', '').lower()]
                 
                 # 显示患者列表
-                st.markdown(f"### 患者记录 ({len(filtered_patients)} 条)")
+                page = len(st.session_state.history_cursors)
+                st.markdown(f"### 患者记录（第 {page} 页，{len(filtered_patients)} 条）")
                 
                 for patient in filtered_patients:
                     with st.expander(f"👤 {patient.get('name', '未知')} - {patient.get('created_at', '未知时间')}"):
@@ -607,6 +648,8 @@ def history_page():
                         with col_btn1:
                             if st.button(f"👁️ 查看详情", key=f"view_{patient.get('id')}"):
                                 view_patient_details(patient.get('id'))
+                            if patient.get('latest_report_id') and st.button(f"📋 最新报告", key=f"report_{patient.get('id')}"):
+                                view_report(patient['latest_report_id'])
                         
                         with col_btn2:
                             if st.button(f"🗑️ 删除", key=f"delete_{patient.get('id')}", type="secondary"):
@@ -627,6 +670,17 @@ def history_page():
                                 if st.button(f"❌ 取消", key=f"cancel_{patient.get('id')}", type="secondary"):
                                     st.session_state[f'confirm_delete_{patient.get("id")}'] = False
                                     st.rerun()
+                
+                # 翻页
+                col_prev, col_next = st.columns(2)
+                with col_prev:
+                    if page > 1 and st.button("⬅️ 上一页"):
+                        st.session_state.history_cursors.pop()
+                        st.rerun()
+                with col_next:
+                    if data.get('has_more') and st.button("下一页 ➡️"):
+                        st.session_state.history_cursors.append(data['next_cursor'])
+                        st.rerun()
             else:
                 st.info("📝 暂无患者记录")
         else:
@@ -681,6 +735,21 @@ def view_patient_details(patient_id):
     except Exception as e:
         st.error(f"❌ 发生错误: {str(e)}")
 
+def view_report(report_id):
+    """按需加载并显示报告正文"""
+    try:
+        response = requests.get(f"{API_BASE_URL}/reports/{report_id}", timeout=10)
+        
+        if response.status_code == 200:
+            report = response.json()["report"]
+            st.markdown(f"### 📋 诊疗报告（{report.get('created_at', '')}）")
+            st.markdown(report.get("content", ""))
+        else:
+            st.error(f"❌ 获取报告失败: {response.text}")
+            
+    except Exception as e:
+        st.error(f"❌ 发生错误: {str(e)}")
+
 def ai_chat_page():
     """AI对话页面"""
     st.markdown('<h2 class="section-header">🤖 AI对话助手</h2>', unsafe_allow_html=True)
@@ -1262,7 +1331,7 @@ def check_api_status():
 def check_database_status():
     """检查数据库状态"""
     try:
-        response = requests.get(f"{API_BASE_URL}/patients", timeout=5)
+        response = requests.get(f"{API_BASE_URL}/patients", params={"limit": 1, "fields": "id"}, timeout=5)
         return response.status_code == 200
     except:
         return False
@@ -0,0 +1,242 @@
+"""
+归档存储 - 把长期不活跃的病人及其报告按月移入独立的 SQLite 文件
+
+- 病人按创建月份分区，连同报告、检验结果一起写入 ARCHIVE_DIR 下的 <库名>_<YYYY-MM>.db
+- 活跃库只保留 archived_patients 定位表（病人 ID -> 分区），查询热路径和备份、VACUUM 的耗时都与归档数据量无关
+- 归档文件按需 ATTACH，/patient/{id} 查不到时透明地从归档读取
+- 归档文件的表结构取自活跃库，后续迁移新增的列会在下次归档时补齐
+- 每批在一个事务中先写归档再删活跃库；WAL 模式下跨库提交不保证原子性，
+  中断后重跑会覆盖归档中已有的行，不会丢数据也不会重复
+"""
+
+import glob
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import config
+from database import Database
+from report_store import report_codec
+from search import unindex_patients
+
+ARCHIVE_SCHEMA = "archive"
+# 随病人一起归档的表（报告字典只复制不删除，使归档文件可独立解压）
+ARCHIVED_TABLES = ("patients", "reports", "lab_results", "report_dictionaries")
+
+
+def partition_path(database: Database, partition: str) -> str:
+    """分区 "2024-03" 对应的归档文件路径"""
+    stem = os.path.splitext(os.path.basename(database.db_path))[0]
+    return os.path.join(config.ARCHIVE_DIR, f"{stem}_{partition}.db")
+
+
+def _table_columns(conn, schema: str, table: str) -> List[Tuple[str, str]]:
+    return [(row[1], row[2]) for row in conn.execute(f'PRAGMA {schema}.table_info({table})')]
+
+
+def _ensure_archive_schema(conn):
+    """按活跃库的表结构创建归档表，已有的归档表补齐缺少的列"""
+    for table in ARCHIVED_TABLES:
+        existing = {name for name, _ in _table_columns(conn, ARCHIVE_SCHEMA, table)}
+        if not existing:
+            sql = conn.execute(
+                "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()[0]
+            conn.execute(sql.replace("CREATE TABLE ", f"CREATE TABLE {ARCHIVE_SCHEMA}.", 1))
+            continue
+        for name, column_type in _table_columns(conn, "main", table):
+            if name not in existing:
+                conn.execute(f'ALTER TABLE {ARCHIVE_SCHEMA}.{table} ADD COLUMN {name} {column_type}')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {ARCHIVE_SCHEMA}.idx_reports_patient ON reports (patient_id)')
+
+
+def _attach(conn, path: str):
+    conn.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (path,))
+
+
+def _detach(conn):
+    conn.execute(f'DETACH DATABASE {ARCHIVE_SCHEMA}')
+
+
+def _copy_rows(conn, table: str, key: str, ids: List[int]):
+    columns = ", ".join(name for name, _ in _table_columns(conn, "main", table))
+    placeholders = ",".join("?" * len(ids))
+    conn.execute(
+        f'INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.{table} ({columns}) '
+        f'SELECT {columns} FROM main.{table} WHERE {key} IN ({placeholders})', ids
+    )
+
+
+def _move_batch(database: Database, partition: str, ids: List[int]):
+    """把一批同一分区的病人移入归档文件"""
+    os.makedirs(config.ARCHIVE_DIR, exist_ok=True)
+    placeholders = ",".join("?" * len(ids))
+    with database.connection() as conn:
+        # ATTACH 不能在事务中执行
+        _attach(conn, partition_path(database, partition))
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                _ensure_archive_schema(conn)
+                conn.execute(
+                    f'INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}.report_dictionaries SELECT * FROM main.report_dictionaries'
+                )
+                _copy_rows(conn, "patients", "id", ids)
+                _copy_rows(conn, "reports", "patient_id", ids)
+                _copy_rows(conn, "lab_results", "patient_id", ids)
+                conn.execute(f'''
+                    INSERT OR REPLACE INTO archived_patients (id, partition, created_at)
+                    SELECT id, ?, created_at FROM main.patients WHERE id IN ({placeholders})
+                ''', (partition, *ids))
+                # 先移除报告和病人的全文索引；lab_results 由删除病人的触发器同步删除
+                report_codec.unindex_reports(conn, f'patient_id IN ({placeholders})', ids)
+                unindex_patients(conn, f'id IN ({placeholders})', ids)
+                conn.execute(f'DELETE FROM main.reports WHERE patient_id IN ({placeholders})', ids)
+                conn.execute(f'DELETE FROM main.patients WHERE id IN ({placeholders})', ids)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        finally:
+            _detach(conn)
+
+
+def archive_old_records(database: Database, older_than_days: int = None, batch_size: int = None,
+                        vacuum: bool = False) -> Dict[str, Any]:
+    """
+    归档创建时间早于 older_than_days 天、且期间没有新报告的病人
+
+    Args:
+        database: 数据库实例
+        older_than_days: 归档阈值（天），默认 ARCHIVE_AFTER_DAYS
+        batch_size: 每个事务移动的病人数
+        vacuum: 完成后是否 VACUUM 活跃库以回收文件空间
+
+    Returns:
+        {"archived": 总病人数, "partitions": {"2024-03": 病人数, ...}}
+    """
+    older_than_days = older_than_days if older_than_days is not None else config.ARCHIVE_AFTER_DAYS
+    batch_size = batch_size or config.ARCHIVE_BATCH_SIZE
+    cutoff = f"-{int(older_than_days)} days"
+    partitions: Dict[str, int] = {}
+
+    while True:
+        # 经 idx_patients_created 从最早的病人开始取；已移走的行不会再被选中
+        rows = database.query_all('''
+            SELECT p.id, strftime('%Y-%m', p.created_at)
+            FROM patients p
+            WHERE p.created_at < datetime('now', ?)
+              AND NOT EXISTS (
+                  SELECT 1 FROM reports r WHERE r.patient_id = p.id AND r.created_at >= datetime('now', ?)
+              )
+            ORDER BY p.created_at, p.id
+            LIMIT ?
+        ''', (cutoff, cutoff, batch_size))
+        if not rows:
+            break
+        groups: Dict[str, List[int]] = {}
+        for patient_id, partition in rows:
+            groups.setdefault(partition or "unknown", []).append(patient_id)
+        for partition, ids in groups.items():
+            _move_batch(database, partition, ids)
+            partitions[partition] = partitions.get(partition, 0) + len(ids)
+
+    if vacuum and partitions:
+        with database.connection() as conn:
+            conn.execute('VACUUM')
+    return {"archived": sum(partitions.values()), "partitions": partitions}
+
+
+def _archived_partition(database: Database, patient_id: int) -> Optional[str]:
+    row = database.query_one('SELECT partition FROM archived_patients WHERE id = ?', (patient_id,))
+    if not row or not os.path.exists(partition_path(database, row[0])):
+        return None
+    return row[0]
+
+
+def load_archived_patient(database: Database, patient_id: int) -> Optional[Tuple[tuple, List[tuple]]]:
+    """
+    从归档读取病人及其全部报告（报告正文已解压）
+
+    Returns:
+        (病人行, 报告行列表)，列顺序与活跃库一致；未归档时返回 None
+    """
+    partition = _archived_partition(database, patient_id)
+    if not partition:
+        return None
+    with database.connection() as conn:
+        _attach(conn, partition_path(database, partition))
+        try:
+            patient = conn.execute(f'SELECT * FROM {ARCHIVE_SCHEMA}.patients WHERE id = ?', (patient_id,)).fetchone()
+            reports = conn.execute(f'''
+                SELECT id, patient_id, report_text(report_content, compression) AS report_content,
+                       report_type, created_at
+                FROM {ARCHIVE_SCHEMA}.reports
+                WHERE patient_id = ?
+                ORDER BY created_at DESC, id DESC
+            ''', (patient_id,)).fetchall()
+        finally:
+            _detach(conn)
+    return (patient, reports) if patient else None
+
+
+def delete_archived_patient(database: Database, patient_id: int) -> Optional[str]:
+    """从归档中删除病人及其报告，返回病人姓名；未归档时返回 None"""
+    partition = _archived_partition(database, patient_id)
+    if not partition:
+        return None
+    with database.connection() as conn:
+        _attach(conn, partition_path(database, partition))
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    f'SELECT name FROM {ARCHIVE_SCHEMA}.patients WHERE id = ?', (patient_id,)
+                ).fetchone()
+                for table, key in (("reports", "patient_id"), ("lab_results", "patient_id"), ("patients", "id")):
+                    conn.execute(f'DELETE FROM {ARCHIVE_SCHEMA}.{table} WHERE {key} = ?', (patient_id,))
+                conn.execute('DELETE FROM archived_patients WHERE id = ?', (patient_id,))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        finally:
+            _detach(conn)
+    return row[0] if row else None
+
+
+def delete_all_archives(database: Database) -> Dict[str, int]:
+    """删除全部归档文件，返回删除的病人数和报告数"""
+    patients, reports = 0, 0
+    stem = os.path.splitext(os.path.basename(database.db_path))[0]
+    for path in glob.glob(os.path.join(config.ARCHIVE_DIR, f"{stem}_*.db")):
+        with database.connection() as conn:
+            _attach(conn, path)
+            try:
+                patients += conn.execute(f'SELECT COUNT(*) FROM {ARCHIVE_SCHEMA}.patients').fetchone()[0]
+                reports += conn.execute(f'SELECT COUNT(*) FROM {ARCHIVE_SCHEMA}.reports').fetchone()[0]
+            finally:
+                _detach(conn)
+        os.remove(path)
+    with database.transaction() as conn:
+        conn.execute('DELETE FROM archived_patients')
+    return {"patients": patients, "reports": reports}
+
+
+def archive_stats(database: Database) -> Dict[str, Any]:
+    """各分区的病人数和文件大小"""
+    rows = database.query_all(
+        'SELECT partition, COUNT(*) FROM archived_patients GROUP BY partition ORDER BY partition'
+    )
+    return {
+        "active_db_bytes": os.path.getsize(database.db_path) if os.path.exists(database.db_path) else 0,
+        "partitions": [
+            {
+                "partition": partition,
+                "patients": count,
+                "file": partition_path(database, partition),
+                "bytes": os.path.getsize(partition_path(database, partition))
+                if os.path.exists(partition_path(database, partition)) else 0
+            }
+            for partition, count in rows
+        ]
+    }
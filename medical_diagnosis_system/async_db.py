@@ -0,0 +1,190 @@
+"""
+异步数据库访问 - 让 async 接口中的 SQLite 读写不占用事件循环
+
+- 读：在专用的读线程池中执行，连接取自 database.py 的连接池
+- 写：交给唯一的写线程按顺序执行；写线程把排队中的多个写操作合并进同一个事务提交（组提交），
+  每个写操作各有一个 SAVEPOINT，其中一个失败只回滚它自己
+- 调用方 await 结果即可，流式响应等其他协程在数据库 I/O 期间照常运行
+"""
+
+import asyncio
+import contextvars
+import functools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Sequence
+
+import metrics
+from config import config
+from database import Database, db
+
+
+class _Write:
+    __slots__ = ("func", "args", "future", "loop", "context")
+
+    def __init__(self, func, args, future, loop, context):
+        self.func = func
+        self.args = args
+        self.future = future
+        self.loop = loop
+        self.context = context
+
+
+def _resolve(future: asyncio.Future, ok: bool, value: Any):
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+class AsyncDatabase:
+    """Database 的异步门面"""
+
+    def __init__(self, database: Database, read_workers: int = None, group_commit_max: int = None):
+        self.database = database
+        self.read_workers = read_workers or config.DB_READ_WORKERS
+        self.group_commit_max = group_commit_max or config.DB_GROUP_COMMIT_MAX
+
+        self._readers: Optional[ThreadPoolExecutor] = None
+        self._writes: "queue.Queue[Optional[_Write]]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+        self.commits = 0
+        self.writes = 0
+
+    # ---------- 读 ----------
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """在读线程池中执行阻塞的数据库函数（如 search_records(db, ...)）"""
+        with self._lock:
+            if self._readers is None:
+                self._readers = ThreadPoolExecutor(self.read_workers, thread_name_prefix="db-reader")
+        # 复制上下文，使线程中记录的 Server-Timing 阶段归入当前请求
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._readers, call)
+
+    async def read(self, func: Callable, *args) -> Any:
+        """借出一个连接执行 func(conn, *args)"""
+        return await self.run(self._with_connection, func, args)
+
+    def _with_connection(self, func: Callable, args: tuple) -> Any:
+        with self.database.connection() as conn:
+            return func(conn, *args)
+
+    async def query_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        return await self.run(self.database.query_one, sql, params)
+
+    async def query_all(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return await self.run(self.database.query_all, sql, params)
+
+    # ---------- 写 ----------
+
+    async def write(self, func: Callable, *args) -> Any:
+        """
+        在写线程中执行 func(conn, *args) 并返回其结果
+
+        func 在写事务中运行，不能自行 commit/rollback；与同时排队的其他写操作一起提交，
+        await 返回时数据已经提交。
+        """
+        self._ensure_writer()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put(_Write(func, args, future, loop, contextvars.copy_context()))
+        return await future
+
+    @property
+    def write_queue_depth(self) -> int:
+        return self._writes.qsize()
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+                self._writer.start()
+
+    def _writer_loop(self):
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            # 组提交：执行上一批期间排队的写操作并入同一个事务
+            while len(batch) < self.group_commit_max:
+                try:
+                    item = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+            if stop:
+                return
+
+    def _commit_batch(self, batch: List[_Write]):
+        results = []
+        try:
+            with self.database.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for write in batch:
+                        conn.execute('SAVEPOINT group_write')
+                        try:
+                            value = write.context.run(write.func, conn, *write.args)
+                        except Exception as e:
+                            conn.execute('ROLLBACK TO group_write')
+                            conn.execute('RELEASE group_write')
+                            results.append((False, e))
+                        else:
+                            conn.execute('RELEASE group_write')
+                            results.append((True, value))
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+        except Exception as e:
+            # 开启或提交事务失败：本批全部失败
+            results = [(False, e)] * len(batch)
+        else:
+            self.commits += 1
+            self.writes += len(batch)
+
+        for write, (ok, value) in zip(batch, results):
+            write.loop.call_soon_threadsafe(_resolve, write.future, ok, value)
+
+    # ---------- 生命周期 ----------
+
+    def close(self):
+        """处理完已排队的写操作后停止写线程和读线程池（应用关闭时调用）"""
+        with self._lock:
+            writer, self._writer = self._writer, None
+            readers, self._readers = self._readers, None
+        if writer is not None:
+            self._writes.put(None)
+            writer.join()
+        if readers is not None:
+            readers.shutdown(wait=True)
+
+
+# 创建全局异步数据库实例
+adb = AsyncDatabase(db)
+
+metrics.registry.gauge(
+    "db_write_queue_depth", "等待写线程执行的数据库写操作数",
+    callback=lambda: adb.write_queue_depth
+)
+metrics.registry.counter(
+    "db_group_commits_total", "写线程提交的事务数",
+    callback=lambda: adb.commits
+)
+metrics.registry.counter(
+    "db_writes_total", "经写线程执行的写操作数（与提交数之比即平均每次提交合并的写操作数）",
+    callback=lambda: adb.writes
+)
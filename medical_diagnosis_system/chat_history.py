@@ -0,0 +1,143 @@
+"""
+对话历史管理 - 按 token 预算压缩 /chat 的对话历史
+
+- 保留系统提示和最近 N 轮对话原文
+- 更早的对话替换为滚动摘要，摘要按前缀指纹缓存，仅在窗口移动时增量更新
+- 窗口按固定步长移动，避免每轮对话都重新生成摘要
+"""
+
+import hashlib
+import json
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+from rate_limiter import PRIORITY_INTERACTIVE
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+SUMMARY_SYSTEM_PROMPT = "你是一个医疗对话记录整理助手，负责把医患/医生与AI的对话压缩为简洁准确的摘要。"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文约 1 字 1 token，其他字符约 4 个 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """估算消息列表的 token 数（每条消息额外计 4 个格式开销）"""
+    return sum(estimate_tokens(str(m.get("content", ""))) + 4 for m in messages)
+
+
+class ConversationHistoryManager:
+    """基于 token 预算的对话历史压缩器"""
+
+    def __init__(self, llm_gateway, max_history_tokens: int = None, keep_last_turns: int = None,
+                 summary_step_turns: int = None, summary_max_tokens: int = None,
+                 max_cached_summaries: int = 256):
+        self.llm_gateway = llm_gateway
+        self.max_history_tokens = max_history_tokens or config.CHAT_HISTORY_MAX_TOKENS
+        self.keep_last_turns = keep_last_turns or config.CHAT_KEEP_LAST_TURNS
+        self.summary_step_turns = summary_step_turns or config.CHAT_SUMMARY_STEP_TURNS
+        self.summary_max_tokens = summary_max_tokens or config.CHAT_SUMMARY_MAX_TOKENS
+        self.max_cached_summaries = max_cached_summaries
+
+        # 前缀指纹 -> 该前缀的摘要
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+
+    async def build_messages(self, system_prompt: str, history: List[Dict[str, str]],
+                             user_message: str) -> List[Dict[str, str]]:
+        """组装发给大模型的消息列表，历史超出预算时压缩早期对话"""
+        history = [
+            {"role": m.get("role", "user"), "content": str(m.get("content", ""))}
+            for m in history if isinstance(m, dict) and m.get("content")
+        ]
+        messages = [{"role": "system", "content": system_prompt}]
+
+        if count_message_tokens(history) <= self.max_history_tokens:
+            return messages + history + [{"role": "user", "content": user_message}]
+
+        older, recent = self._split(history)
+        if older:
+            summary = await self._summarize(older)
+            if summary:
+                messages.append({"role": "system", "content": f"以下是此前对话的摘要：\n{summary}"})
+
+        # 近期原文仍超预算时从最早的消息开始丢弃，至少保留最后一条
+        budget = self.max_history_tokens - count_message_tokens(messages[1:])
+        while len(recent) > 1 and count_message_tokens(recent) > budget:
+            recent = recent[1:]
+
+        return messages + recent + [{"role": "user", "content": user_message}]
+
+    def _split(self, history: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+        """
+        划分需要摘要的早期消息和保留原文的近期消息
+
+        摘要边界按 summary_step_turns 对齐，近期原文保留 keep_last_turns 到
+        keep_last_turns + summary_step_turns 轮，边界不变时摘要可直接复用缓存。
+        """
+        keep = self.keep_last_turns * 2
+        step = self.summary_step_turns * 2
+        overflow = len(history) - keep
+        if overflow <= 0:
+            return [], history
+        cut = (overflow // step) * step
+        return history[:cut], history[cut:]
+
+    async def _summarize(self, older: List[Dict[str, str]]) -> Optional[str]:
+        """返回 older 的摘要，优先在最长的已缓存前缀摘要上增量更新"""
+        prefix_keys = self._prefix_keys(older)
+        full_key = prefix_keys[-1]
+        if full_key in self._summaries:
+            self._summaries.move_to_end(full_key)
+            return self._summaries[full_key]
+
+        base_summary, start = None, 0
+        for i in range(len(prefix_keys) - 2, -1, -1):
+            if prefix_keys[i] in self._summaries:
+                base_summary, start = self._summaries[prefix_keys[i]], i + 1
+                break
+
+        transcript = "\n".join(
+            f"{'用户' if m['role'] == 'user' else '助手'}：{m['content']}" for m in older[start:]
+        )
+        prompt = "请将以下对话压缩为摘要，保留患者信息、关键症状、检查指标、诊断意见和已给出的建议，省略寒暄：\n\n"
+        if base_summary:
+            prompt += f"【已有摘要】\n{base_summary}\n\n【新增对话】\n{transcript}"
+        else:
+            prompt += transcript
+
+        try:
+            summary = await self.llm_gateway.complete(
+                messages=[
+                    {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.2,
+                max_tokens=self.summary_max_tokens,
+                use_cache=True,
+                priority=PRIORITY_INTERACTIVE
+            )
+        except Exception as e:
+            print(f"⚠️ 对话摘要生成失败，改为仅保留近期对话: {e}")
+            return base_summary
+
+        self._summaries[full_key] = summary
+        while len(self._summaries) > self.max_cached_summaries:
+            self._summaries.popitem(last=False)
+        return summary
+
+    @staticmethod
+    def _prefix_keys(messages: List[Dict[str, str]]) -> List[str]:
+        """逐条累积计算前缀指纹，prefix_keys[i] 对应 messages[:i + 1]"""
+        digest = hashlib.sha256()
+        keys = []
+        for m in messages:
+            digest.update(json.dumps([m["role"], m["content"]], ensure_ascii=False).encode("utf-8"))
+            keys.append(digest.copy().hexdigest())
+        return keys
@@ -3,8 +3,11 @@
 """
 
 import streamlit as st
+import requests
 from typing import Optional
 
+from config import config
+
 class ModernHeader:
     """现代化头部组件"""
     
@@ -44,6 +47,8 @@ class ModernHeader:
                 key="header_search",
                 help="搜索患者信息或报告内容"
             )
+            if search_query.strip():
+                self.render_search_results(search_query)
         
         # 主题切换按钮
         if show_theme_toggle:
@@ -105,6 +110,30 @@ class ModernHeader:
         </div>
         """, unsafe_allow_html=True)
     
+    def render_search_results(self, query: str, limit: int = 10):
+        """调用服务端全文检索并显示结果"""
+        try:
+            response = requests.get(
+                f"{config.API_BASE_URL}/search",
+                params={"q": query, "limit": limit},
+                timeout=5
+            )
+            if response.status_code != 200:
+                st.error(f"❌ 检索失败: {response.text}")
+                return
+            results = response.json().get("results", [])
+        except requests.exceptions.RequestException as e:
+            st.error(f"❌ 检索失败: {str(e)}")
+            return
+        
+        if not results:
+            st.info("未找到匹配的患者或报告")
+            return
+        for item in results:
+            label = "📋 报告" if item["type"] == "report" else "👤 患者"
+            st.markdown(f"{label} · **{item.get('patient_name') or '未知'}**（ID {item['patient_id']}，{item.get('created_at', '')}）")
+            st.caption(item.get("snippet", ""))
+    
     def update_time(self):
         """更新时间显示"""
         from datetime import datetime
@@ -18,8 +18,87 @@ class Config:
     MODEL_TRAINING_URL = "http://localhost:7003"  # 本地模拟服务
     # MODEL_TRAINING_URL = "http://47.108.190.171:7003"  # 生产服务器
     
+    # 大模型网关配置（可通过环境变量覆盖）
+    LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+    LLM_MODEL = os.getenv("LLM_MODEL", "qwen-plus")
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))  # 同时在途的上游请求数
+    LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))  # HTTP连接池上限
+    LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "16"))  # 保持的空闲长连接数
+    LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "90"))  # 单次调用超时（秒）
+    LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))  # 429/超时/连接错误的重试次数
+    LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))  # 指数退避基准（秒），带随机抖动
+    LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20"))
+    LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "300"))  # 0 表示不限制
+    LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "500000"))  # 0 表示不限制
+    LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "100"))  # 等待放行的请求上限，超出返回 503
+    LLM_PRICE_PER_1K_PROMPT = float(os.getenv("LLM_PRICE_PER_1K_PROMPT", "0.0008"))  # 元/千 token，用于费用估算
+    LLM_PRICE_PER_1K_COMPLETION = float(os.getenv("LLM_PRICE_PER_1K_COMPLETION", "0.002"))
+
+    # 大模型响应缓存配置
+    LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("true", "1", "yes", "on")
+    LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.db")  # 与 medical_reports.db 同目录
+    LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # 过期时间（秒），0 表示不过期
+    LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+    LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+    # 对话历史压缩配置
+    CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "3000"))  # 历史消息的 token 预算
+    CHAT_KEEP_LAST_TURNS = int(os.getenv("CHAT_KEEP_LAST_TURNS", "6"))  # 至少保留原文的最近轮数
+    CHAT_SUMMARY_STEP_TURNS = int(os.getenv("CHAT_SUMMARY_STEP_TURNS", "4"))  # 摘要窗口每次移动的轮数
+    CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "500"))
+
+    # 批量报告生成配置
+    BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))  # 单次批量请求的病人数上限
+    BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+    BATCH_RATE_LIMIT = float(os.getenv("BATCH_RATE_LIMIT", "2"))  # 每秒发起的 LLM 请求数
+
+    # 后台任务队列配置
+    JOB_DB_PATH = os.getenv("JOB_DB_PATH", "medical_reports.db")
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # 进程内并行执行的任务数
+    JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))  # 租约过期未续期的任务会被重新执行
+    JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))  # 空闲时检查新任务/过期租约的间隔（秒）
+    JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "5"))  # 可重试任务的指数退避基准（秒），带随机抖动
+    JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "300"))
+
     # 数据库配置
     DATABASE_PATH = "medical_database.db"
+    REPORTS_DB_PATH = os.getenv("REPORTS_DB_PATH", "medical_reports.db")  # 病人/报告库
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))  # 连接池最大连接数
+    DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))  # 等待写锁/空闲连接的超时（秒）
+    DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", str(64 * 1024)))  # 每个连接的页缓存
+    DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))  # 内存映射读取的字节数
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "128"))  # 每个连接缓存的已编译语句数
+    DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "8"))  # 异步接口执行数据库读操作的线程数
+    DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "64"))  # 写线程每个事务最多合并的写操作数
+    PATIENTS_PAGE_SIZE = int(os.getenv("PATIENTS_PAGE_SIZE", "50"))  # /patients 带 after 翻页时的默认每页条数
+    PATIENTS_MAX_PAGE_SIZE = int(os.getenv("PATIENTS_MAX_PAGE_SIZE", "500"))
+    SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "100"))  # /search 每页条数上限
+    IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))  # 批量导入每个事务写入的行数
+    COHORT_PAGE_SIZE = int(os.getenv("COHORT_PAGE_SIZE", "100"))  # /cohort/query 默认每页条数
+    COHORT_MAX_PAGE_SIZE = int(os.getenv("COHORT_MAX_PAGE_SIZE", "1000"))
+    EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))  # /export 每次从游标读取并输出的行数
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")  # 按月归档的 SQLite 文件目录
+    ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))  # 创建超过该天数且期间无新报告的病人移入归档
+    ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))  # 归档时每个事务移动的病人数
+    ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "0"))  # 自动归档间隔（小时），默认 0 不自动归档
+    REPORT_COMPRESSION = os.getenv("REPORT_COMPRESSION", "auto")  # 报告正文压缩：auto / zstd / zlib / none
+    REPORT_COMPRESSION_LEVEL = int(os.getenv("REPORT_COMPRESSION_LEVEL", "9"))
+    REPORT_COMPRESSION_MIN_BYTES = int(os.getenv("REPORT_COMPRESSION_MIN_BYTES", "256"))  # 更短的报告保存明文
+    REPORT_DICT_SIZE = int(os.getenv("REPORT_DICT_SIZE", str(32 * 1024)))  # 共享字典大小（zlib 最多使用 32KB）
+    REPORT_COMPRESSION_BATCH_SIZE = int(os.getenv("REPORT_COMPRESSION_BATCH_SIZE", "500"))  # 存量压缩每批行数
+    REPORT_DICT_SAMPLE_LIMIT = int(os.getenv("REPORT_DICT_SAMPLE_LIMIT", "2000"))  # 训练字典时最多取的最近报告数
+    REPORT_DICT_RETRAIN_MIN_REPORTS = int(os.getenv("REPORT_DICT_RETRAIN_MIN_REPORTS", "200"))  # 报告达到该数量后才用真实报告重新训练字典
+    REPORT_DICT_RETRAIN_GROWTH = float(os.getenv("REPORT_DICT_RETRAIN_GROWTH", "4"))  # 报告数增长到上次训练样本数的该倍数时重新训练
+    REPORT_DICT_CHECK_INTERVAL = int(os.getenv("REPORT_DICT_CHECK_INTERVAL", "100"))  # 每写入多少份报告检查一次是否需要重新训练
+    PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "reports/cache")  # 渲染好的 PDF 报告缓存目录
+    PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))  # 超出后按最近访问时间淘汰
+    PDF_FONT_PATH = os.getenv("PDF_FONT_PATH", "")  # PDF 中文字体文件（TTF/TTC），为空时使用内置 CID 字体 STSong-Light
+    PDF_FONT_BOLD_PATH = os.getenv("PDF_FONT_BOLD_PATH", "")  # 可选的粗体字体文件
+    PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))  # PDF 渲染进程数，0 表示在线程中渲染
+    PDF_EXPORT_MAX_PATIENTS = int(os.getenv("PDF_EXPORT_MAX_PATIENTS", "200"))  # /export/pdfs 单次最多导出的病人数
+    REPORT_MARKDOWN_CACHE_SIZE = int(os.getenv("REPORT_MARKDOWN_CACHE_SIZE", "256"))  # 每个进程缓存解析结果的报告数
     
     # 系统配置
     SYSTEM_NAME = "医疗AI科研系统"
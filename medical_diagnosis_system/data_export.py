@@ -0,0 +1,346 @@
+"""
+数据导出 - 以 NDJSON / CSV / Parquet 流式导出病人和报告
+
+- 按 ID 键集分页，每块单独执行一次短查询并逐块编码输出：内存占用与数据量无关，
+  客户端下载再慢也不会长时间占用连接池中的连接、不会让一个读事务一直钉住 WAL
+- 病人列与 research.data_engineering.create_sample_dataset 的数据集一致，
+  导出的文件可直接交给 DataProcessor 处理；其余检验指标追加在后面
+- since / until 按自增 ID 做增量导出：把响应头 X-Export-Until 作为下一次的 since 即可。
+  写事务由 BEGIN IMMEDIATE 串行执行，ID 按提交顺序分配，截止 ID 之前的行都已提交，
+  不会像按 created_at（语句执行时间而非提交时间）那样漏掉提交较慢的批量导入
+- encode_zip 把陆续生成的文件（如批量导出的 PDF）逐个写入 ZIP 并立即输出
+"""
+
+import csv
+import io
+import json
+import re
+import zipfile
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import config
+from database import Database
+from lab_results import parse_number
+
+# create_sample_dataset 的列（列名, 类型）
+SAMPLE_DATASET_COLUMNS: List[Tuple[str, str]] = [
+    ("patient_id", "string"),
+    ("age", "int"),
+    ("sex", "string"),
+    ("weight", "float"),
+    ("hypertension", "int"),
+    ("diabetes", "int"),
+    ("ALT", "float"),
+    ("AST", "float"),
+    ("AFP", "float"),
+    ("albumin", "float"),
+    ("bilirubin", "float"),
+    ("tumor_size_cm", "float"),
+    ("portal_vein_invasion", "int"),
+    ("lymph_node_metastasis", "int"),
+    ("histologic_grade", "string"),
+    ("surgery_type", "string"),
+    ("r0_resection", "int"),
+    ("survival_months", "float"),
+    ("death_event", "int"),
+    ("recurrence", "int"),
+    ("recurrence_months", "float"),
+    ("chief_complaint", "string"),
+    ("imaging_result", "string"),
+]
+
+# 数据集之外的病人字段
+PATIENT_EXTRA_COLUMNS: List[Tuple[str, str]] = [
+    ("id", "int"),
+    ("name", "string"),
+    ("history", "string"),
+    ("additional_notes", "string"),
+    ("created_at", "string"),
+]
+
+REPORT_EXPORT_COLUMNS: List[Tuple[str, str]] = [
+    ("report_id", "int"),
+    ("id", "int"),
+    ("patient_id", "string"),
+    ("report_type", "string"),
+    ("created_at", "string"),
+    ("report_content", "string"),
+]
+
+# 数据集列 -> labs 中可能使用的名称（按顺序取第一个存在的）
+LAB_ALIASES = {
+    "albumin": ("albumin", "白蛋白"),
+    "bilirubin": ("bilirubin", "总胆红素"),
+}
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+EXPORT_TABLES = ("patients", "reports")
+
+
+def export_watermark(database: Database, table: str) -> int:
+    """本次导出的截止 ID：此刻已提交的最大 ID"""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"不支持导出的表: {table}")
+    return database.query_one(f'SELECT COALESCE(MAX(id), 0) FROM {table}')[0]
+
+
+def normalize_timestamp(value: str) -> str:
+    """接受 ISO 格式（2024-01-01T08:00:00）或 created_at 格式"""
+    return value.strip().replace("T", " ").rstrip("Z")
+
+
+def parse_since(value: Optional[str]) -> Tuple[int, Optional[str]]:
+    """
+    解析 since，返回 (起始 ID, 起始时间)
+
+    X-Export-Until 为截止 ID；早期版本返回的是时间，仍按 created_at 过滤，导出后改用新的截止 ID
+    """
+    if not value:
+        return 0, None
+    value = value.strip()
+    if value.isdigit():
+        return int(value), None
+    return 0, normalize_timestamp(value)
+
+
+def _iter_pages(database: Database, sql: str, since: Optional[str], until: int, chunk_size: int,
+                alias: str = "") -> Iterator[List[tuple]]:
+    """
+    按 ID 键集分页读取 (since, until] 范围内的行，每页单独借用连接执行一次查询
+
+    sql 中以 {where} 作为条件占位，首列须为 ID
+    """
+    last_id, since_time = parse_since(since)
+    while True:
+        where = [f"{alias}id > ?", f"{alias}id <= ?"]
+        params: List[Any] = [last_id, until]
+        if since_time:
+            where.append(f"{alias}created_at > ?")
+            params.append(since_time)
+        rows = database.query_all(
+            sql.format(where=" AND ".join(where)) + f" ORDER BY {alias}id LIMIT ?", (*params, chunk_size)
+        )
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _coerce(value: Any, kind: str) -> Any:
+    if value is None or value == "":
+        return None
+    if kind == "string":
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False)
+        return str(value)
+    number = parse_number(value.get("value") if isinstance(value, dict) else value)
+    if number is None:
+        return None
+    return int(number) if kind == "int" else number
+
+
+def patient_columns(database: Database, extra_labs: bool = True) -> List[Tuple[str, str]]:
+    """
+    病人导出列：数据集列 + 病人其他字段 + 其余检验指标
+
+    其余检验指标从 lab_results 索引中取出，全部为数值的指标按 float 导出，否则按文本导出。
+    """
+    columns = SAMPLE_DATASET_COLUMNS + PATIENT_EXTRA_COLUMNS
+    if extra_labs:
+        known = {name for name, _ in columns}
+        known.update(alias for aliases in LAB_ALIASES.values() for alias in aliases)
+        for test_name, numeric in database.query_all(
+            'SELECT test_name, MIN(value IS NOT NULL) FROM lab_results GROUP BY test_name ORDER BY test_name'
+        ):
+            if test_name not in known:
+                columns.append((test_name, "float" if numeric else "string"))
+    return columns
+
+
+def iter_patient_records(database: Database, columns: List[Tuple[str, str]], since: Optional[str] = None,
+                         until: int = None, chunk_size: int = None) -> Iterator[List[Dict[str, Any]]]:
+    """按 ID 顺序分块读取 (since, until] 范围内的病人，每块为一组已按 columns 转换好的记录"""
+    chunk_size = chunk_size or config.EXPORT_CHUNK_SIZE
+    until = until if until is not None else export_watermark(database, "patients")
+    sql = '''
+        SELECT id, external_id, name, age, sex, chief_complaint, history, labs, imaging,
+               additional_notes, created_at
+        FROM patients
+        WHERE {where}
+    '''
+    for rows in _iter_pages(database, sql, since, until, chunk_size):
+        yield [_patient_record(row, columns) for row in rows]
+
+
+def _patient_record(row: tuple, columns: List[Tuple[str, str]]) -> Dict[str, Any]:
+    patient_id, external_id, name, age, sex, chief_complaint, history, labs, imaging, notes, created_at = row
+    try:
+        labs = json.loads(labs) if labs else {}
+    except ValueError:
+        labs = {}
+    if not isinstance(labs, dict):
+        labs = {}
+
+    values = {
+        "patient_id": external_id or f"P{patient_id:04d}",
+        "age": age,
+        "sex": sex,
+        "chief_complaint": chief_complaint,
+        "imaging_result": imaging,
+        "id": patient_id,
+        "name": name,
+        "history": history,
+        "additional_notes": notes,
+        "created_at": created_at,
+    }
+    record = {}
+    for column, kind in columns:
+        if column in values:
+            value = values[column]
+        else:
+            value = next((labs[a] for a in LAB_ALIASES.get(column, (column,)) if a in labs), None)
+        record[column] = _coerce(value, kind)
+    return record
+
+
+def iter_report_records(database: Database, since: Optional[str] = None, until: int = None,
+                        chunk_size: int = None) -> Iterator[List[Dict[str, Any]]]:
+    """按 ID 顺序分块读取 (since, until] 范围内的报告（正文在读取时解压）"""
+    chunk_size = chunk_size or config.EXPORT_CHUNK_SIZE
+    until = until if until is not None else export_watermark(database, "reports")
+    sql = '''
+        SELECT r.id, r.patient_id, p.external_id, r.report_type, r.created_at,
+               report_text(r.report_content, r.compression)
+        FROM reports r
+        LEFT JOIN patients p ON p.id = r.patient_id
+        WHERE {where}
+    '''
+    for rows in _iter_pages(database, sql, since, until, chunk_size, alias="r."):
+        yield [
+            {
+                "report_id": report_id,
+                "id": patient_id,
+                "patient_id": external_id or (f"P{patient_id:04d}" if patient_id is not None else None),
+                "report_type": report_type,
+                "created_at": created_at,
+                "report_content": content
+            }
+            for report_id, patient_id, external_id, report_type, created_at, content in rows
+        ]
+
+
+# ---------- 编码 ----------
+
+def encode_ndjson(columns: List[Tuple[str, str]], chunks: Iterable[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    for records in chunks:
+        yield "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+
+
+def encode_csv(columns: List[Tuple[str, str]], chunks: Iterable[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=[name for name, _ in columns])
+    writer.writeheader()
+    for records in chunks:
+        writer.writerows(records)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """ParquetWriter / ZipFile 的输出目标：写入的字节暂存，由生成器逐块取走"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def encode_parquet(columns: List[Tuple[str, str]], chunks: Iterable[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    """每块写成一个行组，写完即输出"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"int": pa.int64(), "float": pa.float64(), "string": pa.string()}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for records in chunks:
+            writer.write_table(pa.Table.from_pylist(records, schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {
+    "ndjson": encode_ndjson,
+    "csv": encode_csv,
+    "parquet": encode_parquet,
+}
+
+
+_UNSAFE_NAME_CHARS = re.compile(r'[\x00-\x1f/\\:*?"<>|]')
+
+
+def safe_filename(name: str, default: str = "file") -> str:
+    """
+    把任意文本（如病人姓名）转换为安全的文件名：路径分隔符、NUL 等控制字符和 Windows 不允许的字符
+    替换为 "_"，去掉开头的点，避免 "张三/../x" 这类名字在 ZIP 或下载文件名中构成路径
+    """
+    name = _UNSAFE_NAME_CHARS.sub("_", name).lstrip(". ").strip()
+    return name or default
+
+
+def _zip_entry_name(name: str) -> str:
+    """ZIP 条目名只保留安全的相对路径（去掉绝对路径和 . / .. 部分）"""
+    parts = [safe_filename(part) for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return "/".join(parts) or "file"
+
+
+async def encode_zip(files: AsyncIterable[Tuple[str, bytes]]) -> AsyncIterator[bytes]:
+    """
+    把 (文件名, 内容) 逐个写入 ZIP，每写完一个文件即输出
+
+    输出流不可回退，ZipFile 会在每个文件后写数据描述符记录大小；内存中只保留当前文件。
+    PDF 本身已压缩，文件以 ZIP_STORED 方式存储。文件名中的路径成分会被清理，解压时不会写到目标目录之外。
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        async for name, data in files:
+            archive.writestr(_zip_entry_name(name), data)
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,124 @@
+"""
+数据库访问层 - 病人/报告库的 SQLite 连接池
+
+- 连接复用，避免每次请求重新打开数据库和编译 SQL（每个连接缓存已编译的语句）
+- WAL 日志模式：读不阻塞写、写不阻塞读
+- synchronous=NORMAL、mmap、页缓存、busy_timeout 等参数统一配置
+- transaction() 以 BEGIN IMMEDIATE 开启写事务，多条写入要么全部成功要么全部回滚
+"""
+
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional, Sequence
+
+from config import config
+
+
+class Database:
+    """带连接池的 SQLite 数据库"""
+
+    def __init__(self, db_path: str = None, pool_size: int = None):
+        self.db_path = db_path or config.REPORTS_DB_PATH
+        self.pool_size = pool_size or config.DB_POOL_SIZE
+
+        self._pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._connection_hooks: List[Callable[[sqlite3.Connection], None]] = []
+
+    def add_connection_hook(self, hook: Callable[[sqlite3.Connection], None]):
+        """注册新建连接时执行的回调（如注册自定义 SQL 函数）；已有的空闲连接会被关闭后按需重建"""
+        self._connection_hooks.append(hook)
+        self.close()
+
+    def _create_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=config.DB_BUSY_TIMEOUT,
+            check_same_thread=False,  # 连接由连接池在线程间传递，同一时刻只被一个线程使用
+            isolation_level=None,  # 自动提交，写事务由 transaction() 显式开启
+            cached_statements=config.DB_STATEMENT_CACHE_SIZE
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT * 1000)}')
+        conn.execute(f'PRAGMA cache_size = -{int(config.DB_CACHE_SIZE_KB)}')
+        conn.execute(f'PRAGMA mmap_size = {int(config.DB_MMAP_SIZE)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        for hook in self._connection_hooks:
+            hook(conn)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                try:
+                    return self._create_connection()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._pool.get(timeout=config.DB_BUSY_TIMEOUT)
+
+    def _release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 连接已不可用，丢弃后由连接池按需重建
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._pool.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """借出一个连接（自动提交模式，适合只读查询）"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务：成功时提交，异常时回滚"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    def query_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def query_all(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def close(self):
+        """关闭所有空闲连接（应用关闭时调用）"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+# 创建全局数据库实例
+db = Database()
@@ -0,0 +1,18 @@
+"""
+科研数据集的字段约定 - 批量导入（patient_import）与科研数据处理（research.data_engineering）共用
+
+本模块不依赖配置、数据库或第三方库，离线的科研代码可以直接导入
+"""
+
+from typing import List
+
+# 必需字段
+REQUIRED_FIELDS = [
+    'patient_id', 'age', 'sex', 'chief_complaint',
+    'ALT', 'AST', 'AFP', 'imaging_result'
+]
+
+
+def missing_required_fields(columns: List[str]) -> List[str]:
+    """返回 columns 中缺少的必需字段"""
+    return [field for field in REQUIRED_FIELDS if field not in columns]
@@ -0,0 +1,194 @@
+"""
+证据包紧凑编码 - 以更少的 token 把证据包嵌入科研报告 Prompt
+
+与 json.dumps(indent=2) 相比：
+- 去掉空值（None、空字符串、空列表/字典）和元数据字段（时间戳等）
+- 浮点数按指定精度取整
+- 嵌套字典展平为 a.b.c=值
+- 字段相同的字典列表输出为表格：name(col1,col2): v1,v2; v1,v2
+- 每个顶层分组一行，字段之间用 " | " 分隔
+"""
+
+import json
+import math
+from typing import Any, Dict, Iterable, List, Tuple
+
+DEFAULT_DROP_KEYS = ("timestamp", "evidence_version")
+
+
+def _is_empty(value: Any) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    return isinstance(value, (str, list, tuple, dict)) and len(value) == 0
+
+
+def _format_scalar(value: Any, precision: int) -> str:
+    if hasattr(value, "item") and not isinstance(value, (list, dict, str)):
+        value = value.item()  # numpy 标量
+    if isinstance(value, bool):
+        return "是" if value else "否"
+    if isinstance(value, float):
+        text = f"{round(value, precision):.{precision}f}".rstrip("0").rstrip(".")
+        return text if text not in ("", "-0") else "0"
+    return str(value).replace("\n", " ").strip()
+
+
+def _flatten(data: Dict[str, Any], prefix: str, precision: int,
+             drop_keys: Tuple[str, ...]) -> Tuple[List[str], List[str]]:
+    """展平字典，返回 (键值对列表, 表格行列表)"""
+    pairs, tables = [], []
+    for key, value in data.items():
+        if key in drop_keys or _is_empty(value):
+            continue
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            sub_pairs, sub_tables = _flatten(value, f"{path}.", precision, drop_keys)
+            pairs.extend(sub_pairs)
+            tables.extend(sub_tables)
+        elif isinstance(value, (list, tuple)):
+            table = _encode_list(path, value, precision, drop_keys)
+            if table is not None:
+                (tables if table.startswith(f"{path}(") else pairs).append(table)
+        else:
+            pairs.append(f"{path}={_format_scalar(value, precision)}")
+    return pairs, tables
+
+
+def _encode_list(path: str, items: Iterable[Any], precision: int,
+                 drop_keys: Tuple[str, ...]):
+    items = [item for item in items if not _is_empty(item)]
+    if not items:
+        return None
+    if all(isinstance(item, dict) for item in items):
+        columns = []
+        for item in items:
+            for key, value in item.items():
+                if key not in columns and key not in drop_keys and not isinstance(value, (dict, list)):
+                    columns.append(key)
+        rows = [
+            ",".join("" if _is_empty(item.get(c)) else _format_scalar(item.get(c), precision) for c in columns)
+            for item in items
+        ]
+        return f"{path}({','.join(columns)}): " + "; ".join(rows)
+    if any(isinstance(item, (dict, list)) for item in items):
+        return f"{path}=" + json.dumps(items, ensure_ascii=False, separators=(",", ":"), default=str)
+    return f"{path}=" + "；".join(_format_scalar(item, precision) for item in items)
+
+
+def encode_evidence(evidence: Dict[str, Any], precision: int = 3,
+                    drop_keys: Iterable[str] = DEFAULT_DROP_KEYS) -> str:
+    """
+    将证据包编码为紧凑的文本表示
+
+    Args:
+        evidence: 证据包字典
+        precision: 浮点数保留的小数位数
+        drop_keys: 需要忽略的字段名（任意层级）
+
+    Returns:
+        每个顶层分组一行（字典列表单独成行）的文本
+    """
+    drop_keys = tuple(drop_keys)
+    lines = []
+    top_pairs = []
+    for key, value in evidence.items():
+        if key in drop_keys or _is_empty(value):
+            continue
+        if isinstance(value, dict):
+            pairs, tables = _flatten(value, "", precision, drop_keys)
+            if pairs:
+                lines.append(f"[{key}] " + " | ".join(pairs))
+            lines.extend(f"[{key}] {table}" for table in tables)
+        elif isinstance(value, (list, tuple)):
+            encoded = _encode_list(key, value, precision, drop_keys)
+            if encoded is not None:
+                lines.append(encoded)
+        else:
+            top_pairs.append(f"{key}={_format_scalar(value, precision)}")
+    if top_pairs:
+        lines.insert(0, " | ".join(top_pairs))
+    return "\n".join(lines)
+
+
+def benchmark_prompt_size(evidence: Dict[str, Any]) -> Dict[str, Any]:
+    """对比 json.dumps(indent=2) 与紧凑编码的字符数和估算 token 数"""
+    from chat_history import estimate_tokens
+
+    baseline = json.dumps(evidence, ensure_ascii=False, indent=2, default=str)
+    compact = encode_evidence(evidence)
+    baseline_tokens, compact_tokens = estimate_tokens(baseline), estimate_tokens(compact)
+    return {
+        "baseline_chars": len(baseline),
+        "compact_chars": len(compact),
+        "baseline_tokens": baseline_tokens,
+        "compact_tokens": compact_tokens,
+        "token_reduction": round(1 - compact_tokens / baseline_tokens, 4) if baseline_tokens else 0.0
+    }
+
+
+def _sample_evidence() -> Dict[str, Any]:
+    """与 /research/generate_evidence_bundle 结构一致的示例证据包（含可解释性和不确定性字段）"""
+    return {
+        "patient_info": {
+            "age": 55, "sex": "男", "chief_complaint": "右上腹疼痛3周，伴食欲减退",
+            "key_labs": {"ALT": 56, "AST": 62, "AFP": 420, "CA19-9": None},
+            "imaging": "CT提示肝右叶占位，大小约3.5cm，边界不清"
+        },
+        "diagnostic_prediction": {
+            "prediction": "阳性", "probability": 0.8712345, "confidence_level": "高",
+            "top_contributing_factors": [
+                {"feature": "AFP", "importance": 0.351234},
+                {"feature": "tumor_size_cm", "importance": 0.221987},
+                {"feature": "age", "importance": 0.181111}
+            ],
+            "model_performance": {"auc_score": 0.8934, "model_type": "XGBoost"}
+        },
+        "survival_prediction": {
+            "median_survival_months": 36.5,
+            "survival_probabilities": {"1_year": 0.8512, "2_year": 0.6823, "3_year": 0.5231, "5_year": 0.3102},
+            "risk_group": "中高危", "risk_score": 1.234567,
+            "model_performance": {"c_index": 0.7212, "model_type": "Cox回归"}
+        },
+        "recurrence_prediction": {
+            "recurrence_risk": "高风险", "recurrence_probability_2yr": 0.4234,
+            "risk_factors": ["AFP显著升高(>400)", "肿瘤直径>3cm", "影像提示边界不清"]
+        },
+        "explainability": {
+            "top_features": [
+                {"feature": f"feature_{i}", "shap_value": 0.1 / (i + 1), "direction": "正向"} for i in range(10)
+            ],
+            "explanation_summary": "AFP 和肿瘤大小是主要驱动因素"
+        },
+        "uncertainty": {
+            "data_quality_score": 0.912345, "missing_features": [],
+            "confidence_interval": {"lower": 0.8123456, "upper": 0.9234567}
+        },
+        "clinical_recommendations": {
+            "immediate_actions": ["建议完善增强MRI进一步评估", "建议肝胆外科专科会诊"],
+            "additional_tests": ["乙肝病毒标志物检查", "肝储备功能评估", "胸部CT排除远处转移"]
+        },
+        "timestamp": "2024-01-01T00:00:00",
+        "evidence_version": "1.0"
+    }
+
+
+# 基准测试：python evidence_encoder.py [证据包.json]
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf-8") as f:
+            sample = json.load(f)
+    else:
+        sample = _sample_evidence()
+
+    result = benchmark_prompt_size(sample)
+    print("📏 证据包编码对比（json.dumps(indent=2) vs 紧凑编码）")
+    print("=" * 50)
+    print(f"字符数: {result['baseline_chars']} -> {result['compact_chars']}")
+    print(f"估算 token: {result['baseline_tokens']} -> {result['compact_tokens']}")
+    print(f"token 减少: {result['token_reduction']:.1%}")
+    print("\n紧凑编码结果:")
+    print(encode_evidence(sample))
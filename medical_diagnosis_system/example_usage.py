@@ -68,6 +68,42 @@ def generate_report_example():
         print(f"❌ 请求失败: {e}")
         return None
 
+def generate_reports_batch_example(patients):
+    """批量生成报告示例（逐行读取 NDJSON 结果）"""
+    print("\n📦 批量生成诊疗报告示例")
+    print("-" * 50)
+    
+    try:
+        response = requests.post(
+            f"{API_BASE_URL}/generate_reports/batch",
+            json={
+                "patients": patients,
+                "report_type": "comprehensive",
+                "stream": True
+            },
+            stream=True,
+            timeout=(10, 600)
+        )
+        
+        if response.status_code != 200:
+            print(f"❌ 批量生成失败: {response.status_code}")
+            print(response.text)
+            return []
+        
+        results = []
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            item = json.loads(line)
+            results.append(item)
+            status = "✅" if item.get("success") else "❌"
+            print(f"{status} [{item['index']}] {item['name']} (病人ID: {item['patient_id']})")
+        return results
+        
+    except requests.exceptions.RequestException as e:
+        print(f"❌ 请求失败: {e}")
+        return []
+
 def get_patients_example():
     """获取病人列表示例"""
     print("\n📚 获取病人列表示例")
@@ -0,0 +1,374 @@
+"""
+后台任务队列 - 长耗时的报告生成改为提交任务、异步执行、按任务 ID 查询
+
+- 任务持久化在 SQLite 中，提交后立即返回任务 ID
+- 进程内工作协程池按优先级、提交时间领取任务并执行
+- 执行中的任务持有租约并定期续期；进程崩溃后租约过期的任务会被重新放回队列
+- 可重试的失败按指数退避延后重新执行
+- 相同幂等键的重复提交返回已有任务，客户端重试不会重复创建病人
+- 执行进度写入数据库，同时推送给 SSE 订阅者
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+
+from config import config
+from database import Database
+from migrations import apply_migrations
+from rate_limiter import backoff_delay
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+FINISHED_STATUSES = (JOB_SUCCEEDED, JOB_FAILED)
+
+_JSON_FIELDS = ("payload", "state", "result")
+
+
+class Job:
+    """执行中的任务，提供给任务处理函数"""
+
+    def __init__(self, queue: "JobQueue", row: Dict[str, Any]):
+        self.queue = queue
+        self.id = row["id"]
+        self.job_type = row["job_type"]
+        self.payload = row["payload"] or {}
+        self.state = row["state"] or {}  # 检查点，任务被重新执行时可据此跳过已完成的步骤
+        self.attempts = row["attempts"]
+
+    async def checkpoint(self, **state):
+        """持久化检查点数据"""
+        self.state.update(state)
+        await asyncio.to_thread(self.queue._update, self.id, state=self.state)
+
+    async def progress(self, stage: str, percent: Optional[float] = None):
+        """更新执行阶段（写入数据库并通知订阅者）"""
+        fields = {"stage": stage}
+        if percent is not None:
+            fields["progress"] = round(float(percent), 3)
+        await asyncio.to_thread(self.queue._update, self.id, **fields)
+        self.queue._publish(self.id, {"stage": stage, **fields})
+
+    def publish(self, event: Dict[str, Any]):
+        """推送不需要持久化的实时事件（如生成中的文本片段）"""
+        self.queue._publish(self.id, event)
+
+
+JobHandler = Callable[[Job], Awaitable[Dict[str, Any]]]
+
+
+class JobQueue:
+    """基于 SQLite 的持久化任务队列"""
+
+    def __init__(self, db_path: str = None, workers: int = None, lease_seconds: float = None,
+                 max_attempts: int = None, poll_interval: float = None):
+        self.db_path = db_path or config.JOB_DB_PATH
+        self.workers = workers or config.JOB_WORKERS
+        self.lease_seconds = lease_seconds or config.JOB_LEASE_SECONDS
+        self.max_attempts = max_attempts or config.JOB_MAX_ATTEMPTS
+        self.poll_interval = poll_interval or config.JOB_POLL_INTERVAL
+        self.worker_id = uuid.uuid4().hex[:12]
+
+        self._handlers: Dict[str, JobHandler] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    # ---------- 存储 ----------
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialized:
+            # jobs 表由迁移创建（见 migrations.py），任务库与病人库分开时同样执行全部迁移
+            database = Database(self.db_path, pool_size=1)
+            try:
+                apply_migrations(database)
+            finally:
+                database.close()
+            self._initialized = True
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        for field in _JSON_FIELDS:
+            job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    def _update(self, job_id: str, **fields):
+        for field in _JSON_FIELDS:
+            if field in fields:
+                fields[field] = json.dumps(fields[field], ensure_ascii=False)
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _insert(self, job_type: str, payload: Dict[str, Any], priority: int,
+                idempotency_key: Optional[str]) -> Dict[str, Any]:
+        with self._lock:
+            conn = self._connect()
+            try:
+                job_id = uuid.uuid4().hex
+                # 幂等键冲突时由数据库保证只插入一次（多个进程共用同一个库时进程内的锁不够用）
+                conn.execute('''
+                    INSERT INTO jobs (id, job_type, status, priority, payload, idempotency_key, stage, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(idempotency_key) DO NOTHING
+                ''', (job_id, job_type, JOB_QUEUED, priority, json.dumps(payload, ensure_ascii=False),
+                      idempotency_key, JOB_QUEUED, time.time()))
+                conn.commit()
+                if idempotency_key:
+                    row = conn.execute('SELECT * FROM jobs WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+                else:
+                    row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                return self._row_to_dict(row)
+            finally:
+                conn.close()
+
+    def _insert_many(self, job_type: str, payloads: List[Dict[str, Any]], priority: int) -> List[str]:
+        now = time.time()
+        rows = [
+            (uuid.uuid4().hex, job_type, JOB_QUEUED, priority, json.dumps(payload, ensure_ascii=False), JOB_QUEUED, now)
+            for payload in payloads
+        ]
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.executemany('''
+                    INSERT INTO jobs (id, job_type, status, priority, payload, stage, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                conn.commit()
+            finally:
+                conn.close()
+        return [row[0] for row in rows]
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """领取一个待执行任务（原子地标记为 running 并设置租约），跳过退避时间未到的任务"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute('''
+                    UPDATE jobs
+                    SET status = ?, worker_id = ?, lease_until = ?, attempts = attempts + 1,
+                        started_at = COALESCE(started_at, ?), stage = 'running'
+                    WHERE id = (
+                        SELECT id FROM jobs WHERE status = ? AND (available_at IS NULL OR available_at <= ?)
+                        ORDER BY priority, created_at LIMIT 1
+                    ) AND status = ?
+                    RETURNING *
+                ''', (JOB_RUNNING, self.worker_id, now + self.lease_seconds, now,
+                      JOB_QUEUED, now, JOB_QUEUED)).fetchone()
+                conn.commit()
+                return self._row_to_dict(row) if row else None
+            finally:
+                conn.close()
+
+    def _renew_lease(self, job_id: str):
+        self._update(job_id, lease_until=time.time() + self.lease_seconds)
+
+    def _recover_expired(self) -> int:
+        """把租约过期的 running 任务放回队列，超过最大尝试次数的标记为失败"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute('''
+                    UPDATE jobs SET status = ?, finished_at = ?, stage = ?,
+                        error = '任务执行进程异常退出，已达到最大重试次数'
+                    WHERE status = ? AND lease_until < ? AND attempts >= ?
+                ''', (JOB_FAILED, now, JOB_FAILED, JOB_RUNNING, now, self.max_attempts))
+                requeued = conn.execute('''
+                    UPDATE jobs SET status = ?, worker_id = NULL, lease_until = NULL, stage = ?
+                    WHERE status = ? AND lease_until < ?
+                ''', (JOB_QUEUED, JOB_QUEUED, JOB_RUNNING, now)).rowcount
+                conn.commit()
+                return requeued
+            finally:
+                conn.close()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """查询任务"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                return self._row_to_dict(row) if row else None
+            finally:
+                conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        """各状态的任务数"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                rows = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+                return {status: count for status, count in rows}
+            finally:
+                conn.close()
+
+    # ---------- 提交与执行 ----------
+
+    def register(self, job_type: str, handler: JobHandler):
+        """注册任务处理函数：async handler(job) -> result dict"""
+        self._handlers[job_type] = handler
+
+    async def submit(self, job_type: str, payload: Dict[str, Any], priority: int = 1,
+                     idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """提交任务并立即返回任务记录；幂等键已存在时返回已有任务"""
+        if job_type not in self._handlers:
+            raise ValueError(f"未注册的任务类型: {job_type}")
+        job = await asyncio.to_thread(self._insert, job_type, payload, priority, idempotency_key)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def submit_many(self, job_type: str, payloads: List[Dict[str, Any]],
+                          priority: int = 1) -> List[str]:
+        """批量提交任务（单个事务），返回任务 ID 列表"""
+        if job_type not in self._handlers:
+            raise ValueError(f"未注册的任务类型: {job_type}")
+        job_ids = await asyncio.to_thread(self._insert_many, job_type, payloads, priority)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_ids
+
+    async def start(self):
+        """启动工作协程（应用启动时调用）"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        await asyncio.to_thread(self._recover_expired)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """停止工作协程；未完成的任务保持 running，租约过期后由下次启动的进程接管"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            try:
+                row = await asyncio.to_thread(self._claim)
+            except Exception as e:
+                print(f"⚠️ 领取后台任务失败: {e}")
+                row = None
+
+            if row is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    await asyncio.to_thread(self._recover_expired)
+                continue
+
+            await self._run(Job(self, row))
+
+    async def _run(self, job: Job):
+        handler = self._handlers.get(job.job_type)
+        heartbeat = asyncio.ensure_future(self._heartbeat(job.id))
+        self._publish(job.id, {"status": JOB_RUNNING, "attempts": job.attempts})
+        try:
+            if handler is None:
+                raise ValueError(f"未注册的任务类型: {job.job_type}")
+            result = await handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            retry = job.attempts < self.max_attempts and getattr(e, "retryable", False)
+            status = JOB_QUEUED if retry else JOB_FAILED
+            # 可重试的任务按指数退避延后领取，避免上游故障期间被立即反复执行
+            available_at = time.time() + backoff_delay(
+                job.attempts, base=config.JOB_RETRY_BASE_DELAY, cap=config.JOB_RETRY_MAX_DELAY
+            ) if retry else None
+            await asyncio.to_thread(
+                self._update, job.id, status=status, stage=status, error=str(e), lease_until=None,
+                available_at=available_at, finished_at=None if retry else time.time()
+            )
+            self._publish(job.id, {"status": status, "error": str(e)})
+        else:
+            await asyncio.to_thread(
+                self._update, job.id, status=JOB_SUCCEEDED, stage=JOB_SUCCEEDED, progress=1.0,
+                result=result, error=None, lease_until=None, finished_at=time.time()
+            )
+            self._publish(job.id, {"status": JOB_SUCCEEDED})
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self._renew_lease, job_id)
+            except Exception as e:
+                print(f"⚠️ 后台任务续租失败: {e}")
+
+    # ---------- 进度订阅 ----------
+
+    def _publish(self, job_id: str, event: Dict[str, Any]):
+        for queue in self._subscribers.get(job_id, ()):
+            queue.put_nowait(event)
+
+    async def watch(self, job_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        订阅任务进度：先产出当前任务记录，之后产出实时事件，任务结束时产出最终记录
+
+        任务在其他进程执行时收不到实时事件，此时按轮询间隔重新读取任务状态。
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        try:
+            job = await asyncio.to_thread(self.get, job_id)
+            if job is None:
+                return
+            yield {"event": "job", "data": job}
+            last_seen = (job["status"], job["stage"], job["progress"])
+            while job["status"] not in FINISHED_STATUSES:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    event = None
+                if event is not None and "status" not in event:
+                    yield {"event": "progress", "data": event}
+                    continue
+                job = await asyncio.to_thread(self.get, job_id)
+                if job is None:
+                    return
+                current = (job["status"], job["stage"], job["progress"])
+                if current != last_seen and job["status"] not in FINISHED_STATUSES:
+                    yield {"event": "job", "data": job}
+                last_seen = current
+            yield {"event": "done" if job["status"] == JOB_SUCCEEDED else "error", "data": job}
+        finally:
+            subscribers = self._subscribers.get(job_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[job_id]
+
+
+class RetryableJobError(Exception):
+    """可重试的任务错误（如上游暂时不可用），任务会被放回队列"""
+
+    retryable = True
+
+
+# 创建全局任务队列实例
+job_queue = JobQueue()
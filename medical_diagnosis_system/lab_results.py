@@ -0,0 +1,227 @@
+"""
+检验结果明细表 - 把 patients.labs 中的 JSON 拆成 lab_results 行，支持按指标范围筛选队列
+
+- lab_results 由应用在写入病人的同一事务中维护（write_lab_results），表结构不依赖自定义函数，
+  其他进程和 sqlite3 命令行可照常写入 patients；删除病人时由纯 SQL 触发器同步删除
+- 升级前已有的病人和其他进程写入的病人在启动时由 sync_lab_results 补建检验结果明细
+- 指标值统一解析为数字：56、"420 ng/mL"、{"value": 420, "unit": "ng/mL"} 都能识别，
+  "阴性" 等无法转为数字的结果 value 为 NULL，原文保存在 raw_value
+- (test_name, value) 上建索引，"AFP > 400" 这类条件只扫描索引中的一段
+"""
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from database import Database
+
+# 只有数值、没有单位时使用的默认单位（与 PDF 报告中的参考范围一致）
+DEFAULT_UNITS = {
+    "ALT": "U/L",
+    "AST": "U/L",
+    "ALP": "U/L",
+    "总胆红素": "μmol/L",
+    "直接胆红素": "μmol/L",
+    "白蛋白": "g/L",
+    "AFP": "ng/mL",
+    "CA19-9": "U/mL",
+    "CEA": "ng/mL",
+}
+
+_NUMBER_WITH_UNIT = re.compile(r"^\s*([-+]?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)\s*(.*?)\s*$")
+
+
+def parse_number(value: Any) -> Optional[float]:
+    """把 56、"420 ng/mL" 这样的检验结果转换为数字，无法转换时返回 None"""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUMBER_WITH_UNIT.match(str(value))
+    return float(match.group(1)) if match else None
+
+
+def parse_lab_value(test_name: str, value: Any, json_type: str) -> Tuple[Optional[float], Optional[str]]:
+    """
+    解析一项检验结果
+
+    Args:
+        test_name: 指标名
+        value: 检验结果（对象为 JSON 文本）
+        json_type: 值的类型，对象为 "object"
+
+    Returns:
+        (数值, 单位)，无法解析为数字时数值为 None
+    """
+    unit = None
+    if json_type == "object":
+        try:
+            obj = json.loads(value)
+        except (TypeError, ValueError):
+            return None, None
+        value, unit = obj.get("value"), obj.get("unit")
+    number = parse_number(value)
+    if number is None:
+        return None, unit
+    if isinstance(value, str):
+        unit = unit or _NUMBER_WITH_UNIT.match(value).group(2)
+    return number, unit or DEFAULT_UNITS.get(test_name)
+
+
+def _json_text(value: Any) -> str:
+    """检验结果原文（对象和数组保存为紧凑的 JSON）"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+
+def lab_rows(patient_id: int, labs: Any) -> List[tuple]:
+    """
+    把 patients.labs（JSON 文本或字典）拆成 lab_results 行
+
+    Returns:
+        [(patient_id, test_name, value, unit, raw_value), ...]；labs 不是 JSON 对象时为空列表
+    """
+    if isinstance(labs, str):
+        try:
+            labs = json.loads(labs)
+        except ValueError:
+            return []
+    if not isinstance(labs, dict):
+        return []
+    rows = []
+    for test_name, value in labs.items():
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            number, unit = parse_lab_value(test_name, json.dumps(value), "object")
+        else:
+            number, unit = parse_lab_value(test_name, value, "text" if isinstance(value, str) else "number")
+        rows.append((patient_id, test_name, number, unit, _json_text(value)))
+    return rows
+
+
+INSERT_LAB_RESULTS_SQL = '''
+    INSERT OR REPLACE INTO lab_results (patient_id, test_name, value, unit, raw_value)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+
+def write_lab_results(conn, patients: List[Tuple[int, Any]]):
+    """
+    写入新病人的检验结果明细（与写入病人在同一事务中调用）
+
+    Args:
+        conn: 当前事务的连接
+        patients: [(病人 ID, labs), ...]
+    """
+    conn.executemany(INSERT_LAB_RESULTS_SQL, [row for pid, labs in patients for row in lab_rows(pid, labs)])
+
+
+def sync_lab_results(database: Database, batch_size: int = 1000) -> int:
+    """为有检验结果但还没有明细的病人（如其他进程写入的病人）补建明细，返回补建的病人数"""
+    synced, last_id = 0, 0
+    while True:
+        with database.transaction() as conn:
+            rows = conn.execute('''
+                SELECT id, labs FROM patients p
+                WHERE id > ? AND labs IS NOT NULL AND labs NOT IN ('', '{}', 'null')
+                  AND NOT EXISTS (SELECT 1 FROM lab_results l WHERE l.patient_id = p.id)
+                ORDER BY id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            write_lab_results(conn, rows)
+        if not rows:
+            return synced
+        synced += len(rows)
+        last_id = rows[-1][0]
+
+
+def query_cohort(database: Database, filters: List[Dict[str, Any]], sex: Optional[str] = None,
+                 age_min: Optional[int] = None, age_max: Optional[int] = None,
+                 after: Optional[int] = None, limit: int = 100,
+                 include_total: bool = False) -> Dict[str, Any]:
+    """
+    按检验指标范围筛选病人
+
+    Args:
+        database: 数据库实例
+        filters: [{"test_name": "AFP", "min": 400, "max": None}, ...]，各条件需同时满足，
+            min / max 均为闭区间，都不传时只要求做过该项检查
+        sex / age_min / age_max: 人口学条件
+        after: 上一页最后一个病人 ID（按病人 ID 升序翻页）
+        limit: 每页条数
+        include_total: 是否统计符合条件的总人数
+
+    Returns:
+        {"patients": [...], "has_more": bool, "next_cursor": int 或 None, "total": int 或 None}
+    """
+    branches, params = [], []
+    for f in filters:
+        conditions = ["test_name = ?"]
+        params.append(f["test_name"])
+        if f.get("min") is not None:
+            conditions.append("value >= ?")
+            params.append(f["min"])
+        if f.get("max") is not None:
+            conditions.append("value <= ?")
+            params.append(f["max"])
+        branches.append(f"SELECT patient_id FROM lab_results WHERE {' AND '.join(conditions)}")
+
+    # 每个指标条件各走一次 (test_name, value) 索引，取病人 ID 交集
+    source = f"({' INTERSECT '.join(branches)}) c JOIN patients p ON p.id = c.patient_id" if branches else "patients p"
+    where, where_params = [], []
+    if sex:
+        where.append("p.sex = ?")
+        where_params.append(sex)
+    if age_min is not None:
+        where.append("p.age >= ?")
+        where_params.append(age_min)
+    if age_max is not None:
+        where.append("p.age <= ?")
+        where_params.append(age_max)
+
+    total = None
+    with database.connection() as conn:
+        if include_total:
+            where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+            total = conn.execute(
+                f"SELECT COUNT(*) FROM {source} {where_sql}", (*params, *where_params)
+            ).fetchone()[0]
+
+        page_where = list(where)
+        page_params = list(where_params)
+        if after is not None:
+            page_where.append("p.id > ?")
+            page_params.append(after)
+        where_sql = f"WHERE {' AND '.join(page_where)}" if page_where else ""
+        rows = conn.execute(f'''
+            SELECT p.id, p.name, p.age, p.sex, p.created_at
+            FROM {source}
+            {where_sql}
+            ORDER BY p.id
+            LIMIT ?
+        ''', (*params, *page_params, limit + 1)).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        labs: Dict[int, Dict[str, Any]] = {row[0]: {} for row in rows}
+        if rows:
+            placeholders = ",".join("?" * len(rows))
+            for patient_id, test_name, value, unit, raw_value in conn.execute(
+                f'SELECT patient_id, test_name, value, unit, raw_value FROM lab_results '
+                f'WHERE patient_id IN ({placeholders})', list(labs)
+            ):
+                labs[patient_id][test_name] = {"value": value if value is not None else raw_value, "unit": unit}
+
+    patients = [
+        {"id": pid, "name": name, "age": age, "sex": sex_, "created_at": created_at, "labs": labs[pid]}
+        for pid, name, age, sex_, created_at in rows
+    ]
+    return {
+        "patients": patients,
+        "has_more": has_more,
+        "next_cursor": patients[-1]["id"] if has_more else None,
+        "total": total
+    }
@@ -0,0 +1,171 @@
+"""
+大模型响应缓存 - 对确定性接口的相同输入复用已生成的回复
+
+缓存键为 (model, messages, temperature, max_tokens) 规范化后的 SHA-256，
+数据持久化在 SQLite 中，支持 TTL 过期、LRU 淘汰、条目数/容量上限和命中统计。
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from config import config
+
+
+def make_cache_key(model: str, messages: List[Dict[str, str]], temperature: float,
+                   max_tokens: int) -> str:
+    """生成规范化的缓存键"""
+    payload = json.dumps(
+        {
+            "model": model,
+            "messages": [{"role": m.get("role"), "content": m.get("content")} for m in messages],
+            "temperature": round(float(temperature), 4),
+            "max_tokens": int(max_tokens)
+        },
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """基于 SQLite 的大模型响应缓存"""
+
+    def __init__(self, db_path: str = None, ttl_seconds: int = None,
+                 max_entries: int = None, max_bytes: int = None):
+        self.db_path = db_path or config.LLM_CACHE_PATH
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else config.LLM_CACHE_TTL
+        self.max_entries = max_entries or config.LLM_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or config.LLM_CACHE_MAX_BYTES
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path)
+        if not self._initialized:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hit_count INTEGER DEFAULT 0
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)')
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，过期条目视为未命中并删除"""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    'SELECT response, created_at FROM llm_cache WHERE cache_key = ?', (key,)
+                ).fetchone()
+                if row and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                    conn.execute('DELETE FROM llm_cache WHERE cache_key = ?', (key,))
+                    conn.commit()
+                    self.evictions += 1
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute(
+                    'UPDATE llm_cache SET last_access = ?, hit_count = hit_count + 1 WHERE cache_key = ?',
+                    (now, key)
+                )
+                conn.commit()
+                self.hits += 1
+                return row[0]
+            finally:
+                conn.close()
+
+    def set(self, key: str, response: str):
+        """写入缓存，并在超出上限时按最近最少使用淘汰"""
+        if not response:
+            return
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute('''
+                    INSERT OR REPLACE INTO llm_cache (cache_key, response, size, created_at, last_access)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (key, response, size, now, now))
+                self._evict(conn, now)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """删除过期条目，再按 last_access 淘汰至上限以内"""
+        if self.ttl_seconds:
+            cursor = conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl_seconds,))
+            self.evictions += cursor.rowcount
+
+        count, total_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+
+        rows = conn.execute('SELECT cache_key, size FROM llm_cache ORDER BY last_access ASC').fetchall()
+        victims = []
+        for cache_key, size in rows:
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            victims.append((cache_key,))
+            count -= 1
+            total_bytes -= size
+        conn.executemany('DELETE FROM llm_cache WHERE cache_key = ?', victims)
+        self.evictions += len(victims)
+
+    def clear(self) -> int:
+        """清空缓存，返回删除的条目数"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                deleted = conn.execute('DELETE FROM llm_cache').rowcount
+                conn.commit()
+                return deleted
+            finally:
+                conn.close()
+
+    def stats(self) -> Dict:
+        """缓存统计信息"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                count, total_bytes = conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache'
+                ).fetchone()
+            finally:
+                conn.close()
+        lookups = self.hits + self.misses
+        return {
+            "entries": count,
+            "size_bytes": total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# 创建全局缓存实例
+llm_cache = LLMResponseCache()
@@ -0,0 +1,267 @@
+"""
+大模型异步网关 - 统一管理对通义千问（DashScope 兼容模式）的调用
+
+所有 FastAPI 接口通过本模块访问大模型，避免同步客户端阻塞事件循环：
+- 基于 AsyncOpenAI，进程内共享一个带连接池的 httpx.AsyncClient
+- 通过信号量限制同时在途的上游请求数
+- 每次调用可单独指定超时时间
+- 支持流式输出，逐段转发模型生成的文本
+- 确定性调用可启用持久化响应缓存（见 llm_cache.py）
+- 相同指纹的并发调用合并为一次上游请求（见 singleflight.py）
+- 上游请求经过令牌桶限流和优先队列，429/超时按抖动退避重试（见 rate_limiter.py）
+"""
+
+import asyncio
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+import metrics
+from chat_history import count_message_tokens
+from config import config
+from llm_cache import LLMResponseCache, llm_cache, make_cache_key
+from rate_limiter import (PRIORITY_DEFAULT, AdaptiveRateLimiter, UpstreamOverloadedError,
+                          backoff_delay)
+from singleflight import SingleFlight
+
+# 可重试的上游错误：限流、超时、连接失败、服务端 5xx
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class LLMGateway:
+    """异步大模型网关"""
+
+    def __init__(self, api_key: str, base_url: str = None, model: str = None,
+                 max_concurrency: int = None, timeout: float = None,
+                 cache: Optional[LLMResponseCache] = None,
+                 rate_limiter: Optional[AdaptiveRateLimiter] = None):
+        self.api_key = api_key
+        self.base_url = base_url or config.LLM_BASE_URL
+        self.model = model or config.LLM_MODEL
+        self.max_concurrency = max_concurrency or config.LLM_MAX_CONCURRENCY
+        self.timeout = timeout or config.LLM_TIMEOUT
+        self.cache = cache
+        self.single_flight = SingleFlight()
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._client: Optional[AsyncOpenAI] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """懒加载共享客户端，首次使用时创建连接池"""
+        if self._client is None:
+            self._http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=config.LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.LLM_MAX_KEEPALIVE
+                ),
+                timeout=httpx.Timeout(self.timeout, connect=config.LLM_CONNECT_TIMEOUT)
+            )
+            self._client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                http_client=self._http_client,
+                max_retries=0  # 重试由网关统一处理，见 _open_upstream()
+            )
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """并发闸门，限制同时在途的上游请求数"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def complete(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                       max_tokens: int = 2000, model: str = None,
+                       timeout: float = None, use_cache: bool = False,
+                       priority: int = PRIORITY_DEFAULT) -> str:
+        """
+        调用大模型并返回完整回复文本
+
+        Args:
+            messages: OpenAI 格式的消息列表
+            temperature: 采样温度
+            max_tokens: 最大生成 token 数
+            model: 模型名称，默认使用配置中的模型
+            timeout: 本次调用的超时时间（秒），默认使用网关超时
+            use_cache: 是否读写响应缓存，仅用于输入相同即可复用结果的接口
+            priority: 限流队列中的优先级（见 rate_limiter.PRIORITY_*）
+
+        Returns:
+            模型回复内容
+        """
+        model = model or self.model
+        fingerprint = make_cache_key(model, messages, temperature, max_tokens)
+        cached = await self._cache_get(fingerprint, use_cache)
+        if cached is not None:
+            return cached
+
+        async def call_upstream() -> str:
+            reserved = count_message_tokens(messages) + max_tokens
+            response, started = await self._open_upstream(
+                "complete", reserved, priority,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=timeout or self.timeout
+            )
+            self._finish_upstream("complete", started, "success")
+            self._record_usage(response.usage, reserved)
+            content = response.choices[0].message.content
+            if use_cache and self.cache is not None:
+                await asyncio.to_thread(self.cache.set, fingerprint, content)
+            return content
+
+        # 相同指纹的并发请求只调用一次上游
+        with metrics.phase("llm"):
+            return await self.single_flight.do(f"complete:{fingerprint}", call_upstream)
+
+    async def stream(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                     max_tokens: int = 2000, model: str = None,
+                     timeout: float = None, use_cache: bool = False,
+                     priority: int = PRIORITY_DEFAULT) -> AsyncIterator[str]:
+        """
+        以流式方式调用大模型，逐段产出新生成的文本
+
+        参数同 complete()。缓存命中时一次性产出完整文本；相同指纹的并发流共享
+        同一条上游流。所有调用方都停止迭代（如客户端断开）时关闭上游连接，且不写入缓存。
+        """
+        model = model or self.model
+        fingerprint = make_cache_key(model, messages, temperature, max_tokens)
+        cached = await self._cache_get(fingerprint, use_cache)
+        if cached is not None:
+            yield cached
+            return
+
+        async def stream_upstream() -> AsyncIterator[str]:
+            parts = []
+            reserved = count_message_tokens(messages) + max_tokens
+            response, started = await self._open_upstream(
+                "stream", reserved, priority,
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=timeout or self.timeout,
+                stream=True,
+                extra_body={"stream_options": {"include_usage": True}}
+            )
+            outcome = "error"
+            try:
+                async for chunk in response:
+                    self._record_usage(getattr(chunk, "usage", None), reserved)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+                outcome = "success"
+            finally:
+                await response.response.aclose()
+                self._finish_upstream("stream", started, outcome)
+
+            if use_cache and self.cache is not None:
+                await asyncio.to_thread(self.cache.set, fingerprint, "".join(parts))
+
+        async for delta in self.single_flight.stream(f"stream:{fingerprint}", stream_upstream):
+            yield delta
+
+    async def _cache_get(self, fingerprint: str, use_cache: bool) -> Optional[str]:
+        """查询响应缓存并记录命中情况"""
+        if not use_cache or self.cache is None:
+            return None
+        cached = await asyncio.to_thread(self.cache.get, fingerprint)
+        metrics.LLM_CACHE_LOOKUPS.inc(result="hit" if cached is not None else "miss")
+        return cached
+
+    async def _open_upstream(self, mode: str, reserved_tokens: int, priority: int,
+                             **request) -> Tuple[object, float]:
+        """
+        经限流队列和并发闸门后发起上游请求，可重试错误按带抖动的指数退避重试
+
+        成功返回时仍占用一个并发名额，调用方读取完响应后必须调用 _finish_upstream()。
+        多次 429 后仍失败时抛出 UpstreamOverloadedError。
+        """
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire(reserved_tokens, priority)
+            try:
+                await self.semaphore.acquire()
+            except BaseException:
+                # 等待并发名额时被取消，请求没有发出
+                self.rate_limiter.refund(reserved_tokens)
+                raise
+            metrics.LLM_IN_FLIGHT.inc()
+            started = time.perf_counter()
+            try:
+                return await self.client.chat.completions.create(**request), started
+            except RETRYABLE_ERRORS as e:
+                throttled = isinstance(e, openai.RateLimitError)
+                self._finish_upstream(mode, started, "throttled" if throttled else "error")
+                self.rate_limiter.release_unused(reserved_tokens, 0)
+                if throttled:
+                    self.rate_limiter.on_throttled()
+                if attempt >= config.LLM_MAX_RETRIES:
+                    if throttled:
+                        raise UpstreamOverloadedError("大模型服务限流，请稍后重试",
+                                                      self.rate_limiter.retry_after()) from e
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+                attempt += 1
+            except BaseException:
+                self._finish_upstream(mode, started, "error")
+                raise
+
+    def _finish_upstream(self, mode: str, started: float, outcome: str):
+        """释放并发名额并记录本次上游调用的耗时和结果"""
+        self.semaphore.release()
+        metrics.LLM_IN_FLIGHT.dec()
+        metrics.LLM_LATENCY.observe(time.perf_counter() - started, mode=mode)
+        metrics.LLM_REQUESTS.inc(mode=mode, outcome=outcome)
+        if outcome == "success":
+            self.rate_limiter.on_success()
+
+    def _record_usage(self, usage, reserved_tokens: int):
+        """记录 token 用量，并把多预留的 token 退还给限流器"""
+        if usage is None:
+            return
+        metrics.record_llm_usage(usage, config.LLM_PRICE_PER_1K_PROMPT, config.LLM_PRICE_PER_1K_COMPLETION)
+        total = usage.get("total_tokens") if isinstance(usage, dict) else getattr(usage, "total_tokens", None)
+        self.rate_limiter.release_unused(reserved_tokens, total)
+
+    async def aclose(self):
+        """关闭连接池（应用关闭时调用）"""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+            self._http_client = None
+
+
+# 创建全局网关实例
+llm_gateway = LLMGateway(
+    api_key=config.get_api_key("dashscope"),
+    cache=llm_cache if config.LLM_CACHE_ENABLED else None
+)
+
+metrics.registry.counter(
+    "llm_singleflight_coalesced_total", "被合并到在途请求的大模型调用次数",
+    callback=lambda: llm_gateway.single_flight.coalesced
+)
+metrics.registry.gauge(
+    "llm_queue_depth", "等待限流放行的大模型请求数",
+    callback=lambda: llm_gateway.rate_limiter.queue_depth
+)
+metrics.registry.gauge(
+    "llm_rate_scale", "自适应限流当前的放行速率系数（1 为配置速率）",
+    callback=lambda: llm_gateway.rate_limiter.scale
+)
@@ -1,15 +1,26 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, File, Header, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 import openai
-import sqlite3
+import asyncio
+import csv
+import inspect
+import io
 import json
-from datetime import datetime
+import re
+from datetime import datetime, timezone
 import os
 import requests
-from pdf_generator import generate_medical_report_pdf
+from pdf_service import pdf_service
+from pdf_cache import make_pdf_key, pdf_cache
+from singleflight import SingleFlight
 import socket
+from pathlib import Path
+from urllib.parse import quote
+import metrics
+from metrics import MetricsMiddleware, phase, timed_phase
 
 # 初始化 FastAPI 应用
 app = FastAPI(title="术前病情预测 & 中西医结合诊疗报告生成系统", version="1.0.0")
@@ -21,8 +32,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
 
+# 接口延迟、在途请求数统计与 Server-Timing 响应头
+app.add_middleware(MetricsMiddleware)
+
 # 配置 AI API - 从配置文件读取
 from config import config
 DASHSCOPE_API_KEY = config.get_api_key("dashscope")
@@ -53,12 +68,31 @@ def find_available_model_training_port(host="47.108.190.171", ports=None):
             return f"http://{host}:{port}"
     return None
 
-# 初始化阿里云通义千问客户端
-from openai import OpenAI
-dashscope_client = OpenAI(
-    api_key=DASHSCOPE_API_KEY,
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
+# 初始化阿里云通义千问异步网关（共享连接池，不阻塞事件循环）
+from llm_gateway import llm_gateway
+from llm_cache import llm_cache
+from rate_limiter import (PRIORITY_BATCH, PRIORITY_DEFAULT, PRIORITY_INTERACTIVE,
+                          UpstreamOverloadedError)
+from chat_history import ConversationHistoryManager
+from evidence_encoder import encode_evidence
+from database import db
+from async_db import adb
+from archive import (
+    archive_old_records, archive_stats, delete_all_archives, delete_archived_patient, load_archived_patient
+)
+from data_export import (
+    ENCODERS, EXPORT_FORMATS, REPORT_EXPORT_COLUMNS, encode_zip, export_watermark, iter_patient_records,
+    iter_report_records, parquet_available, patient_columns, safe_filename
 )
+from lab_results import query_cohort, sync_lab_results, write_lab_results
+from migrations import apply_migrations
+from report_store import report_codec
+from search import clear_patient_index, index_patients, search_records, sync_patient_index, unindex_patients
+from patient_import import ImportFormatError, import_patients, iter_csv_rows, iter_xlsx_rows
+from job_queue import FINISHED_STATUSES, Job, RetryableJobError, job_queue
+
+# 对话历史管理（按 token 预算压缩早期对话）
+chat_history_manager = ConversationHistoryManager(llm_gateway)
 
 # 保持原有OpenAI配置兼容性
 openai.api_key = OPENAI_API_KEY
@@ -78,22 +112,37 @@ class PatientInfo(BaseModel):
 class ReportRequest(BaseModel):
     patient: PatientInfo
     report_type: str = "comprehensive"  # comprehensive, western, tcm
+    stream: bool = False  # True 时以 SSE 流式返回
+    use_cache: bool = True  # False 时跳过响应缓存，强制重新生成
+
+# 批量报告生成请求模型
+class BatchReportRequest(BaseModel):
+    patients: List[PatientInfo]
+    report_type: str = "comprehensive"
+    max_concurrency: Optional[int] = None  # 并发上限，默认使用配置
+    rate_limit: Optional[float] = None  # 每秒最多发起的 LLM 请求数，默认使用配置
+    stream: bool = True  # True 时以 NDJSON 逐条返回完成结果
+    use_cache: bool = True
 
 # AI对话请求模型
 class ChatRequest(BaseModel):
     message: str
     conversation_history: list = []
+    stream: bool = False
 
 # AI整理报告请求模型
 class ReportOptimizeRequest(BaseModel):
     original_report: str
     optimize_type: str = "format"  # format, simplify, enhance, summary
+    stream: bool = False
+    use_cache: bool = True
 
 # 科研分析请求模型
 class ResearchAnalysisRequest(BaseModel):
     patient_data: dict
     analysis_type: str = "comprehensive"  # comprehensive, diagnostic, survival, recurrence
     include_tcm: bool = True
+    stream: bool = False
 
 # 批量数据分析请求模型
 class BatchAnalysisRequest(BaseModel):
@@ -101,65 +150,110 @@ class BatchAnalysisRequest(BaseModel):
     analysis_types: list = ["diagnostic", "survival", "recurrence"]
     output_format: str = "json"  # json, csv, excel
 
-# 数据库初始化
-def init_database():
-    conn = sqlite3.connect('medical_reports.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            age INTEGER NOT NULL,
-            sex TEXT NOT NULL,
-            chief_complaint TEXT NOT NULL,
-            history TEXT,
-            labs TEXT,
-            imaging TEXT,
-            additional_notes TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER,
-            report_content TEXT NOT NULL,
-            report_type TEXT DEFAULT 'comprehensive',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+# 队列筛选请求模型
+class LabFilter(BaseModel):
+    test_name: str  # 检验指标名，如 AFP
+    min: Optional[float] = None  # 闭区间下限
+    max: Optional[float] = None  # 闭区间上限
+
+class CohortQueryRequest(BaseModel):
+    filters: List[LabFilter] = []  # 各条件需同时满足
+    sex: Optional[str] = None
+    age_min: Optional[int] = None
+    age_max: Optional[int] = None
+    after: Optional[int] = None  # 上一页返回的 next_cursor
+    limit: int = config.COHORT_PAGE_SIZE
+    include_total: bool = False
+
+class PDFExportRequest(BaseModel):
+    patient_ids: List[int] = []  # 按病人 ID 导出
+    cohort: Optional[CohortQueryRequest] = None  # 或导出符合检验指标条件的全部病人（忽略 after / limit）
+
+# 常用 SQL（语句文本保持不变，以便复用连接上已编译的语句）
+INSERT_PATIENT_SQL = '''
+    INSERT INTO patients (name, age, sex, chief_complaint, history, labs, imaging, additional_notes)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+INSERT_REPORT_SQL = '''
+    INSERT INTO reports (patient_id, report_content, report_type, compression)
+    VALUES (?, ?, ?, ?)
+'''
+# 报告正文可能是压缩存储的，读取时用 report_text() 解压（列顺序与建表时一致）
+REPORT_COLUMNS = 'id, patient_id, report_text(report_content, compression) AS report_content, report_type, created_at'
+SELECT_PATIENT_SQL = 'SELECT * FROM patients WHERE id = ?'
+SELECT_REPORT_SQL = f'SELECT {REPORT_COLUMNS} FROM reports WHERE id = ?'
+SELECT_LATEST_REPORT_SQL = (
+    f'SELECT {REPORT_COLUMNS} FROM reports WHERE patient_id = ? ORDER BY created_at DESC, id DESC LIMIT 1'
+)
 
-# 保存病人信息到数据库
-def save_patient(patient: PatientInfo) -> int:
-    conn = sqlite3.connect('medical_reports.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO patients (name, age, sex, chief_complaint, history, labs, imaging, additional_notes)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+def patient_params(patient: PatientInfo) -> tuple:
+    return (
         patient.name, patient.age, patient.sex, patient.chief_complaint,
         patient.history, json.dumps(patient.labs), patient.imaging, patient.additional_notes
-    ))
-    patient_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    )
+
+# 数据库初始化（按版本执行结构迁移，见 migrations.py）
+def init_database():
+    apply_migrations(db)
+    report_codec.ensure_dictionary()
+
+def report_params(patient_id: int, report_content: str, report_type: str) -> tuple:
+    content, compression = report_codec.encode(report_content)
+    return patient_id, content, report_type, compression
+
+# 写入操作：在写线程的事务中执行（见 async_db.py），并发的小写入合并提交
+def insert_patient(conn, patient: PatientInfo) -> int:
+    params = patient_params(patient)
+    patient_id = conn.execute(INSERT_PATIENT_SQL, params).lastrowid
+    write_lab_results(conn, [(patient_id, params[5])])
+    # 主诉、既往史、影像为第 4、5、7 个参数
+    index_patients(conn, [(patient_id, params[3], params[4], params[6])])
+    return patient_id
+
+def insert_report(conn, patient_id: int, report_content: str, report_type: str) -> int:
+    report_id = conn.execute(INSERT_REPORT_SQL, report_params(patient_id, report_content, report_type)).lastrowid
+    report_codec.index_report(conn, report_id, report_content)
+    return report_id
+
+def insert_patients(conn, patients: List[PatientInfo]) -> List[int]:
+    return [insert_patient(conn, patient) for patient in patients]
+
+def insert_patient_with_report(conn, patient: PatientInfo, report_content: str, report_type: str) -> int:
+    patient_id = insert_patient(conn, patient)
+    insert_report(conn, patient_id, report_content, report_type)
     return patient_id
 
+# 保存病人信息到数据库
+async def save_patient(patient: PatientInfo) -> int:
+    with phase("db"):
+        return await adb.write(insert_patient, patient)
+
+# 批量保存病人信息（单个事务）
+async def save_patients(patients: List[PatientInfo]) -> List[int]:
+    with phase("db"):
+        return await adb.write(insert_patients, patients)
+
+# 新报告积累到一定数量后在后台用真实报告重新训练压缩字典
+def schedule_dictionary_training():
+    if report_codec.retrain_due():
+        start_background_task(asyncio.to_thread(report_codec.ensure_dictionary), "报告字典训练")
+
 # 保存报告到数据库
-def save_report(patient_id: int, report_content: str, report_type: str):
-    conn = sqlite3.connect('medical_reports.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO reports (patient_id, report_content, report_type)
-        VALUES (?, ?, ?)
-    ''', (patient_id, report_content, report_type))
-    conn.commit()
-    conn.close()
+async def save_report(patient_id: int, report_content: str, report_type: str) -> int:
+    with phase("db"):
+        report_id = await adb.write(insert_report, patient_id, report_content, report_type)
+    schedule_dictionary_training()
+    return report_id
+
+# 在一个事务中保存病人信息和报告
+async def save_patient_with_report(patient: PatientInfo, report_content: str, report_type: str) -> int:
+    with phase("db"):
+        patient_id = await adb.write(insert_patient_with_report, patient, report_content, report_type)
+    schedule_dictionary_training()
+    return patient_id
 
 # 生成中西医结合诊疗报告的 Prompt
+@timed_phase("prompt")
 def create_medical_prompt(patient: PatientInfo) -> str:
     return f"""
 你是一个经验丰富的肝胆外科医生，同时精通中医辨证论治理论。请根据以下病人信息生成一份完整的中西医结合术前诊疗报告。
@@ -226,38 +320,195 @@ def create_medical_prompt(patient: PatientInfo) -> str:
 4. 语言简洁明了，避免过度专业术语
 """
 
+# 按固定速率放行请求（rate 为每秒请求数，0 表示不限速）
+class RequestPacer:
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next_start - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_start = max(loop.time(), self._next_start) + self.interval
+
+# SSE 事件格式化
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+# 上游繁忙时返回 503，并告知客户端建议的重试间隔
+def upstream_overloaded(e: UpstreamOverloadedError) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+# 流式转发大模型输出
+def stream_llm_response(messages: list, temperature: float, max_tokens: int,
+                        on_complete, start_payload: Optional[dict] = None,
+                        on_error=None, use_cache: bool = False,
+                        priority: int = PRIORITY_DEFAULT) -> StreamingResponse:
+    """
+    以 SSE 形式转发大模型生成的文本
+
+    事件顺序：start（可选）→ 多个 delta → done（或 error）。
+    生成完成后调用 on_complete(full_text)（可以是协程函数），其返回值作为 done 事件的数据，
+    与对应接口的非流式 JSON 结构保持一致；生成失败或客户端在生成完成前断开时调用 on_error()
+    （可选，可以是协程函数）。
+    限流队列已满时在响应开始前抛出 UpstreamOverloadedError。
+    """
+    llm_gateway.rate_limiter.ensure_capacity()
+
+    async def cleanup():
+        if on_error is not None:
+            result = on_error()
+            if inspect.isawaitable(result):
+                await result
+
+    async def event_generator():
+        completing = False  # 已开始保存结果（或已在出错时清理），之后不再清理
+        try:
+            if start_payload is not None:
+                yield sse_event(start_payload, "start")
+            parts = []
+            async for delta in llm_gateway.stream(messages, temperature=temperature,
+                                                  max_tokens=max_tokens, use_cache=use_cache,
+                                                  priority=priority):
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+            completing = True
+            result = on_complete("".join(parts))
+            if inspect.isawaitable(result):
+                result = await result
+            yield sse_event(result, "done")
+        except Exception as e:
+            completing = True
+            await cleanup()
+            if isinstance(e, UpstreamOverloadedError):
+                yield sse_event({"success": False, "detail": str(e), "retry_after": e.retry_after}, "error")
+            else:
+                yield sse_event({"success": False, "detail": str(e)}, "error")
+        finally:
+            if not completing and on_error is not None:
+                # 客户端中途断开（GeneratorExit / CancelledError）：生成器内不能再等待，清理放到后台执行
+                start_background_task(cleanup(), "流式响应清理")
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.on_event("startup")
 async def startup_event():
     init_database()
+    await job_queue.start()
+    # 预热 PDF 渲染进程
+    await pdf_service.start()
+    # 补建其他进程写入的数据的索引/明细、分批压缩存量报告，在后台执行不阻塞启动
+    start_background_task(asyncio.to_thread(maintain_storage), "存储维护")
+    if config.ARCHIVE_INTERVAL_HOURS > 0:
+        start_background_task(archive_loop(), "定期归档")
+
+# 后台任务的引用（事件循环只持有弱引用，不保存的话任务可能在完成前被回收）
+background_tasks = set()
+
+def start_background_task(coro, name: str) -> asyncio.Task:
+    """启动后台任务，任务异常结束时打印错误，不会被静默丢弃"""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+def _background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"❌ 后台任务「{task.get_name()}」失败: {task.exception()!r}")
+
+def maintain_storage():
+    """启动时的存储维护：补建检验结果明细和全文索引，再压缩存量报告"""
+    labs = sync_lab_results(db)
+    patients = sync_patient_index(db)
+    indexed = report_codec.sync_index()
+    compressed = report_codec.compress_existing()
+    if labs or patients or indexed or compressed:
+        print(f"🗄️ 存储维护: 补建 {labs} 位病人的检验结果明细、{patients} 位病人和 {indexed} 份报告的全文索引，"
+              f"压缩 {compressed} 份报告")
+
+async def archive_loop():
+    """定期把不活跃的病人移入按月归档文件"""
+    while True:
+        try:
+            result = await asyncio.to_thread(archive_old_records, db)
+            if result["archived"]:
+                print(f"📦 已归档 {result['archived']} 位病人: {result['partitions']}")
+        except Exception as e:
+            print(f"⚠️ 归档失败: {e}")
+        await asyncio.sleep(config.ARCHIVE_INTERVAL_HOURS * 3600)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await job_queue.stop()
+    await llm_gateway.aclose()
+    await asyncio.to_thread(pdf_service.close)
+    adb.close()
+    db.close()
 
 @app.get("/")
 async def root():
     return {"message": "术前病情预测 & 中西医结合诊疗报告生成系统 API"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 文本格式的运行指标"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.post("/generate_report")
 async def generate_report(request: ReportRequest):
     try:
-        # 保存病人信息
-        patient_id = save_patient(request.patient)
-        
         # 创建医疗报告 Prompt
         prompt = create_medical_prompt(request.patient)
+        messages = [
+            {"role": "system", "content": "你是一个专业的医疗AI助手，专门生成中西医结合的诊疗报告。"},
+            {"role": "user", "content": prompt}
+        ]
+        
+        if request.stream:
+            # 流式接口的 start 事件需要带上 patient_id，病人先入库；生成失败时再删除，不留下没有报告的病人记录
+            llm_gateway.rate_limiter.ensure_capacity()
+            patient_id = await save_patient(request.patient)
+            
+            async def finish(report_content: str) -> dict:
+                await save_report(patient_id, report_content, request.report_type)
+                return {
+                    "success": True,
+                    "patient_id": patient_id,
+                    "report": report_content,
+                    "generated_at": datetime.now().isoformat()
+                }
+            
+            async def discard_patient():
+                await adb.write(delete_patient_rows, patient_id)
+            
+            return stream_llm_response(messages, 0.2, 3000, finish, {"patient_id": patient_id},
+                                       on_error=discard_patient, use_cache=request.use_cache)
         
         # 调用阿里云通义千问 API
-        response = dashscope_client.chat.completions.create(
-            model="qwen-plus",
-            messages=[
-                {"role": "system", "content": "你是一个专业的医疗AI助手，专门生成中西医结合的诊疗报告。"},
-                {"role": "user", "content": prompt}
-            ],
+        report_content = await llm_gateway.complete(
+            messages=messages,
             temperature=0.2,
-            max_tokens=3000
+            max_tokens=3000,
+            use_cache=request.use_cache
         )
         
-        report_content = response.choices[0].message.content
-        
-        # 保存报告
-        save_report(patient_id, report_content, request.report_type)
+        # 病人信息和报告在一个事务中入库，生成失败时不会留下没有报告的病人记录
+        patient_id = await save_patient_with_report(request.patient, report_content, request.report_type)
         
         return {
             "success": True,
@@ -266,57 +517,467 @@ async def generate_report(request: ReportRequest):
             "generated_at": datetime.now().isoformat()
         }
         
+    except UpstreamOverloadedError as e:
+        raise upstream_overloaded(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成报告时发生错误: {str(e)}")
 
+# 后台任务中为已入库的病人生成并保存报告
+async def generate_report_for_job(job: Job, patient: PatientInfo, patient_id: int, report_type: str,
+                                  use_cache: bool, priority: int = PRIORITY_DEFAULT) -> dict:
+    await job.progress("generating", 0.1)
+    messages = [
+        {"role": "system", "content": "你是一个专业的医疗AI助手，专门生成中西医结合的诊疗报告。"},
+        {"role": "user", "content": create_medical_prompt(patient)}
+    ]
+    parts = []
+    try:
+        async for delta in llm_gateway.stream(messages, temperature=0.2, max_tokens=3000,
+                                              use_cache=use_cache, priority=priority):
+            parts.append(delta)
+            job.publish({"delta": delta})
+    except UpstreamOverloadedError as e:
+        raise RetryableJobError(str(e)) from e
+    report_content = "".join(parts)
+    
+    await job.progress("saving", 0.95)
+    await save_report(patient_id, report_content, report_type)
+    return {
+        "success": True,
+        "patient_id": patient_id,
+        "report": report_content,
+        "generated_at": datetime.now().isoformat()
+    }
+
+# 后台报告生成任务：保存病人 → 生成报告 → 保存报告
+async def run_report_job(job: Job) -> dict:
+    request = ReportRequest(**job.payload)
+    
+    # 任务被重新执行时复用已保存的病人，避免重复入库
+    patient_id = job.state.get("patient_id")
+    if patient_id is None:
+        patient_id = await save_patient(request.patient)
+        await job.checkpoint(patient_id=patient_id)
+    
+    return await generate_report_for_job(job, request.patient, patient_id, request.report_type, request.use_cache)
+
+# 为已入库病人（如批量导入的历史病例）生成报告的后台任务
+async def run_patient_report_job(job: Job) -> dict:
+    patient_id = job.payload["patient_id"]
+    row = await adb.query_one(SELECT_PATIENT_SQL, (patient_id,))
+    if not row:
+        raise ValueError(f"病人 {patient_id} 不存在")
+    patient = PatientInfo(
+        name=row[1], age=row[2], sex=row[3], chief_complaint=row[4], history=row[5] or "",
+        labs=json.loads(row[6]) if row[6] else {}, imaging=row[7] or "", additional_notes=row[8] or ""
+    )
+    return await generate_report_for_job(job, patient, patient_id, job.payload.get("report_type", "comprehensive"),
+                                         job.payload.get("use_cache", True), PRIORITY_BATCH)
+
+job_queue.register("generate_report", run_report_job)
+job_queue.register("generate_patient_report", run_patient_report_job)
+
+# 任务状态响应
+def job_response(job: dict) -> dict:
+    response = {
+        "job_id": job["id"],
+        "job_type": job["job_type"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": job["progress"],
+        "attempts": job["attempts"],
+        "created_at": datetime.fromtimestamp(job["created_at"]).isoformat(),
+        "finished_at": datetime.fromtimestamp(job["finished_at"]).isoformat() if job["finished_at"] else None,
+        "status_url": f"/jobs/{job['id']}",
+        "events_url": f"/jobs/{job['id']}/events"
+    }
+    if job["status"] in FINISHED_STATUSES:
+        response["result"] = job["result"]
+        response["error"] = job["error"]
+    return response
+
+@app.post("/jobs/generate_report", status_code=202)
+async def submit_report_job(request: ReportRequest, idempotency_key: Optional[str] = Header(None)):
+    """提交后台报告生成任务，立即返回任务 ID；相同 Idempotency-Key 的重复提交返回已有任务"""
+    try:
+        job = await job_queue.submit("generate_report", request.model_dump(exclude={"stream"}),
+                                     idempotency_key=idempotency_key)
+        return job_response(job)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"提交报告任务时发生错误: {str(e)}")
+
+@app.get("/jobs/stats")
+async def get_job_stats():
+    """各状态的后台任务数"""
+    return {"success": True, "stats": await asyncio.to_thread(job_queue.stats)}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询后台任务状态，完成后包含结果"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job_response(job)
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    """以 SSE 推送任务进度：job（状态变化）、progress（阶段/生成片段）、done 或 error（最终结果）"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    
+    async def event_generator():
+        async for item in job_queue.watch(job_id):
+            data = job_response(item["data"]) if item["event"] != "progress" else item["data"]
+            yield sse_event(data, item["event"])
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/generate_reports/batch")
+async def generate_reports_batch(request: BatchReportRequest):
+    """批量生成诊疗报告：病人信息一次性入库，LLM 调用按并发上限和速率限制并行执行"""
+    if not request.patients:
+        raise HTTPException(status_code=400, detail="病人列表不能为空")
+    if len(request.patients) > config.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多提交 {config.BATCH_MAX_ITEMS} 个病人")
+    
+    try:
+        patient_ids = await save_patients(request.patients)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量保存病人信息时发生错误: {str(e)}")
+    
+    concurrency = min(request.max_concurrency or config.BATCH_MAX_CONCURRENCY, config.LLM_MAX_CONCURRENCY)
+    rate_limit = request.rate_limit if request.rate_limit is not None else config.BATCH_RATE_LIMIT
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    pacer = RequestPacer(rate_limit)
+    
+    async def generate_one(index: int, patient: PatientInfo, patient_id: int) -> dict:
+        item = {"index": index, "patient_id": patient_id, "name": patient.name}
+        async with semaphore:
+            await pacer.wait()
+            try:
+                report_content = await llm_gateway.complete(
+                    messages=[
+                        {"role": "system", "content": "你是一个专业的医疗AI助手，专门生成中西医结合的诊疗报告。"},
+                        {"role": "user", "content": create_medical_prompt(patient)}
+                    ],
+                    temperature=0.2,
+                    max_tokens=3000,
+                    use_cache=request.use_cache,
+                    priority=PRIORITY_BATCH
+                )
+                await save_report(patient_id, report_content, request.report_type)
+                item.update({"success": True, "report": report_content})
+            except UpstreamOverloadedError as e:
+                item.update({"success": False, "error": str(e), "retry_after": e.retry_after})
+            except Exception as e:
+                item.update({"success": False, "error": str(e)})
+        item["generated_at"] = datetime.now().isoformat()
+        return item
+    
+    tasks = [
+        asyncio.ensure_future(generate_one(i, patient, patient_id))
+        for i, (patient, patient_id) in enumerate(zip(request.patients, patient_ids))
+    ]
+    
+    if request.stream:
+        async def ndjson_generator():
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    item = await finished
+                    yield json.dumps(item, ensure_ascii=False) + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+        
+        return StreamingResponse(ndjson_generator(), media_type="application/x-ndjson")
+    
+    results = await asyncio.gather(*tasks)
+    succeeded = sum(1 for item in results if item["success"])
+    return {
+        "success": succeeded == len(results),
+        "total": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    }
+
+# /patients 可选字段：字段名 -> SQL 表达式（r 为最新一份报告）
+PATIENT_LIST_FIELDS = {
+    "id": "p.id",
+    "name": "p.name",
+    "age": "p.age",
+    "sex": "p.sex",
+    "chief_complaint": "p.chief_complaint",
+    "history": "p.history",
+    "labs": "p.labs",
+    "imaging": "p.imaging",
+    "additional_notes": "p.additional_notes",
+    "created_at": "p.created_at",
+    "latest_report_id": "r.id",
+    "latest_report_type": "r.report_type",
+    "latest_report": "report_text(r.report_content, r.compression)",
+    "report_created_at": "r.created_at"
+}
+DEFAULT_PATIENT_LIST_FIELDS = [
+    "id", "name", "age", "sex", "chief_complaint", "history", "labs", "imaging",
+    "additional_notes", "created_at", "latest_report", "report_created_at"
+]
+
+def parse_patient_cursor(after: str) -> tuple:
+    """解析游标 <created_at>,<id>"""
+    created_at, _, patient_id = after.rpartition(",")
+    if not created_at or not patient_id.isdigit():
+        raise HTTPException(status_code=400, detail="after 参数格式应为 <created_at>,<id>")
+    return created_at, int(patient_id)
+
+@app.post("/patients/import")
+async def import_patients_file(file: UploadFile = File(...), encoding: str = "utf-8-sig",
+                               skip_existing: bool = True, generate_reports: bool = False,
+                               report_type: str = "comprehensive"):
+    """
+    从 CSV/XLSX 批量导入历史病例
+
+    - 必需列：patient_id, age, sex, chief_complaint, ALT, AST, AFP, imaging_result
+    - 可选列：name, history / medical_history, additional_notes，其余列作为检验指标写入 labs
+    - skip_existing: 跳过库中已导入过的 patient_id
+    - generate_reports: 为导入的病人提交后台报告生成任务（低优先级）
+    """
+    filename = (file.filename or "").lower()
+    if filename.endswith(".csv"):
+        open_rows = lambda: iter_csv_rows(file.file, encoding)
+    elif filename.endswith(".xlsx"):
+        open_rows = lambda: iter_xlsx_rows(file.file)
+    else:
+        raise HTTPException(status_code=400, detail="支持的文件格式: CSV, XLSX")
+    
+    def run_import():
+        header, rows = open_rows()
+        return import_patients(db, header, rows, skip_existing=skip_existing)
+    
+    try:
+        with phase("db"):
+            stats = await asyncio.to_thread(run_import)
+    except ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"导入病人数据时发生错误: {str(e)}")
+    finally:
+        await file.close()
+    
+    imported_ids = stats.pop("imported_ids")
+    queued_jobs = 0
+    if generate_reports and imported_ids:
+        payloads = [{"patient_id": pid, "report_type": report_type} for pid in imported_ids]
+        queued_jobs = len(await job_queue.submit_many("generate_patient_report", payloads, priority=PRIORITY_BATCH))
+    
+    return {
+        "success": True,
+        **stats,
+        "first_patient_id": imported_ids[0] if imported_ids else None,
+        "last_patient_id": imported_ids[-1] if imported_ids else None,
+        "queued_report_jobs": queued_jobs
+    }
+
 @app.get("/patients")
-async def get_patients():
-    conn = sqlite3.connect('medical_reports.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT p.*, r.report_content, r.created_at as report_created_at
-        FROM patients p
-        LEFT JOIN reports r ON p.id = r.patient_id
-        ORDER BY p.created_at DESC
-    ''')
-    patients = cursor.fetchall()
-    conn.close()
+async def get_patients(after: Optional[str] = None, limit: Optional[int] = None,
+                       fields: Optional[str] = None):
+    """
+    分页获取病人列表（按创建时间倒序）
+
+    - after: 上一页返回的 next_cursor，不传时从最新的病人开始
+    - limit: 每页条数；传了 after 而没传 limit 时为 PATIENTS_PAGE_SIZE。
+      after 和 limit 都不传时返回全部病人，与分页之前的调用方式兼容
+    - fields: 逗号分隔的返回字段，列表视图可省略 labs、latest_report 等大字段，
+      报告正文按 latest_report_id 通过 /reports/{id} 单独获取
+    """
+    paginate = after is not None or limit is not None
+    if paginate:
+        limit = max(1, min(limit or config.PATIENTS_PAGE_SIZE, config.PATIENTS_MAX_PAGE_SIZE))
+    selected = [f.strip() for f in fields.split(",") if f.strip()] if fields else DEFAULT_PATIENT_LIST_FIELDS
+    unknown = [f for f in selected if f not in PATIENT_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"不支持的字段: {', '.join(unknown)}")
+    
+    columns = [f"{PATIENT_LIST_FIELDS[f]} AS {f}" for f in selected]
+    # 每个病人只关联最新一份报告（经 idx_reports_patient_created 索引逐个定位），不需要报告字段时不关联
+    join = '''
+        LEFT JOIN reports r ON r.id = (
+            SELECT id FROM reports
+            WHERE patient_id = p.id
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        )
+    ''' if any(re.search(r"\br\.", PATIENT_LIST_FIELDS[f]) for f in selected) else ""
+    where, params = "", []
+    if after:
+        where = "WHERE (p.created_at, p.id) < (?, ?)"
+        params.extend(parse_patient_cursor(after))
     
+    with phase("db"):
+        # 多取一条用于判断是否还有下一页；末尾两列用于生成游标（LIMIT -1 为不限条数）
+        rows = await adb.query_all(f'''
+            SELECT {", ".join(columns)}, p.created_at, p.id
+            FROM patients p
+            {join}
+            {where}
+            ORDER BY p.created_at DESC, p.id DESC
+            LIMIT ?
+        ''', (*params, limit + 1 if paginate else -1))
+    
+    has_more = paginate and len(rows) > limit
+    rows = rows[:limit] if paginate else rows
     result = []
-    for patient in patients:
-        result.append({
-            "id": patient[0],
-            "name": patient[1],
-            "age": patient[2],
-            "sex": patient[3],
-            "chief_complaint": patient[4],
-            "history": patient[5],
-            "labs": json.loads(patient[6]) if patient[6] else {},
-            "imaging": patient[7],
-            "additional_notes": patient[8],
-            "created_at": patient[9],
-            "latest_report": patient[10] if patient[10] else None,
-            "report_created_at": patient[11] if patient[11] else None
-        })
+    for row in rows:
+        patient = dict(zip(selected, row))
+        if "labs" in patient:
+            patient["labs"] = json.loads(patient["labs"]) if patient["labs"] else {}
+        for key in ("latest_report", "report_created_at"):
+            if key in patient and not patient[key]:
+                patient[key] = None
+        result.append(patient)
     
-    return {"patients": result}
+    return {
+        "patients": result,
+        "has_more": has_more,
+        "next_cursor": f"{rows[-1][-2]},{rows[-1][-1]}" if has_more else None
+    }
 
-@app.get("/patient/{patient_id}")
-async def get_patient(patient_id: int):
-    conn = sqlite3.connect('medical_reports.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
-    patient = cursor.fetchone()
+@app.get("/reports/{report_id}")
+async def get_report(report_id: int):
+    """获取单份报告正文"""
+    with phase("db"):
+        report = await adb.query_one(SELECT_REPORT_SQL, (report_id,))
+    if not report:
+        raise HTTPException(status_code=404, detail="报告未找到")
     
-    if not patient:
-        conn.close()
-        raise HTTPException(status_code=404, detail="病人信息未找到")
+    return {
+        "report": {
+            "id": report[0],
+            "patient_id": report[1],
+            "content": report[2],
+            "type": report[3],
+            "created_at": report[4]
+        }
+    }
+
+@app.get("/search")
+async def search(q: str, scope: str = "all", limit: int = 20, offset: int = 0):
+    """
+    全文检索病人信息（主诉、既往史、影像）和报告正文
+
+    - q: 检索词，空白分隔的多个词需同时命中
+    - scope: all / patients / reports
+    - limit / offset: 分页，结果按相关度排序
+    """
+    if scope not in ("all", "patients", "reports"):
+        raise HTTPException(status_code=400, detail="scope 应为 all、patients 或 reports")
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="检索词不能为空")
+    limit = max(1, min(limit, config.SEARCH_MAX_PAGE_SIZE))
     
-    cursor.execute('SELECT * FROM reports WHERE patient_id = ? ORDER BY created_at DESC', (patient_id,))
-    reports = cursor.fetchall()
-    conn.close()
+    try:
+        with phase("db"):
+            result = await adb.run(search_records, db, q, scope, limit, max(0, offset))
+        return {"query": q, **result}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"检索时发生错误: {str(e)}")
+
+def check_cohort_filters(filters: List[LabFilter]):
+    for f in filters:
+        if not f.test_name.strip():
+            raise HTTPException(status_code=400, detail="test_name 不能为空")
+        if f.min is not None and f.max is not None and f.min > f.max:
+            raise HTTPException(status_code=400, detail=f"{f.test_name} 的 min 不能大于 max")
+
+@app.post("/cohort/query")
+async def cohort_query(request: CohortQueryRequest):
+    """
+    按检验指标范围筛选病人队列，如 AFP >= 400 且 ALT <= 40
+
+    结果按病人 ID 升序分页，把 next_cursor 作为下一次请求的 after 即可继续翻页；
+    每个病人返回全部检验结果（数值和单位）。
+    """
+    check_cohort_filters(request.filters)
+    limit = max(1, min(request.limit, config.COHORT_MAX_PAGE_SIZE))
+    
+    try:
+        with phase("db"):
+            result = await adb.run(
+                query_cohort, db, [f.model_dump() for f in request.filters], request.sex,
+                request.age_min, request.age_max, request.after, limit, request.include_total
+            )
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"筛选队列时发生错误: {str(e)}")
+
+def export_response(kind: str, format: str, columns: list, chunks, until: int) -> StreamingResponse:
+    return StreamingResponse(
+        ENCODERS[format](columns, chunks),
+        media_type=EXPORT_FORMATS[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{kind}_{until}.{format}"',
+            "X-Export-Until": str(until)
+        }
+    )
+
+def check_export_format(format: str):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format 应为 {'、'.join(EXPORT_FORMATS)}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="导出 Parquet 需要安装 pyarrow")
+
+@app.get("/export/patients")
+async def export_patients(format: str = "ndjson", since: Optional[str] = None, extra_labs: bool = True):
+    """
+    流式导出病人数据，列与 create_sample_dataset 的数据集一致
+
+    - format: ndjson / csv / parquet
+    - since: 传上一次响应头中的 X-Export-Until（截止 ID）即为增量导出，只导出之后写入的病人；
+      也接受时间（只导出该时间之后创建的病人）
+    - extra_labs: 是否追加数据集之外的检验指标列
+    """
+    check_export_format(format)
+    with phase("db"):
+        until = await adb.run(export_watermark, db, "patients")
+        columns = await adb.run(patient_columns, db, extra_labs)
+    return export_response("patients", format, columns, iter_patient_records(db, columns, since, until), until)
+
+@app.get("/export/reports")
+async def export_reports(format: str = "ndjson", since: Optional[str] = None):
+    """流式导出报告（含解压后的正文），参数同 /export/patients"""
+    check_export_format(format)
+    with phase("db"):
+        until = await adb.run(export_watermark, db, "reports")
+    return export_response("reports", format, REPORT_EXPORT_COLUMNS, iter_report_records(db, since, until), until)
+
+def fetch_patient_with_reports(conn, patient_id: int) -> tuple:
+    patient = conn.execute(SELECT_PATIENT_SQL, (patient_id,)).fetchone()
+    if not patient:
+        return None, []
+    reports = conn.execute(
+        f'SELECT {REPORT_COLUMNS} FROM reports WHERE patient_id = ? ORDER BY created_at DESC, id DESC', (patient_id,)
+    ).fetchall()
+    return patient, reports
+
+@app.get("/patient/{patient_id}")
+async def get_patient(patient_id: int):
+    archived = False
+    with phase("db"):
+        patient, reports = await adb.read(fetch_patient_with_reports, patient_id)
+        if not patient:
+            # 不在活跃库中时查归档
+            found = await adb.run(load_archived_patient, db, patient_id)
+            if not found:
+                raise HTTPException(status_code=404, detail="病人信息未找到")
+            (patient, reports), archived = found, True
     
     return {
+        "archived": archived,
         "patient": {
             "id": patient[0],
             "name": patient[1],
@@ -339,63 +1000,73 @@ async def get_patient(patient_id: int):
         ]
     }
 
+def delete_patient_rows(conn, patient_id: int) -> Optional[str]:
+    """删除病人及其报告，返回病人姓名；病人不存在时返回 None"""
+    # 检查患者是否存在
+    patient = conn.execute('SELECT name FROM patients WHERE id = ?', (patient_id,)).fetchone()
+    if not patient:
+        return None
+    
+    # 删除相关报告（先移除其全文索引）
+    report_codec.unindex_reports(conn, 'patient_id = ?', (patient_id,))
+    conn.execute('DELETE FROM reports WHERE patient_id = ?', (patient_id,))
+    
+    # 删除患者记录（先移除其短词索引）
+    unindex_patients(conn, 'id = ?', (patient_id,))
+    conn.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
+    return patient[0]
+
 @app.delete("/patient/{patient_id}")
 async def delete_patient(patient_id: int):
     """删除患者记录"""
-    conn = sqlite3.connect('medical_reports.db')
-    cursor = conn.cursor()
-    
     try:
-        # 检查患者是否存在
-        cursor.execute('SELECT name FROM patients WHERE id = ?', (patient_id,))
-        patient = cursor.fetchone()
+        name = await adb.write(delete_patient_rows, patient_id)
+        if name is None:
+            # 不在活跃库中时从归档删除
+            name = await adb.run(delete_archived_patient, db, patient_id)
+            if name is None:
+                raise HTTPException(status_code=404, detail="患者记录未找到")
         
-        if not patient:
-            conn.close()
-            raise HTTPException(status_code=404, detail="患者记录未找到")
-        
-        # 删除相关报告
-        cursor.execute('DELETE FROM reports WHERE patient_id = ?', (patient_id,))
-        
-        # 删除患者记录
-        cursor.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
-        
-        conn.commit()
-        conn.close()
+        # 删除该病人缓存的 PDF
+        await asyncio.to_thread(pdf_cache.purge_patient, patient_id)
         
         return {
             "success": True,
-            "message": f"患者 {patient[0]} 的记录已删除",
+            "message": f"患者 {name} 的记录已删除",
             "deleted_id": patient_id
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.rollback()
-        conn.close()
         raise HTTPException(status_code=500, detail=f"删除患者记录时发生错误: {str(e)}")
 
+def delete_all_rows(conn) -> tuple:
+    """删除所有病人和报告，返回删除前的 (病人数, 报告数)"""
+    # 获取删除前的记录数
+    patient_count = conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+    report_count = conn.execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+    
+    # 删除所有报告及其全文索引
+    report_codec.clear_index(conn)
+    conn.execute('DELETE FROM reports')
+    
+    # 删除所有患者及其短词索引
+    clear_patient_index(conn)
+    conn.execute('DELETE FROM patients')
+    return patient_count, report_count
+
 @app.delete("/patients/all")
 async def delete_all_patients():
     """删除所有患者记录"""
-    conn = sqlite3.connect('medical_reports.db')
-    cursor = conn.cursor()
-    
     try:
-        # 获取删除前的记录数
-        cursor.execute('SELECT COUNT(*) FROM patients')
-        patient_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM reports')
-        report_count = cursor.fetchone()[0]
+        patient_count, report_count = await adb.write(delete_all_rows)
         
-        # 删除所有报告
-        cursor.execute('DELETE FROM reports')
-        
-        # 删除所有患者
-        cursor.execute('DELETE FROM patients')
-        
-        conn.commit()
-        conn.close()
+        # 删除归档文件
+        archived = await adb.run(delete_all_archives, db)
+        patient_count += archived["patients"]
+        report_count += archived["reports"]
+        await asyncio.to_thread(pdf_cache.clear)
         
         return {
             "success": True,
@@ -405,73 +1076,139 @@ async def delete_all_patients():
         }
         
     except Exception as e:
-        conn.rollback()
-        conn.close()
         raise HTTPException(status_code=500, detail=f"删除所有记录时发生错误: {str(e)}")
 
+@app.post("/archive")
+async def run_archive(older_than_days: Optional[int] = None, vacuum: bool = False):
+    """
+    立即归档不活跃的病人（默认每 ARCHIVE_INTERVAL_HOURS 小时自动执行）
+
+    - older_than_days: 创建超过该天数且期间没有新报告的病人移入按月归档文件，默认 ARCHIVE_AFTER_DAYS
+    - vacuum: 归档后 VACUUM 活跃库以回收文件空间
+    """
+    if older_than_days is not None and older_than_days < 0:
+        raise HTTPException(status_code=400, detail="older_than_days 不能为负数")
+    try:
+        result = await adb.run(archive_old_records, db, older_than_days, None, vacuum)
+        return {"success": True, **result}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"归档时发生错误: {str(e)}")
+
+@app.get("/archive/stats")
+async def get_archive_stats():
+    """活跃库大小和各归档分区的病人数、文件大小"""
+    with phase("db"):
+        return await adb.run(archive_stats, db)
+
+def fetch_patient_with_latest_report(conn, patient_id: int) -> tuple:
+    patient = conn.execute(SELECT_PATIENT_SQL, (patient_id,)).fetchone()
+    if not patient:
+        return None, None
+    return patient, conn.execute(SELECT_LATEST_REPORT_SQL, (patient_id,)).fetchone()
+
+async def load_pdf_source(patient_id: int) -> tuple:
+    """读取生成 PDF 所需的病人行和最新报告，不存在时抛出 404"""
+    with phase("db"):
+        patient, report = await adb.read(fetch_patient_with_latest_report, patient_id)
+    if not patient:
+        raise HTTPException(status_code=404, detail="病人信息未找到")
+    if not report:
+        raise HTTPException(status_code=404, detail="该病人暂无诊疗报告")
+    return patient, report
+
+async def render_report_pdf(patient: tuple, report: tuple) -> bytes:
+    """在 PDF 渲染进程中渲染病人最新报告（报告生成时间取报告的创建时间，相同报告的 PDF 内容一致）"""
+    patient_data = {
+        "id": patient[0],
+        "name": patient[1],
+        "age": patient[2],
+        "sex": patient[3],
+        "chief_complaint": patient[4],
+        "history": patient[5],
+        "labs": json.loads(patient[6]) if patient[6] else {},
+        "imaging": patient[7],
+        "additional_notes": patient[8]
+    }
+    # created_at 为 UTC 时间
+    generated_at = datetime.strptime(report[4], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).astimezone()
+    return await pdf_service.render(patient_data, report[2], generated_at, report[0])
+
+# 同一缓存键的并发请求合并为一次渲染
+pdf_render_flight = SingleFlight()
+
+async def cached_report_pdf(patient: tuple, report: tuple) -> str:
+    """返回缓存的 PDF 路径，未缓存时渲染一次写入缓存（相同 PDF 的并发请求只渲染一次）"""
+    key = make_pdf_key(patient, report[0])
+    path = pdf_cache.get(key)
+    if path:
+        return path
+
+    async def render() -> str:
+        with phase("pdf"):
+            data = await render_report_pdf(patient, report)
+        return await asyncio.to_thread(pdf_cache.put, key, data)
+
+    return await pdf_render_flight.do(key, render)
+
+def pdf_download_name(patient: tuple) -> str:
+    # 姓名是用户输入，清理路径分隔符等字符后才能用作下载文件名和 ZIP 条目名
+    return f"诊疗报告_{safe_filename(str(patient[1]), '病人')}_{patient[0]}.pdf"
+
 @app.post("/generate_pdf/{patient_id}")
 async def generate_pdf_report(patient_id: int):
-    """生成PDF格式的诊疗报告"""
+    """生成PDF格式的诊疗报告（病人信息和报告未变化时直接返回已缓存的 PDF）"""
     try:
-        # 获取病人信息和最新报告
-        conn = sqlite3.connect('medical_reports.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
-        patient = cursor.fetchone()
-        
-        if not patient:
-            conn.close()
-            raise HTTPException(status_code=404, detail="病人信息未找到")
-        
-        cursor.execute('SELECT * FROM reports WHERE patient_id = ? ORDER BY created_at DESC LIMIT 1', (patient_id,))
-        report = cursor.fetchone()
-        conn.close()
-        
-        if not report:
-            raise HTTPException(status_code=404, detail="该病人暂无诊疗报告")
-        
-        # 构建病人数据
-        patient_data = {
-            "id": patient[0],
-            "name": patient[1],
-            "age": patient[2],
-            "sex": patient[3],
-            "chief_complaint": patient[4],
-            "history": patient[5],
-            "labs": json.loads(patient[6]) if patient[6] else {},
-            "imaging": patient[7],
-            "additional_notes": patient[8]
-        }
-        
-        # 生成PDF
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        pdf_filename = f"诊疗报告_{patient_data['name']}_{timestamp}.pdf"
-        pdf_path = f"reports/{pdf_filename}"
-        
-        # 确保reports目录存在
-        os.makedirs("reports", exist_ok=True)
-        
-        generate_medical_report_pdf(patient_data, report[2], pdf_path)
+        patient, report = await load_pdf_source(patient_id)
+        pdf_path = await cached_report_pdf(patient, report)
         
         return {
             "success": True,
             "pdf_path": pdf_path,
-            "filename": pdf_filename,
+            "filename": os.path.basename(pdf_path),
+            "download_name": pdf_download_name(patient),
             "message": "PDF报告生成成功"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成PDF报告时发生错误: {str(e)}")
 
+@app.get("/download_pdf/patient/{patient_id}")
+async def download_patient_pdf(patient_id: int, cache: bool = True):
+    """
+    下载病人最新报告的 PDF
+    
+    cache=true 时使用（必要时写入）PDF 缓存；cache=false 时在内存中渲染后直接返回，不落盘
+    """
+    patient, report = await load_pdf_source(patient_id)
+    download_name = pdf_download_name(patient)
+    try:
+        if cache:
+            return FileResponse(
+                path=await cached_report_pdf(patient, report),
+                filename=download_name,
+                media_type='application/pdf'
+            )
+        with phase("pdf"):
+            data = await render_report_pdf(patient, report)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成PDF报告时发生错误: {str(e)}")
+    return Response(
+        content=data,
+        media_type='application/pdf',
+        headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(download_name)}"}
+    )
+
 @app.get("/download_pdf/{filename}")
 async def download_pdf(filename: str):
-    """下载PDF文件"""
-    import os
-    from fastapi.responses import FileResponse
-    
-    pdf_path = f"reports/{filename}"
-    if not os.path.exists(pdf_path):
-        raise HTTPException(status_code=404, detail="PDF文件未找到")
+    """下载PDF文件（/generate_pdf 返回的 filename）"""
+    pdf_path = pdf_cache.lookup(filename)
+    if not pdf_path:
+        # 旧版本生成在 reports/ 下的文件
+        pdf_path = os.path.join("reports", os.path.basename(filename))
+        if not os.path.isfile(pdf_path):
+            raise HTTPException(status_code=404, detail="PDF文件未找到")
     
     return FileResponse(
         path=pdf_path,
@@ -479,38 +1216,130 @@ async def download_pdf(filename: str):
         media_type='application/pdf'
     )
 
+def fetch_pdf_sources(conn, patient_ids: List[int]) -> list:
+    """[(病人ID, 病人行, 最新报告行)]，病人或报告不存在时对应项为 None"""
+    return [(pid, *fetch_patient_with_latest_report(conn, pid)) for pid in patient_ids]
+
+async def read_report_pdf(patient: tuple, report: tuple) -> bytes:
+    path = await cached_report_pdf(patient, report)
+    try:
+        return await asyncio.to_thread(Path(path).read_bytes)
+    except FileNotFoundError:
+        # 刚写入缓存就被淘汰，直接重新渲染
+        return await render_report_pdf(patient, report)
+
+async def iter_report_pdfs(sources: list):
+    """
+    并行渲染各病人的 PDF，按完成顺序产出 (文件名, PDF 字节)，最后产出清单 manifest.csv
+
+    同时在途的渲染任务和已完成、未被取走的结果都有上限，客户端下载较慢时渲染随之暂停，内存占用恒定。
+    """
+    concurrency = max(2, pdf_service.workers * 2)
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    pending = iter(sources)
+
+    async def worker():
+        for patient_id, patient, report in pending:
+            if not patient:
+                await results.put((patient_id, None, None, "病人信息未找到"))
+            elif not report:
+                await results.put((patient_id, patient, None, "暂无诊疗报告"))
+            else:
+                try:
+                    await results.put((patient_id, patient, await read_report_pdf(patient, report), "成功"))
+                except Exception as e:
+                    await results.put((patient_id, patient, None, f"生成失败: {e}"))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(sources)))]
+    manifest = io.StringIO()
+    writer = csv.writer(manifest)
+    writer.writerow(["patient_id", "name", "file", "status"])
+    try:
+        for _ in range(len(sources)):
+            patient_id, patient, data, status = await results.get()
+            filename = pdf_download_name(patient) if data is not None else ""
+            writer.writerow([patient_id, patient[1] if patient else "", filename, status])
+            if data is not None:
+                yield filename, data
+        yield "manifest.csv", manifest.getvalue().encode("utf-8-sig")
+    finally:
+        for task in workers:
+            task.cancel()
+
+@app.post("/export/pdfs")
+async def export_pdfs(request: PDFExportRequest):
+    """
+    批量导出病人最新报告的 PDF，以 ZIP 流式返回
+    
+    - patient_ids: 病人 ID 列表；或 cohort: 与 /cohort/query 相同的筛选条件，二者选一
+    - 各 PDF 在渲染进程池中并行生成（已缓存的直接读取），每完成一份即写入 ZIP 输出
+    - ZIP 末尾的 manifest.csv 列出每位病人的导出结果（无报告、不存在的病人也在其中）
+    """
+    if bool(request.patient_ids) == (request.cohort is not None):
+        raise HTTPException(status_code=400, detail="patient_ids 和 cohort 需提供且只能提供一个")
+    max_patients = config.PDF_EXPORT_MAX_PATIENTS
+    
+    if request.cohort is not None:
+        cohort = request.cohort
+        check_cohort_filters(cohort.filters)
+        with phase("db"):
+            result = await adb.run(
+                query_cohort, db, [f.model_dump() for f in cohort.filters], cohort.sex,
+                cohort.age_min, cohort.age_max, None, max_patients, False
+            )
+        if result["has_more"]:
+            raise HTTPException(status_code=400, detail=f"符合条件的病人超过 {max_patients} 位，请缩小筛选范围")
+        patient_ids = [p["id"] for p in result["patients"]]
+    else:
+        patient_ids = list(dict.fromkeys(request.patient_ids))
+        if len(patient_ids) > max_patients:
+            raise HTTPException(status_code=400, detail=f"单次最多导出 {max_patients} 位病人")
+    if not patient_ids:
+        raise HTTPException(status_code=404, detail="没有符合条件的病人")
+    
+    with phase("db"):
+        sources = await adb.read(fetch_pdf_sources, patient_ids)
+    filename = f"诊疗报告_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return StreamingResponse(
+        encode_zip(iter_report_pdfs(sources)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"}
+    )
+
 @app.post("/chat")
 async def ai_chat(request: ChatRequest):
     """AI对话功能"""
     try:
-        # 构建对话历史
-        messages = [
-            {"role": "system", "content": "你是一个专业的医疗AI助手，可以回答医疗相关问题，提供医学建议，但请注意提醒用户这些建议仅供参考，不能替代专业医生的诊断。"}
-        ]
-        
-        # 添加历史对话
-        for msg in request.conversation_history:
-            messages.append(msg)
+        # 构建对话历史（超出 token 预算时早期对话以摘要代替）
+        messages = await chat_history_manager.build_messages(
+            "你是一个专业的医疗AI助手，可以回答医疗相关问题，提供医学建议，但请注意提醒用户这些建议仅供参考，不能替代专业医生的诊断。",
+            request.conversation_history,
+            request.message
+        )
         
-        # 添加当前用户消息
-        messages.append({"role": "user", "content": request.message})
+        if request.stream:
+            return stream_llm_response(messages, 0.7, 2000, lambda ai_response: {
+                "success": True,
+                "response": ai_response,
+                "timestamp": datetime.now().isoformat()
+            }, priority=PRIORITY_INTERACTIVE)
         
         # 调用阿里云通义千问 API
-        response = dashscope_client.chat.completions.create(
-            model="qwen-plus",
+        ai_response = await llm_gateway.complete(
             messages=messages,
             temperature=0.7,
-            max_tokens=2000
+            max_tokens=2000,
+            priority=PRIORITY_INTERACTIVE
         )
         
-        ai_response = response.choices[0].message.content
-        
         return {
             "success": True,
             "response": ai_response,
             "timestamp": datetime.now().isoformat()
         }
         
+    except UpstreamOverloadedError as e:
+        raise upstream_overloaded(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI对话时发生错误: {str(e)}")
 
@@ -528,20 +1357,28 @@ async def optimize_report(request: ReportOptimizeRequest):
         
         prompt = optimize_prompts.get(request.optimize_type, optimize_prompts["format"])
         full_prompt = f"{prompt}\n\n原始报告：\n{request.original_report}"
+        messages = [
+            {"role": "system", "content": "你是一个专业的医疗报告整理专家，擅长优化医疗报告的格式、内容和可读性。"},
+            {"role": "user", "content": full_prompt}
+        ]
+        
+        if request.stream:
+            return stream_llm_response(messages, 0.3, 3000, lambda optimized_report: {
+                "success": True,
+                "original_report": request.original_report,
+                "optimized_report": optimized_report,
+                "optimize_type": request.optimize_type,
+                "timestamp": datetime.now().isoformat()
+            }, use_cache=request.use_cache)
         
         # 调用阿里云通义千问 API
-        response = dashscope_client.chat.completions.create(
-            model="qwen-plus",
-            messages=[
-                {"role": "system", "content": "你是一个专业的医疗报告整理专家，擅长优化医疗报告的格式、内容和可读性。"},
-                {"role": "user", "content": full_prompt}
-            ],
+        optimized_report = await llm_gateway.complete(
+            messages=messages,
             temperature=0.3,
-            max_tokens=3000
+            max_tokens=3000,
+            use_cache=request.use_cache
         )
         
-        optimized_report = response.choices[0].message.content
-        
         return {
             "success": True,
             "original_report": request.original_report,
@@ -550,11 +1387,13 @@ async def optimize_report(request: ReportOptimizeRequest):
             "timestamp": datetime.now().isoformat()
         }
         
+    except UpstreamOverloadedError as e:
+        raise upstream_overloaded(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"报告整理时发生错误: {str(e)}")
 
 @app.post("/analyze_symptoms")
-async def analyze_symptoms(symptoms: dict):
+async def analyze_symptoms(symptoms: dict, use_cache: bool = True):
     """症状分析功能"""
     try:
         symptoms_text = ", ".join([f"{k}: {v}" for k, v in symptoms.items()])
@@ -572,18 +1411,16 @@ async def analyze_symptoms(symptoms: dict):
         请注意：此分析仅供参考，不能替代专业医生的诊断，如有疑问请及时就医。
         """
         
-        response = dashscope_client.chat.completions.create(
-            model="qwen-plus",
+        analysis = await llm_gateway.complete(
             messages=[
                 {"role": "system", "content": "你是一个专业的医疗AI助手，提供症状分析和医学建议。"},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.3,
-            max_tokens=2000
+            max_tokens=2000,
+            use_cache=use_cache
         )
         
-        analysis = response.choices[0].message.content
-        
         return {
             "success": True,
             "symptoms": symptoms,
@@ -591,9 +1428,34 @@ async def analyze_symptoms(symptoms: dict):
             "timestamp": datetime.now().isoformat()
         }
         
+    except UpstreamOverloadedError as e:
+        raise upstream_overloaded(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"症状分析时发生错误: {str(e)}")
 
+@app.get("/llm_cache/stats")
+async def get_llm_cache_stats():
+    """获取大模型响应缓存统计"""
+    stats = await asyncio.to_thread(llm_cache.stats)
+    return {"success": True, "enabled": llm_gateway.cache is not None, "stats": stats}
+
+@app.delete("/llm_cache")
+async def clear_llm_cache():
+    """清空大模型响应缓存"""
+    deleted = await asyncio.to_thread(llm_cache.clear)
+    return {"success": True, "message": f"已清空 {deleted} 条缓存", "deleted": deleted}
+
+@app.get("/pdf_cache/stats")
+async def get_pdf_cache_stats():
+    """获取 PDF 缓存统计"""
+    return {"success": True, "stats": await asyncio.to_thread(pdf_cache.stats)}
+
+@app.delete("/pdf_cache")
+async def clear_pdf_cache():
+    """清空 PDF 缓存"""
+    deleted = await asyncio.to_thread(pdf_cache.clear)
+    return {"success": True, "message": f"已清空 {deleted} 个缓存的 PDF", "deleted": deleted}
+
 @app.post("/research/generate_evidence_bundle")
 async def generate_evidence_bundle(request: ResearchAnalysisRequest):
     """生成科研证据包"""
@@ -603,20 +1465,28 @@ async def generate_evidence_bundle(request: ResearchAnalysisRequest):
         
         # 生成科研报告prompt
         research_prompt = create_research_prompt(evidence, request.analysis_type)
+        messages = [
+            {"role": "system", "content": "你是一个专业的医疗AI研究专家，精通临床科研和中西医结合。"},
+            {"role": "user", "content": research_prompt}
+        ]
+        
+        if request.stream:
+            return stream_llm_response(messages, 0.2, 4000, lambda research_report: {
+                "success": True,
+                "evidence_bundle": evidence,
+                "research_report": research_report,
+                "analysis_type": request.analysis_type,
+                "include_tcm": request.include_tcm,
+                "timestamp": datetime.now().isoformat()
+            })
         
         # 调用LLM生成科研报告
-        response = dashscope_client.chat.completions.create(
-            model="qwen-plus",
-            messages=[
-                {"role": "system", "content": "你是一个专业的医疗AI研究专家，精通临床科研和中西医结合。"},
-                {"role": "user", "content": research_prompt}
-            ],
+        research_report = await llm_gateway.complete(
+            messages=messages,
             temperature=0.2,
             max_tokens=4000
         )
         
-        research_report = response.choices[0].message.content
-        
         return {
             "success": True,
             "evidence_bundle": evidence,
@@ -626,6 +1496,8 @@ async def generate_evidence_bundle(request: ResearchAnalysisRequest):
             "timestamp": datetime.now().isoformat()
         }
         
+    except UpstreamOverloadedError as e:
+        raise upstream_overloaded(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"科研分析时发生错误: {str(e)}")
 
@@ -695,6 +1567,7 @@ def create_sample_evidence_bundle_simple(patient_data: dict):
         "timestamp": datetime.now().isoformat()
     }
 
+@timed_phase("prompt")
 def create_research_prompt(evidence: dict, analysis_type: str):
     """创建科研分析prompt"""
     if analysis_type == "comprehensive":
@@ -702,7 +1575,7 @@ def create_research_prompt(evidence: dict, analysis_type: str):
 你是一位资深的肝胆外科专家和临床研究员，同时精通中医辨证论治。请基于以下科学证据包，生成一份专业的术前评估报告，包含临床诊疗建议和科研分析。
 
 **证据包数据：**
-{json.dumps(evidence, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence)}
 
 **请按以下结构生成报告：**
 
@@ -767,7 +1640,7 @@ def create_research_prompt(evidence: dict, analysis_type: str):
         return f"""
 请基于以下医疗AI证据包，生成专业的{analysis_type}分析报告：
 
-{json.dumps(evidence, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence)}
 
 请提供专业的医学分析和建议。
 """
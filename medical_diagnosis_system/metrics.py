@@ -0,0 +1,271 @@
+"""
+运行指标模块 - 以 Prometheus 文本格式输出接口延迟、LLM token/费用、错误率等指标
+
+无需外部依赖：
+- Counter / Gauge / Histogram 三种基础指标，支持标签
+- MetricsMiddleware 统计每个接口的延迟、在途请求数，并写入 Server-Timing 响应头
+- phase() / timed_phase() 记录单个请求内数据库、Prompt 构建、LLM、PDF 等阶段耗时
+"""
+
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """指标基类"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 callback: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._callback = callback  # 提供时在采集时读取当前值（无标签）
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        if self._callback is not None:
+            return [f"{self.name} {_format_value(self._callback())}"]
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames, callback)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames, callback)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """分桶直方图"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            items = [(k, list(c), self._sums[k]) for k, c in self._counts.items()]
+        for key, counts, total in items:
+            for bound, count in zip(self.buckets, counts):
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), callback=None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, callback))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# 接口指标
+HTTP_REQUESTS = registry.counter("http_requests_total", "HTTP 请求总数", ("method", "endpoint", "status"))
+HTTP_LATENCY = registry.histogram("http_request_duration_seconds", "HTTP 请求耗时（含流式响应体）", ("method", "endpoint"))
+HTTP_IN_FLIGHT = registry.gauge("http_requests_in_flight", "正在处理的 HTTP 请求数")
+PHASE_LATENCY = registry.histogram("request_phase_duration_seconds", "请求内各阶段耗时", ("phase",))
+
+# 大模型指标
+LLM_REQUESTS = registry.counter("llm_requests_total", "上游大模型调用次数", ("mode", "outcome"))
+LLM_LATENCY = registry.histogram("llm_request_duration_seconds", "上游大模型调用耗时", ("mode",))
+LLM_IN_FLIGHT = registry.gauge("llm_requests_in_flight", "正在进行的上游大模型调用数")
+LLM_TOKENS = registry.counter("llm_tokens_total", "大模型 token 用量", ("type",))
+LLM_COST = registry.counter("llm_cost_yuan_total", "按配置单价估算的大模型费用（元）")
+LLM_CACHE_LOOKUPS = registry.counter("llm_cache_lookups_total", "大模型响应缓存查询次数", ("result",))
+LLM_CACHE_HIT_RATIO = registry.gauge(
+    "llm_cache_hit_ratio", "大模型响应缓存命中率",
+    callback=lambda: _ratio(LLM_CACHE_LOOKUPS.value(result="hit"),
+                            LLM_CACHE_LOOKUPS.value(result="hit") + LLM_CACHE_LOOKUPS.value(result="miss"))
+)
+
+def _ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator else 0.0
+
+
+# Server-Timing 阶段记录（每个请求一份）
+_phases: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_phases", default=None)
+
+
+def record_phase(name: str, seconds: float):
+    """记录一个阶段耗时，同一请求内同名阶段累加"""
+    PHASE_LATENCY.observe(seconds, phase=name)
+    phases = _phases.get()
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str):
+    """统计代码块耗时：with phase("db"): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+
+def timed_phase(name: str):
+    """统计同步函数耗时的装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_llm_usage(usage, prompt_price: float = 0.0, completion_price: float = 0.0):
+    """记录 token 用量和费用，usage 可以是对象或字典；单价为每千 token 的价格"""
+    if usage is None:
+        return
+    get = usage.get if isinstance(usage, dict) else (lambda k, d=None: getattr(usage, k, d))
+    prompt_tokens = get("prompt_tokens", 0) or 0
+    completion_tokens = get("completion_tokens", 0) or 0
+    LLM_TOKENS.inc(prompt_tokens, type="prompt")
+    LLM_TOKENS.inc(completion_tokens, type="completion")
+    LLM_COST.inc(prompt_tokens / 1000 * prompt_price + completion_tokens / 1000 * completion_price)
+
+
+class MetricsMiddleware:
+    """ASGI 中间件：记录接口延迟、状态码、在途请求数，并添加 Server-Timing 响应头"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        phases: Dict[str, float] = {}
+        token = _phases.set(phases)
+        start = time.perf_counter()
+        status = 500
+        HTTP_IN_FLIGHT.inc()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items()]
+                timings.append(f"app;dur={(time.perf_counter() - start) * 1000:.1f}")
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", ", ".join(timings).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # 路由匹配后 FastAPI 会把 route 写入 scope，使用路由模板避免标签基数膨胀
+            endpoint = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_IN_FLIGHT.dec()
+            HTTP_LATENCY.observe(time.perf_counter() - start, method=scope["method"], endpoint=endpoint)
+            HTTP_REQUESTS.inc(method=scope["method"], endpoint=endpoint, status=str(status))
+            _phases.reset(token)
@@ -0,0 +1,212 @@
+"""
+数据库结构迁移 - 按版本号依次执行，已执行的版本记录在 PRAGMA user_version 中
+
+新增迁移时在 MIGRATIONS 末尾追加 (版本号, 说明, SQL 语句列表)，不要修改已发布的迁移。
+"""
+
+from typing import List, Tuple
+
+from database import Database
+
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "创建病人表和报告表", [
+        '''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            sex TEXT NOT NULL,
+            chief_complaint TEXT NOT NULL,
+            history TEXT,
+            labs TEXT,
+            imaging TEXT,
+            additional_notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            report_content TEXT NOT NULL,
+            report_type TEXT DEFAULT 'comprehensive',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+        ''',
+    ]),
+    (2, "病人列表和最新报告查询的索引", [
+        'CREATE INDEX IF NOT EXISTS idx_reports_patient_created ON reports (patient_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_patients_created ON patients (created_at)',
+        'ANALYZE',
+    ]),
+    (3, "病人与报告全文检索索引（trigram 分词，短词使用单字/两字索引）", [
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            chief_complaint, history, imaging,
+            content='patients', content_rowid='id', tokenize='trigram'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts (rowid, chief_complaint, history, imaging)
+            VALUES (new.id, new.chief_complaint, new.history, new.imaging);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, chief_complaint, history, imaging)
+            VALUES ('delete', old.id, old.chief_complaint, old.history, old.imaging);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, chief_complaint, history, imaging)
+            VALUES ('delete', old.id, old.chief_complaint, old.history, old.imaging);
+            INSERT INTO patients_fts (rowid, chief_complaint, history, imaging)
+            VALUES (new.id, new.chief_complaint, new.history, new.imaging);
+        END
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS reports_fts USING fts5(
+            report_content,
+            content='reports', content_rowid='id', tokenize='trigram'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_insert AFTER INSERT ON reports BEGIN
+            INSERT INTO reports_fts (rowid, report_content) VALUES (new.id, new.report_content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_delete AFTER DELETE ON reports BEGIN
+            INSERT INTO reports_fts (reports_fts, rowid, report_content) VALUES ('delete', old.id, old.report_content);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS reports_fts_update AFTER UPDATE ON reports BEGIN
+            INSERT INTO reports_fts (reports_fts, rowid, report_content) VALUES ('delete', old.id, old.report_content);
+            INSERT INTO reports_fts (rowid, report_content) VALUES (new.id, new.report_content);
+        END
+        ''',
+        # 1~2 个字的检索词使用的单字/两字索引，由应用维护（search.ngram_text），
+        # 已有数据在启动时由 search.sync_patient_index / ReportCodec.sync_index 补建
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_ngram USING fts5(
+            text, content='', detail='none', tokenize='unicode61'
+        )
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS reports_ngram USING fts5(
+            text, content='', detail='none', tokenize='unicode61'
+        )
+        ''',
+        # 为已有数据建立索引
+        "INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')",
+        "INSERT INTO reports_fts (reports_fts) VALUES ('rebuild')",
+    ]),
+    (4, "病人外部编号（批量导入时的 patient_id）", [
+        'ALTER TABLE patients ADD COLUMN external_id TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_patients_external_id ON patients (external_id)',
+    ]),
+    # 存量报告由 ReportCodec.compress_existing 分批压缩；reports_fts 改为无内容（contentless）索引，
+    # 由应用在写入/删除报告时用明文维护，存量报告的索引在启动时由 ReportCodec.sync_index 补建
+    (5, "报告正文压缩存储，全文索引改为由应用维护的无内容索引", [
+        'ALTER TABLE reports ADD COLUMN compression TEXT',
+        '''
+        CREATE TABLE IF NOT EXISTS report_dictionaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            sample_count INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'DROP TRIGGER IF EXISTS reports_fts_insert',
+        'DROP TRIGGER IF EXISTS reports_fts_delete',
+        'DROP TRIGGER IF EXISTS reports_fts_update',
+        'DROP TABLE IF EXISTS reports_fts',
+        '''
+        CREATE VIRTUAL TABLE reports_fts USING fts5(
+            report_content,
+            content='', tokenize='trigram'
+        )
+        ''',
+    ]),
+    # lab_results 由应用在写入病人的同一事务中写入（lab_results.write_lab_results），
+    # 已有病人的明细在启动时由 lab_results.sync_lab_results 回填；删除病人时由纯 SQL 触发器同步删除
+    (6, "检验结果明细表（由 patients.labs 拆分，按指标范围筛选队列）", [
+        '''
+        CREATE TABLE IF NOT EXISTS lab_results (
+            patient_id INTEGER NOT NULL,
+            test_name TEXT NOT NULL,
+            value REAL,
+            unit TEXT,
+            raw_value TEXT,
+            PRIMARY KEY (patient_id, test_name)
+        ) WITHOUT ROWID
+        ''',
+        # 索引隐含主键列 patient_id，范围筛选只读索引即可拿到病人 ID
+        'CREATE INDEX IF NOT EXISTS idx_lab_results_test_value ON lab_results (test_name, value)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS lab_results_delete AFTER DELETE ON patients BEGIN
+            DELETE FROM lab_results WHERE patient_id = old.id;
+        END
+        ''',
+    ]),
+    (7, "报告按创建时间增量导出的索引", [
+        'CREATE INDEX IF NOT EXISTS idx_reports_created ON reports (created_at)',
+    ]),
+    (8, "已归档病人的分区定位表（见 archive.py）", [
+        '''
+        CREATE TABLE IF NOT EXISTS archived_patients (
+            id INTEGER PRIMARY KEY,
+            partition TEXT NOT NULL,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    # 早期版本由 job_queue.py 在首次连接时建表，表已存在时只补充 available_at 列
+    (9, "后台任务队列表（可重试任务的退避时间）", [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            priority INTEGER DEFAULT 1,
+            payload TEXT,
+            state TEXT,
+            result TEXT,
+            error TEXT,
+            stage TEXT,
+            progress REAL DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            idempotency_key TEXT UNIQUE,
+            worker_id TEXT,
+            lease_until REAL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+        ''',
+        'ALTER TABLE jobs ADD COLUMN available_at REAL',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, priority, created_at)',
+    ]),
+]
+
+
+def apply_migrations(database: Database, migrations: List[Tuple[int, str, List[str]]] = None) -> int:
+    """执行尚未执行的迁移，返回迁移后的版本号"""
+    migrations = migrations if migrations is not None else MIGRATIONS
+    with database.transaction() as conn:
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, description, statements in sorted(migrations, key=lambda m: m[0]):
+            if version <= current:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            current = version
+            print(f"✅ 数据库迁移至版本 {version}: {description}")
+    return current
@@ -0,0 +1,200 @@
+"""
+病人批量导入 - 流式解析 CSV/XLSX 并分批写入数据库
+
+- 逐行读取上传文件，内存占用与文件大小无关
+- 必需字段与科研数据处理（DataProcessor.validate_required_fields）一致
+- 每批数据（连同检验结果明细）用 executemany 在一个事务中写入
+- 文件内重复的 patient_id 只导入第一条，可选跳过库中已导入过的 patient_id
+"""
+
+import csv
+import io
+import json
+from typing import Any, BinaryIO, Dict, Iterator, List, Tuple
+
+from config import config
+from database import Database
+from dataset_schema import REQUIRED_FIELDS, missing_required_fields
+from lab_results import write_lab_results
+from search import index_patients
+
+# 表格列名 -> patients 表字段；未列出的列作为检验指标写入 labs
+COLUMN_MAPPING = {
+    'patient_id': 'external_id',
+    'name': 'name',
+    'age': 'age',
+    'sex': 'sex',
+    'chief_complaint': 'chief_complaint',
+    'history': 'history',
+    'medical_history': 'history',
+    'imaging_result': 'imaging',
+    'additional_notes': 'additional_notes',
+}
+
+INSERT_IMPORTED_PATIENT_SQL = '''
+    INSERT INTO patients (name, age, sex, chief_complaint, history, labs, imaging, additional_notes, external_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+MAX_REPORTED_ERRORS = 100
+
+
+class ImportFormatError(ValueError):
+    """文件格式错误（缺少必需列、无法解析等）"""
+
+
+def _is_blank(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _to_number(value: Any) -> Any:
+    """尽量把检验指标转换为数字，无法转换时保留原文"""
+    if isinstance(value, (int, float)) or _is_blank(value):
+        return value
+    text = str(value).strip()
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return int(number) if number.is_integer() and "." not in text else number
+
+
+def iter_csv_rows(stream: BinaryIO, encoding: str = "utf-8-sig") -> Tuple[List[str], Iterator[List[Any]]]:
+    """流式读取 CSV，返回 (表头, 行迭代器)"""
+    reader = csv.reader(io.TextIOWrapper(stream, encoding=encoding, newline=""))
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise ImportFormatError("文件为空")
+    except UnicodeDecodeError:
+        raise ImportFormatError(f"无法以 {encoding} 编码解析文件，可通过 encoding 参数指定（如 gbk）")
+    return [h.strip() for h in header], reader
+
+
+def iter_xlsx_rows(stream: BinaryIO) -> Tuple[List[str], Iterator[List[Any]]]:
+    """以只读模式流式读取 XLSX 第一个工作表，返回 (表头, 行迭代器)"""
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportFormatError("导入 XLSX 需要安装 openpyxl")
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    rows = workbook.worksheets[0].iter_rows(values_only=True)
+    try:
+        header = next(rows)
+    except StopIteration:
+        raise ImportFormatError("文件为空")
+    return [str(h).strip() if h is not None else "" for h in header], rows
+
+
+def row_to_params(header: List[str], values: List[Any]) -> tuple:
+    """把一行数据转换为 INSERT_IMPORTED_PATIENT_SQL 的参数，数据不合法时抛出 ValueError"""
+    record: Dict[str, Any] = {}
+    labs: Dict[str, Any] = {}
+    for column, value in zip(header, values):
+        if not column:
+            continue
+        if column in COLUMN_MAPPING:
+            if not _is_blank(value):
+                record.setdefault(COLUMN_MAPPING[column], value)
+        elif not _is_blank(value):
+            labs[column] = _to_number(value)
+
+    for field in REQUIRED_FIELDS:
+        target = COLUMN_MAPPING.get(field)
+        present = record.get(target) if target else labs.get(field)
+        if _is_blank(present):
+            raise ValueError(f"{field} 不能为空")
+    try:
+        age = int(float(record["age"]))
+    except (TypeError, ValueError):
+        raise ValueError(f"age 不是有效数字: {record['age']}")
+    if not 0 <= age <= 150:
+        raise ValueError(f"age 超出范围: {age}")
+
+    external_id = str(record["external_id"]).strip()
+    return (
+        str(record.get("name") or external_id).strip(),
+        age,
+        str(record["sex"]).strip(),
+        str(record["chief_complaint"]).strip(),
+        str(record.get("history") or ""),
+        json.dumps(labs, ensure_ascii=False, default=str),
+        str(record["imaging"]),
+        str(record.get("additional_notes") or ""),
+        external_id
+    )
+
+
+def import_patients(database: Database, header: List[str], rows: Iterator[List[Any]],
+                    skip_existing: bool = False, batch_size: int = None) -> Dict[str, Any]:
+    """
+    校验并分批写入病人数据
+
+    Returns:
+        导入统计，imported_ids 为本次写入的病人 ID（按写入顺序）
+    """
+    missing = missing_required_fields(header)
+    if missing:
+        raise ImportFormatError(f"缺失必需字段: {', '.join(missing)}")
+
+    batch_size = batch_size or config.IMPORT_BATCH_SIZE
+    stats = {"total_rows": 0, "imported": 0, "duplicates": 0, "invalid": 0, "errors": []}
+    imported_ids: List[int] = []
+    seen = set()
+    batch: List[tuple] = []
+
+    def flush():
+        if not batch:
+            return
+        with database.transaction() as conn:
+            params = batch
+            if skip_existing:
+                existing = _existing_external_ids(conn, [p[-1] for p in batch])
+                params = [p for p in batch if p[-1] not in existing]
+                stats["duplicates"] += len(batch) - len(params)
+            if params:
+                conn.executemany(INSERT_IMPORTED_PATIENT_SQL, params)
+                # 事务内独占写锁，本批写入的行 ID 连续
+                last = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                ids = range(last - len(params) + 1, last + 1)
+                imported_ids.extend(ids)
+                # labs 为第 6 个参数；主诉、既往史、影像为第 4、5、7 个参数
+                write_lab_results(conn, [(patient_id, p[5]) for patient_id, p in zip(ids, params)])
+                index_patients(conn, [(patient_id, p[3], p[4], p[6]) for patient_id, p in zip(ids, params)])
+        stats["imported"] += len(params)
+        batch.clear()
+
+    for line_number, values in enumerate(rows, start=2):
+        if values is None or all(_is_blank(v) for v in values):
+            continue
+        stats["total_rows"] += 1
+        try:
+            params = row_to_params(header, list(values))
+        except ValueError as e:
+            stats["invalid"] += 1
+            if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+                stats["errors"].append({"line": line_number, "error": str(e)})
+            continue
+        if params[-1] in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(params[-1])
+        batch.append(params)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    stats["imported_ids"] = imported_ids
+    return stats
+
+
+def _existing_external_ids(conn, external_ids: List[str]) -> set:
+    existing = set()
+    # SQLite 单条语句的参数个数有上限，分段查询
+    for i in range(0, len(external_ids), 500):
+        chunk = external_ids[i:i + 500]
+        placeholders = ",".join("?" * len(chunk))
+        existing.update(row[0] for row in conn.execute(
+            f'SELECT external_id FROM patients WHERE external_id IN ({placeholders})', chunk
+        ))
+    return existing
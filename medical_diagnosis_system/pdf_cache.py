@@ -0,0 +1,166 @@
+"""
+PDF 报告缓存 - 相同的病人信息和报告只渲染一次 PDF
+
+- 缓存键为 (病人行, 报告 ID, 模板版本) 规范化后的 SHA-256，病人信息修改、生成新报告或
+  PDF 模板升级（pdf_generator.PDF_TEMPLATE_VERSION）后自然失效
+- 渲染结果以 <病人ID>_<缓存键>.pdf 保存在 PDF_CACHE_DIR 中，重复下载直接发送文件；
+  删除病人时按文件名前缀一并删除其 PDF
+- 目录总大小超过 PDF_CACHE_MAX_BYTES 时按最近访问时间（文件 mtime）淘汰
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+import metrics
+from config import config
+from pdf_generator import PDF_TEMPLATE_VERSION
+
+PDF_SUFFIX = ".pdf"
+_KEY_PATTERN = re.compile(r"^\d+_[0-9a-f]{64}$")
+
+
+def make_pdf_key(patient_row: Sequence[Any], report_id: int) -> str:
+    """生成规范化的缓存键（病人行的第一列为病人 ID）"""
+    payload = json.dumps(
+        {"patient": list(patient_row), "report_id": report_id, "template": PDF_TEMPLATE_VERSION},
+        ensure_ascii=False, separators=(",", ":"), default=str
+    )
+    return f"{patient_row[0]}_{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+class PDFCache:
+    """基于文件目录的 PDF 缓存"""
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        self.cache_dir = cache_dir or config.PDF_CACHE_DIR
+        self.max_bytes = max_bytes or config.PDF_CACHE_MAX_BYTES
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._total_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + PDF_SUFFIX)
+
+    def lookup(self, filename: str) -> Optional[str]:
+        """按文件名（<缓存键>.pdf）查找缓存文件，供下载接口使用"""
+        key, suffix = os.path.splitext(os.path.basename(filename))
+        if suffix != PDF_SUFFIX or not _KEY_PATTERN.match(key):
+            return None
+        return self.get(key)
+
+    def get(self, key: str) -> Optional[str]:
+        """返回缓存文件路径，未命中时返回 None；命中时刷新 mtime 作为最近访问时间"""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        """写入缓存并返回文件路径，超出容量时淘汰最久未访问的文件"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        # 先写临时文件再改名，并发下载不会读到写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_size()
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+        return path
+
+    def _entries(self, prefix: str = ""):
+        """[(mtime, size, path)]，跳过并发删除的文件"""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(PDF_SUFFIX) or not entry.name.startswith(prefix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """按 mtime 从旧到新删除文件，直到总大小降到上限以内"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self._total_bytes = total
+
+    def _remove(self, prefix: str = "") -> int:
+        with self._lock:
+            deleted = 0
+            for _, _, path in self._entries(prefix):
+                try:
+                    os.remove(path)
+                    deleted += 1
+                except FileNotFoundError:
+                    pass
+            self._total_bytes = None
+            return deleted
+
+    def purge_patient(self, patient_id: int) -> int:
+        """删除某个病人的全部缓存 PDF，返回删除的文件数"""
+        return self._remove(f"{int(patient_id)}_")
+
+    def clear(self) -> int:
+        """清空缓存，返回删除的文件数"""
+        return self._remove()
+
+    def stats(self) -> Dict:
+        """缓存统计信息"""
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "files": len(entries),
+            "size_bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+# 创建全局缓存实例
+pdf_cache = PDFCache()
+
+metrics.registry.counter("pdf_cache_hits_total", "PDF 缓存命中次数", callback=lambda: pdf_cache.hits)
+metrics.registry.counter("pdf_cache_misses_total", "PDF 缓存未命中（需要渲染）次数", callback=lambda: pdf_cache.misses)
+metrics.registry.counter("pdf_cache_evictions_total", "因超出容量被淘汰的 PDF 数", callback=lambda: pdf_cache.evictions)
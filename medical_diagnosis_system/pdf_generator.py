@@ -4,13 +4,78 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_JUSTIFY
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.lib.fonts import addMapping
 from datetime import datetime
+import io
 import json
+import os
+import threading
+
+from config import config
+from report_markdown import BULLET_STYLES, parse_report, to_flowables
+
+# PDF 版式/模板版本，修改版式后递增，使 pdf_cache 中按旧版式渲染的文件失效
+PDF_TEMPLATE_VERSION = 3
+
+# 未配置 PDF_FONT_PATH 时使用 ReportLab 内置的 CID 中文字体（无需字体文件，由阅读器提供字形）
+CJK_CID_FONT = "STSong-Light"
+
+_fonts = None
+_fonts_lock = threading.Lock()
+
+
+def register_cjk_fonts():
+    """
+    注册中文字体（每个进程只注册一次），返回 (常规字体名, 粗体字体名)
+
+    配置了 PDF_FONT_PATH（TTF/TTC 文件，如思源黑体、微软雅黑）时嵌入该字体，
+    PDF_FONT_BOLD_PATH 可另外指定粗体；否则使用内置 CID 字体，粗体与常规字体相同。
+    """
+    global _fonts
+    with _fonts_lock:
+        if _fonts is not None:
+            return _fonts
+        regular = bold = None
+        if config.PDF_FONT_PATH and os.path.exists(config.PDF_FONT_PATH):
+            try:
+                pdfmetrics.registerFont(TTFont("ReportCJK", config.PDF_FONT_PATH))
+                regular = bold = "ReportCJK"
+                if config.PDF_FONT_BOLD_PATH and os.path.exists(config.PDF_FONT_BOLD_PATH):
+                    pdfmetrics.registerFont(TTFont("ReportCJK-Bold", config.PDF_FONT_BOLD_PATH))
+                    bold = "ReportCJK-Bold"
+            except Exception as e:
+                print(f"⚠️ 加载字体 {config.PDF_FONT_PATH} 失败，改用内置中文字体: {e}")
+                regular = bold = None
+        if regular is None:
+            pdfmetrics.registerFont(UnicodeCIDFont(CJK_CID_FONT))
+            regular = bold = CJK_CID_FONT
+        # 使 Paragraph 中的 <b> 标签映射到粗体
+        addMapping(regular, 0, 0, regular)
+        addMapping(regular, 1, 0, bold)
+        addMapping(regular, 0, 1, regular)
+        addMapping(regular, 1, 1, bold)
+        _fonts = (regular, bold)
+        return _fonts
+
 
 class MedicalReportPDFGenerator:
+    """
+    PDF 报告渲染器
+
+    字体、段落样式和表格样式在构造时准备一次，generate_pdf 不修改它们，
+    同一个实例可以在多个线程中反复使用（见 get_pdf_renderer）。
+    """
+
     def __init__(self):
+        self.font, self.bold_font = register_cjk_fonts()
         self.styles = getSampleStyleSheet()
         self.setup_custom_styles()
+        self.setup_table_styles()
+        # SimpleDocTemplate 默认左右页边距各 1 英寸
+        self.content_width = A4[0] - 2 * inch
     
     def setup_custom_styles(self):
         """设置自定义样式"""
@@ -22,6 +87,7 @@ class MedicalReportPDFGenerator:
             self.styles.add(ParagraphStyle(
                 name='CustomTitle',
                 parent=self.styles['Heading1'],
+                fontName=self.bold_font,
                 fontSize=18,
                 spaceAfter=30,
                 alignment=TA_CENTER,
@@ -33,6 +99,7 @@ class MedicalReportPDFGenerator:
             self.styles.add(ParagraphStyle(
                 name='SectionTitle',
                 parent=self.styles['Heading2'],
+                fontName=self.bold_font,
                 fontSize=14,
                 spaceAfter=12,
                 spaceBefore=20,
@@ -47,22 +114,38 @@ class MedicalReportPDFGenerator:
             self.styles.add(ParagraphStyle(
                 name='SubSectionTitle',
                 parent=self.styles['Heading3'],
+                fontName=self.bold_font,
                 fontSize=12,
                 spaceAfter=8,
                 spaceBefore=12,
                 textColor=colors.darkgreen
             ))
         
-        # 正文样式
+        # 报告中 ### 及以下的小标题
+        if 'MinorSectionTitle' not in style_names:
+            self.styles.add(ParagraphStyle(
+                name='MinorSectionTitle',
+                parent=self.styles['Heading4'],
+                fontName=self.bold_font,
+                fontSize=11,
+                spaceAfter=6,
+                spaceBefore=8,
+                textColor=colors.black
+            ))
+        
+        # 正文样式（CJK 换行规则：中文可在任意字符间断行）
         if 'CustomBodyText' not in style_names:
             self.styles.add(ParagraphStyle(
                 name='CustomBodyText',
                 parent=self.styles['Normal'],
+                fontName=self.font,
                 fontSize=10,
+                leading=15,
                 spaceAfter=6,
                 alignment=TA_JUSTIFY,
                 leftIndent=0,
-                rightIndent=0
+                rightIndent=0,
+                wordWrap='CJK'
             ))
         
         # 病人信息样式
@@ -70,14 +153,79 @@ class MedicalReportPDFGenerator:
             self.styles.add(ParagraphStyle(
                 name='PatientInfo',
                 parent=self.styles['Normal'],
+                fontName=self.font,
                 fontSize=10,
                 spaceAfter=4,
                 leftIndent=20,
-                textColor=colors.darkblue
+                textColor=colors.darkblue,
+                wordWrap='CJK'
+            ))
+        
+        # 报告中的列表项，按缩进层级
+        for depth, name in enumerate(BULLET_STYLES):
+            if name not in style_names:
+                self.styles.add(ParagraphStyle(
+                    name=name,
+                    parent=self.styles['CustomBodyText'],
+                    alignment=TA_LEFT,
+                    leftIndent=14 * (depth + 1),
+                    bulletIndent=14 * depth + 2,
+                    spaceAfter=3
+                ))
+        
+        # 报告中表格的单元格
+        if 'TableCell' not in style_names:
+            self.styles.add(ParagraphStyle(
+                name='TableCell',
+                parent=self.styles['Normal'],
+                fontName=self.font,
+                fontSize=9,
+                leading=12,
+                wordWrap='CJK'
             ))
+    
+    def setup_table_styles(self):
+        """设置表格样式"""
+        self.patient_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (0, -1), colors.lightblue),
+            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (0, -1), self.bold_font),
+            ('FONTNAME', (1, 0), (1, -1), self.font),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
+            ('BACKGROUND', (0, 0), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black)
+        ])
+        self.labs_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), self.bold_font),
+            ('FONTNAME', (0, 1), (-1, -1), self.font),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+            ('BACKGROUND', (0, 1), (-1, -1), colors.lightgrey),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black)
+        ])
+        self.report_table_style = TableStyle([
+            ('FONTNAME', (0, 0), (-1, 0), self.bold_font),
+            ('FONTNAME', (0, 1), (-1, -1), self.font),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey)
+        ])
 
-    def generate_pdf(self, patient_data, report_content, output_path):
-        """生成PDF报告"""
+    def generate_pdf(self, patient_data, report_content, output_path, generated_at=None, report_id=None):
+        """
+        生成PDF报告
+
+        Args:
+            output_path: 文件路径或可写的文件对象（如 BytesIO）
+            generated_at: 报告生成时间，默认为当前时间；传入报告的创建时间可使相同报告的 PDF 内容一致
+            report_id: 报告 ID，提供时复用缓存的报告解析结果
+        """
         doc = SimpleDocTemplate(output_path, pagesize=A4)
         story = []
         
@@ -87,7 +235,7 @@ class MedicalReportPDFGenerator:
         story.append(Spacer(1, 20))
         
         # 添加生成时间
-        current_time = datetime.now().strftime("%Y年%m月%d日 %H:%M:%S")
+        current_time = (generated_at or datetime.now()).strftime("%Y年%m月%d日 %H:%M:%S")
         time_para = Paragraph(f"报告生成时间：{current_time}", self.styles['CustomBodyText'])
         story.append(time_para)
         story.append(Spacer(1, 20))
@@ -107,17 +255,7 @@ class MedicalReportPDFGenerator:
         ]
         
         patient_table = Table(patient_info_data, colWidths=[1.5*inch, 4*inch])
-        patient_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (0, -1), colors.lightblue),
-            ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-            ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 12),
-            ('BACKGROUND', (0, 0), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
+        patient_table.setStyle(self.patient_table_style)
         
         story.append(patient_table)
         story.append(Spacer(1, 20))
@@ -133,17 +271,7 @@ class MedicalReportPDFGenerator:
                 labs_data.append([key, str(value), ref_range])
             
             labs_table = Table(labs_data, colWidths=[1.5*inch, 1*inch, 2*inch])
-            labs_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 0), (-1, -1), 9),
-                ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.lightgrey),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black)
-            ]))
+            labs_table.setStyle(self.labs_table_style)
             
             story.append(labs_table)
             story.append(Spacer(1, 20))
@@ -152,7 +280,7 @@ class MedicalReportPDFGenerator:
         story.append(Paragraph("三、诊疗报告", self.styles['SectionTitle']))
         
         # 解析报告内容并格式化
-        formatted_report = self.format_report_content(report_content)
+        formatted_report = self.format_report_content(report_content, report_id)
         for section in formatted_report:
             story.append(section)
         
@@ -183,49 +311,92 @@ class MedicalReportPDFGenerator:
         }
         return reference_ranges.get(test_name, '请参考实验室标准')
     
-    def format_report_content(self, report_content):
-        """格式化报告内容"""
-        sections = []
-        lines = report_content.split('\n')
-        
-        current_section = []
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            
-            # 检测章节标题
-            if line.startswith('##') or line.startswith('**') and '**' in line:
-                if current_section:
-                    sections.append(Paragraph('\n'.join(current_section), self.styles['CustomBodyText']))
-                    current_section = []
-                
-                # 清理标题格式
-                title_text = line.replace('##', '').replace('**', '').strip()
-                if title_text:
-                    sections.append(Paragraph(title_text, self.styles['SubSectionTitle']))
-            
-            # 检测子标题
-            elif line.startswith('###') or (line.startswith('-') and ':' in line):
-                if current_section:
-                    sections.append(Paragraph('\n'.join(current_section), self.styles['CustomBodyText']))
-                    current_section = []
-                
-                title_text = line.replace('###', '').replace('-', '').strip()
-                if title_text:
-                    sections.append(Paragraph(f"• {title_text}", self.styles['CustomBodyText']))
-            
-            else:
-                current_section.append(line)
-        
-        # 添加最后一部分
-        if current_section:
-            sections.append(Paragraph('\n'.join(current_section), self.styles['CustomBodyText']))
-        
-        return sections
+    def format_report_content(self, report_content, report_id=None):
+        """把 Markdown 格式的报告内容编译为 flowable 列表（见 report_markdown.py）"""
+        blocks = parse_report(report_content, report_id)
+        return to_flowables(blocks, self.styles, self.report_table_style, self.content_width)
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_pdf_renderer():
+    """进程内共享的渲染器，字体和样式只准备一次"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = MedicalReportPDFGenerator()
+        return _renderer
 
 def generate_medical_report_pdf(patient_data, report_content, output_path):
     """生成医疗报告PDF的便捷函数"""
-    generator = MedicalReportPDFGenerator()
-    generator.generate_pdf(patient_data, report_content, output_path)
+    get_pdf_renderer().generate_pdf(patient_data, report_content, output_path)
     return output_path
+
+def render_medical_report_pdf(patient_data, report_content, generated_at=None, report_id=None):
+    """在内存中生成医疗报告PDF，返回PDF字节"""
+    buffer = io.BytesIO()
+    get_pdf_renderer().generate_pdf(patient_data, report_content, buffer, generated_at, report_id)
+    return buffer.getvalue()
+
+
+# 基准测试：python pdf_generator.py [--save 目录]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    sample_patient = {
+        "name": "张三", "age": 58, "sex": "男",
+        "chief_complaint": "右上腹隐痛3月，伴食欲减退、乏力",
+        "history": "乙肝病史20年，高血压5年",
+        "labs": {"ALT": 56, "AST": 48, "总胆红素": 18.2, "白蛋白": 38, "AFP": "420 ng/mL"},
+        "imaging": "CT 示肝右叶 4.5cm 占位，动脉期强化、门脉期廓清",
+        "additional_notes": "无"
+    }
+    section = (
+        "## 一、疾病分析\n### 西医诊断分析\n"
+        "- 可能诊断：原发性肝细胞癌（BCLC A 期），依据为乙肝病史、AFP 明显升高及典型影像学表现\n"
+        + "患者肝功能 Child-Pugh A 级，肿瘤单发、无血管侵犯，具备根治性手术条件，建议完善术前评估。" * 3 + "\n"
+        "### 中医辨证分析\n- 证型：肝郁脾虚、湿热蕴结\n"
+        + "治以疏肝健脾、清热利湿，方选逍遥散合茵陈蒿汤加减，配合饮食调理。" * 3 + "\n"
+    )
+
+    def count_pages(data):
+        return data.count(b"/Type /Page") - data.count(b"/Type /Pages")
+
+    save_dir = sys.argv[sys.argv.index("--save") + 1] if "--save" in sys.argv else None
+    print("📄 PDF 渲染基准测试")
+    print("=" * 50)
+
+    start = time.perf_counter()
+    renderer = get_pdf_renderer()
+    print(f"渲染器准备（字体注册 + 样式）: {(time.perf_counter() - start) * 1000:.1f}ms，字体: {renderer.font}")
+
+    start = time.perf_counter()
+    for _ in range(20):
+        MedicalReportPDFGenerator()
+    print(f"每次新建渲染器的开销（旧实现每个 PDF 都要付出）: {(time.perf_counter() - start) / 20 * 1000:.2f}ms")
+
+    # 先测出每页约容纳多少段，再按目标页数生成报告
+    calibration = 20
+    base_pages = count_pages(render_medical_report_pdf(sample_patient, section.splitlines()[0]))
+    sections_per_page = calibration / (count_pages(render_medical_report_pdf(sample_patient, section * calibration)) - base_pages)
+
+    def report_for_pages(pages):
+        if pages <= base_pages:
+            return section.splitlines()[0]
+        return section * max(1, round((pages - base_pages) * sections_per_page))
+
+    for pages in (1, 10, 100):
+        content = report_for_pages(pages)
+        runs = 5 if pages < 100 else 2
+        data = render_medical_report_pdf(sample_patient, content)  # 预热
+        start = time.perf_counter()
+        for _ in range(runs):
+            data = render_medical_report_pdf(sample_patient, content)
+        elapsed = (time.perf_counter() - start) / runs
+        actual = count_pages(data)
+        print(f"{actual:>4} 页: {elapsed * 1000:8.1f}ms/份，{elapsed / actual * 1000:6.2f}ms/页，{len(data) // 1024}KB")
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+            with open(os.path.join(save_dir, f"benchmark_{pages}.pdf"), "wb") as f:
+                f.write(data)
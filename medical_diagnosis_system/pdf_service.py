@@ -0,0 +1,140 @@
+"""
+PDF 渲染服务 - 在独立的进程池中渲染 PDF，ReportLab 排版不再占用事件循环和 GIL
+
+- 工作进程启动时预先导入 ReportLab、注册字体并准备样式（warm worker），之后每个 PDF 只付排版开销
+- 工作进程由 forkserver 派生（Windows 等不支持时用 spawn），不继承主进程中的数据库连接和后台线程；
+  forkserver 预先导入 ReportLab，新的工作进程直接继承已导入的模块
+- 调用方 await render() 即可，渲染期间其他请求（对话、流式报告等）照常处理
+- PDF_RENDER_WORKERS=0 时退回线程中渲染（适合只有单核的部署环境）
+"""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+import metrics
+from config import config
+
+RENDER_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PDF_RENDER_QUEUE = metrics.registry.gauge("pdf_render_queue_depth", "已提交、尚未完成的 PDF 渲染任务数")
+PDF_RENDER_SECONDS = metrics.registry.histogram(
+    "pdf_render_duration_seconds", "工作进程中单个 PDF 的渲染耗时", buckets=RENDER_BUCKETS
+)
+PDF_RENDER_WAIT_SECONDS = metrics.registry.histogram(
+    "pdf_render_wait_seconds", "PDF 渲染任务从提交到完成的总耗时（含排队）", buckets=RENDER_BUCKETS
+)
+PDF_RENDER_ERRORS = metrics.registry.counter("pdf_render_errors_total", "PDF 渲染失败次数")
+
+
+def _mp_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["__main__", "pdf_generator"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def _warm_worker():
+    """工作进程初始化：导入 ReportLab、注册字体、准备样式"""
+    from pdf_generator import get_pdf_renderer
+    get_pdf_renderer()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _render(patient_data: Dict[str, Any], report_content: str, generated_at: Optional[datetime],
+            report_id: Optional[int]) -> Tuple[bytes, float]:
+    """在工作进程中渲染，返回 (PDF 字节, 渲染耗时)"""
+    from pdf_generator import render_medical_report_pdf
+    start = time.perf_counter()
+    data = render_medical_report_pdf(patient_data, report_content, generated_at, report_id)
+    return data, time.perf_counter() - start
+
+
+class PDFRenderService:
+    """基于进程池的 PDF 渲染服务"""
+
+    def __init__(self, workers: int = None):
+        self.workers = workers if workers is not None else config.PDF_RENDER_WORKERS
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=_mp_context(),
+                    initializer=_warm_worker
+                )
+            return self._pool
+
+    def _reset_pool(self, broken: ProcessPoolExecutor):
+        """工作进程异常退出（如被 OOM 杀死）后丢弃整个进程池，下次调用时重建"""
+        with self._lock:
+            if self._pool is broken:
+                self._pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def start(self):
+        """启动并预热全部工作进程（应用启动时调用）"""
+        if self.workers <= 0:
+            await asyncio.to_thread(_warm_worker)
+            return
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        # 连续提交 workers 个任务，每个任务都会拉起一个新的工作进程
+        await asyncio.gather(*[loop.run_in_executor(pool, _ping) for _ in range(self.workers)])
+
+    async def render(self, patient_data: Dict[str, Any], report_content: str,
+                     generated_at: Optional[datetime] = None, report_id: Optional[int] = None) -> bytes:
+        """渲染 PDF 并返回其字节（提供 report_id 时工作进程复用该报告缓存的解析结果）"""
+        self.pending += 1
+        PDF_RENDER_QUEUE.set(self.pending)
+        start = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                data, seconds = await asyncio.to_thread(_render, patient_data, report_content, generated_at, report_id)
+            else:
+                data, seconds = await self._render_in_pool(patient_data, report_content, generated_at, report_id)
+        except Exception:
+            PDF_RENDER_ERRORS.inc()
+            raise
+        finally:
+            self.pending -= 1
+            PDF_RENDER_QUEUE.set(self.pending)
+        PDF_RENDER_SECONDS.observe(seconds)
+        PDF_RENDER_WAIT_SECONDS.observe(time.perf_counter() - start)
+        return data
+
+    async def _render_in_pool(self, *args) -> Tuple[bytes, float]:
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = self._get_pool()
+            try:
+                return await loop.run_in_executor(pool, _render, *args)
+            except BrokenProcessPool:
+                self._reset_pool(pool)
+                if attempt:
+                    raise
+
+    def close(self):
+        """关闭进程池（应用关闭时调用）"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+# 创建全局渲染服务
+pdf_service = PDFRenderService()
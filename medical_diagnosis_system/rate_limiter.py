@@ -0,0 +1,183 @@
+"""
+上游限流与背压 - 保护 DashScope 上游，避免流量高峰时 429/超时级联成 500
+
+- 令牌桶同时限制每分钟请求数和每分钟 token 数
+- 超出速率的请求进入有界优先队列，交互式对话优先于批量报告
+- 队列已满时立即失败（UpstreamOverloadedError，附带建议的 Retry-After）
+- 收到 429 时自动降低放行速率，之后随成功请求逐步恢复
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import time
+from typing import List, Optional
+
+from config import config
+
+# 优先级：数值越小越先放行
+PRIORITY_INTERACTIVE = 0  # /chat 等交互式请求
+PRIORITY_DEFAULT = 1  # 单个报告生成等
+PRIORITY_BATCH = 2  # 批量报告、后台任务
+
+
+class UpstreamOverloadedError(Exception):
+    """上游繁忙（队列已满或多次限流重试失败）"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数，capacity 为桶容量"""
+
+    def __init__(self, per_minute: float):
+        self.base_rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.scale = 1.0
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.base_rate > 0
+
+    @property
+    def rate(self) -> float:
+        return self.base_rate * self.scale
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """距离可取出 amount 个令牌还需等待的秒数"""
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def take(self, amount: float):
+        if self.enabled:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount: float):
+        if self.enabled and amount > 0:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class AdaptiveRateLimiter:
+    """带优先级等待队列的自适应限流器"""
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None,
+                 max_queue: int = None, min_scale: float = 0.1):
+        self.requests = TokenBucket(requests_per_minute if requests_per_minute is not None
+                                    else config.LLM_REQUESTS_PER_MINUTE)
+        self.tokens = TokenBucket(tokens_per_minute if tokens_per_minute is not None
+                                  else config.LLM_TOKENS_PER_MINUTE)
+        self.max_queue = max_queue if max_queue is not None else config.LLM_QUEUE_MAX
+        self.min_scale = min_scale
+
+        self._waiters: List[list] = []  # [priority, seq, future, tokens]
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.rejected = 0
+        self.throttled = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for w in self._waiters if not w[2].done())
+
+    @property
+    def scale(self) -> float:
+        return self.requests.scale
+
+    def retry_after(self) -> float:
+        """按当前放行速率估算排到队尾所需的秒数"""
+        rate = self.requests.rate if self.requests.enabled else 1.0
+        return (self.queue_depth + 1) / rate if rate > 0 else 60.0
+
+    def ensure_capacity(self):
+        """队列已满时立即抛出，用于流式响应开始前的快速失败"""
+        if self.queue_depth >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamOverloadedError("大模型请求排队已满，请稍后重试", self.retry_after())
+
+    async def acquire(self, tokens: int = 0, priority: int = PRIORITY_DEFAULT):
+        """按优先级等待放行；队列已满时抛出 UpstreamOverloadedError"""
+        if not self._waiters and self._ready(tokens):
+            self._take(tokens)
+            return
+
+        self.ensure_capacity()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._seq), future, tokens])
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已被放行、尚未恢复执行时被取消：令牌已经扣除，需要退还
+            if future.done() and not future.cancelled():
+                self.refund(tokens)
+            raise
+
+    def refund(self, tokens: int = 0):
+        """放行后没有发出请求（如调用方被取消）：退还请求次数和预留的 token"""
+        self.requests.give_back(1)
+        self.tokens.give_back(tokens)
+
+    def release_unused(self, reserved_tokens: int, used_tokens: Optional[int]):
+        """请求完成后按实际用量退回多预留的 token"""
+        if used_tokens is not None:
+            self.tokens.give_back(reserved_tokens - used_tokens)
+
+    def on_throttled(self):
+        """收到 429：放行速率减半（不低于 min_scale）"""
+        self.throttled += 1
+        for bucket in (self.requests, self.tokens):
+            bucket.scale = max(self.min_scale, bucket.scale * 0.5)
+
+    def on_success(self):
+        """请求成功：放行速率逐步恢复"""
+        for bucket in (self.requests, self.tokens):
+            if bucket.scale < 1.0:
+                bucket.scale = min(1.0, bucket.scale + 0.05)
+
+    def _ready(self, tokens: int) -> bool:
+        return self.requests.wait_time(1) <= 0 and self.tokens.wait_time(tokens) <= 0
+
+    def _take(self, tokens: int):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    async def _dispatch(self):
+        """按优先级依次放行等待者"""
+        while self._waiters:
+            priority, seq, future, tokens = self._waiters[0]
+            if future.done():  # 等待方已取消
+                heapq.heappop(self._waiters)
+                continue
+            delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._waiters)
+            self._take(tokens)
+            future.set_result(None)
+
+
+def backoff_delay(attempt: int, base: float = None, cap: float = None) -> float:
+    """带完全抖动的指数退避时间（秒）"""
+    base = base if base is not None else config.LLM_RETRY_BASE_DELAY
+    cap = cap if cap is not None else config.LLM_RETRY_MAX_DELAY
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,432 @@
+"""
+报告 Markdown 编译器 - 一次扫描把大模型生成的报告解析为块，再编译为 PDF flowable 或 HTML
+
+- 支持标题（# ~ ######，以及整行加粗的 **小标题**）、无序/有序列表（按缩进分级）、段落、
+  **加粗** / *斜体*、管道表格和分隔线
+- 正文先转义 & < >，"AFP <20 ng/mL" 这类内容不会破坏 ReportLab 的段落标记
+- 段落内的换行保留为 <br/>（ReportLab 会忽略段落文本中的 \\n）
+- 解析结果按报告 ID 缓存，PDF 和 Streamlit 的 HTML 预览共用；ReportLab 的 flowable 在排版时
+  会被拆分修改，不能跨文档复用，因此每次渲染从缓存的块重新生成
+- 编译 PDF 时直接构造 Paragraph 的片段，不再经过 ReportLab 逐段落的标记解析
+- 只有编译 PDF 时才导入 ReportLab
+"""
+
+import html
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from config import config
+
+# PDF 中使用的段落样式名（由 pdf_generator.MedicalReportPDFGenerator 定义）
+HEADING_STYLE = "SubSectionTitle"
+MINOR_HEADING_STYLE = "MinorSectionTitle"
+BODY_STYLE = "CustomBodyText"
+BULLET_STYLES = ("ReportBullet1", "ReportBullet2", "ReportBullet3")
+TABLE_CELL_STYLE = "TableCell"
+
+# 整行加粗的小标题按 4 级标题处理
+BOLD_LINE_LEVEL = 4
+
+
+class Block(NamedTuple):
+    """解析出的一个块；text / rows 中已是转换好的内联标记（<b>、<i>、<br/>）"""
+    kind: str  # heading / paragraph / bullet / table / rule
+    text: str = ""
+    level: int = 0  # 标题级别或列表缩进层级（从 0 开始）
+    marker: str = ""  # 有序列表的序号，如 "1."；无序列表为空
+    rows: Tuple[Tuple[str, ...], ...] = ()  # 表格行，第一行为表头
+
+
+_HEADING = re.compile(r"(#{1,6})\s+(.*?)\s*#*$")
+# 中文编号 "1、" 后面常常不带空格
+_BULLET = re.compile(r"(?:([-*+•])\s+|(\d{1,3}[.)])\s+|(\d{1,3}、)\s*)(.*)$")
+_BOLD_LINE = re.compile(r"\*\*([^*]+)\*\*\s*[:：]?$")
+_RULE = re.compile(r"(?:-{3,}|\*{3,}|_{3,})$")
+_TABLE_SEPARATOR = re.compile(r"\|?(?:\s*:?-+:?\s*\|)+\s*(?::?-+:?\s*)?$")
+_INLINE = re.compile(r"\*\*(.+?)\*\*|__(.+?)__|(?<![\w*])\*(?![\s*])(.+?)(?<![\s*])\*(?!\*)|`([^`]+)`")
+
+
+def _inline_replace(match) -> str:
+    bold = match.group(1) or match.group(2)
+    if bold is not None:
+        return f"<b>{bold}</b>"
+    if match.group(3) is not None:
+        return f"<i>{match.group(3)}</i>"
+    return match.group(4)
+
+
+def inline_markup(text: str) -> str:
+    """转义并转换内联格式：**加粗**、*斜体*，`代码` 只去掉反引号"""
+    return _INLINE.sub(_inline_replace, html.escape(text, quote=False))
+
+
+def _table_cells(line: str) -> List[str]:
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    return [inline_markup(cell.strip()) for cell in line.split("|")]
+
+
+def parse_markdown(text: str) -> List[Block]:
+    """一次扫描把 Markdown 文本解析为块列表"""
+    blocks: List[Block] = []
+    paragraph: List[str] = []
+    table: List[str] = []
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append(Block("paragraph", "<br/>".join(paragraph)))
+            paragraph.clear()
+
+    def flush_table():
+        if not table:
+            return
+        if len(table) >= 2 and _TABLE_SEPARATOR.match(table[1]):
+            header = _table_cells(table[0])
+            rows = [tuple(header)]
+            for line in table[2:]:
+                cells = _table_cells(line)
+                cells = (cells + [""] * len(header))[:len(header)]
+                rows.append(tuple(cells))
+            blocks.append(Block("table", rows=tuple(rows)))
+        else:
+            # 不是表格，按普通段落处理
+            blocks.append(Block("paragraph", "<br/>".join(inline_markup(line) for line in table)))
+        table.clear()
+
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            flush_paragraph()
+            flush_table()
+            continue
+
+        first = line[0]
+        if first == "|":
+            flush_paragraph()
+            table.append(line)
+            continue
+        flush_table()
+
+        if first == "#":
+            match = _HEADING.match(line)
+            if match:
+                flush_paragraph()
+                if match.group(2):
+                    blocks.append(Block("heading", inline_markup(match.group(2)), len(match.group(1))))
+                continue
+        elif first in "-*_" and _RULE.match(line):
+            flush_paragraph()
+            blocks.append(Block("rule"))
+            continue
+
+        if first in "-*+•" or first.isdigit():
+            match = _BULLET.match(line)
+            if match:
+                flush_paragraph()
+                indent = len(raw.expandtabs(4)) - len(raw.expandtabs(4).lstrip())
+                blocks.append(Block(
+                    "bullet", inline_markup(match.group(4)), min(indent // 2, len(BULLET_STYLES) - 1),
+                    match.group(2) or match.group(3) or ""
+                ))
+                continue
+
+        if first == "*":
+            match = _BOLD_LINE.match(line)
+            if match:
+                flush_paragraph()
+                blocks.append(Block("heading", inline_markup(match.group(1).strip()), BOLD_LINE_LEVEL))
+                continue
+
+        paragraph.append(inline_markup(line))
+
+    flush_paragraph()
+    flush_table()
+    return blocks
+
+
+_cache: "OrderedDict[Tuple[Any, int], List[Block]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def parse_report(content: str, report_id: Optional[int] = None) -> List[Block]:
+    """解析报告，提供 report_id 时按 (报告 ID, 正文哈希) 缓存解析结果"""
+    if report_id is None:
+        return parse_markdown(content)
+    key = (report_id, hash(content))
+    with _cache_lock:
+        blocks = _cache.get(key)
+        if blocks is not None:
+            _cache.move_to_end(key)
+            return blocks
+    blocks = parse_markdown(content)
+    with _cache_lock:
+        _cache[key] = blocks
+        while len(_cache) > config.REPORT_MARKDOWN_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return blocks
+
+
+# ---------- 编译 ----------
+
+# 单元格左右内边距之和（Table 默认各 6pt）
+_CELL_PADDING = 12
+
+_MARKUP_TAG = re.compile(r"(<b>|</b>|<i>|</i>|<br/>)")
+_WHITESPACE = re.compile(r"\s{2,}|[^\S ]")
+# 以样式对象本身为键（弱引用），样式被回收后缓存随之清除，不会因 id() 复用取到别的样式的字体
+_frag_templates = weakref.WeakKeyDictionary()
+
+
+def _templates(style):
+    """
+    用 ReportLab 自己的解析器为每个样式解析一次样板标记，得到普通 / 粗体 / 斜体 / 粗斜体
+    和换行的片段（frag）模板；字体映射（addMapping）等细节都与 Paragraph 的解析结果一致
+    """
+    templates = _frag_templates.get(style)
+    if templates is None:
+        from reportlab.platypus.paraparser import ParaParser
+
+        def frags(markup):
+            return ParaParser().parse(markup, style)[1]
+
+        templates = {
+            (False, False): frags("x")[0],
+            (True, False): frags("<b>x</b>")[0],
+            (False, True): frags("<i>x</i>")[0],
+            (True, True): frags("<b><i>x</i></b>")[0],
+            "br": frags("x<br/>x")[1],
+        }
+        _frag_templates[style] = templates
+    return templates
+
+
+def _paragraph(text: str, style, bullet_text: Optional[str] = None):
+    """
+    由内联标记（只含本模块生成的 <b>、<i>、<br/> 和转义字符）直接构造 Paragraph 的片段，
+    跳过 ReportLab 逐段落的 XML 标记解析（编译时间的大头）；空白同解析器一样合并为一个空格
+    """
+    from reportlab.platypus import Paragraph
+
+    templates = _templates(style)
+    frags = []
+    bold = italic = False
+    for i, part in enumerate(_MARKUP_TAG.split(text)):
+        if i % 2:
+            if part == "<br/>":
+                frags.append(templates["br"].clone())
+            else:
+                opening = part[1] != "/"
+                if part[-2] == "b":
+                    bold = opening
+                else:
+                    italic = opening
+        elif part:
+            frags.append(templates[(bold, italic)].clone(text=_WHITESPACE.sub(" ", html.unescape(part))))
+    if not frags:
+        frags.append(templates[(False, False)].clone(text=""))
+    return Paragraph(text, style, bulletText=bullet_text, frags=frags)
+
+
+def _table_cell(text: str, style, col_width: Optional[float], bold: bool = False):
+    """
+    表格单元格：没有内联标记且一行放得下的文本直接用字符串（字体由表格样式指定），
+    省去 Paragraph 的标记解析；其余用 Paragraph 以便换行
+    """
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    if ("<" not in text and "&" not in text and col_width
+            and stringWidth(text, style.fontName, style.fontSize) <= col_width - _CELL_PADDING):
+        return text
+    return _paragraph(f"<b>{text}</b>" if bold else text, style)
+
+
+def to_flowables(blocks: List[Block], styles, table_style=None, width: float = None) -> list:
+    """
+    编译为 ReportLab flowable 列表
+
+    Args:
+        blocks: parse_markdown / parse_report 的结果
+        styles: 包含本模块所用样式名的样式表
+        table_style: 表格的 TableStyle，需为纯文本单元格指定字体（表头为粗体）
+        width: 可用宽度，表格各列平分
+    """
+    from reportlab.platypus import Table
+    from reportlab.platypus.flowables import HRFlowable
+
+    heading, minor_heading, body = styles[HEADING_STYLE], styles[MINOR_HEADING_STYLE], styles[BODY_STYLE]
+    bullets = [styles[name] for name in BULLET_STYLES]
+    cell = styles[TABLE_CELL_STYLE]
+
+    flowables = []
+    for block in blocks:
+        kind = block.kind
+        if kind == "paragraph":
+            flowables.append(_paragraph(block.text, body))
+        elif kind == "bullet":
+            flowables.append(_paragraph(block.text, bullets[block.level], block.marker or "•"))
+        elif kind == "heading":
+            flowables.append(_paragraph(block.text, heading if block.level <= 2 else minor_heading))
+        elif kind == "table":
+            header, *rows = block.rows
+            col_width = width / len(header) if width else None
+            data = [[_table_cell(text, cell, col_width, bold=True) for text in header]]
+            data.extend([_table_cell(text, cell, col_width) for text in row] for row in rows)
+            table = Table(data, colWidths=[col_width] * len(header) if width else None, repeatRows=1)
+            if table_style is not None:
+                table.setStyle(table_style)
+            flowables.append(table)
+        elif kind == "rule":
+            flowables.append(HRFlowable(width="100%", thickness=0.5, spaceBefore=4, spaceAfter=4))
+    return flowables
+
+
+def to_html(blocks: List[Block]) -> str:
+    """编译为 HTML 片段（Streamlit 中用 st.markdown(..., unsafe_allow_html=True) 显示）"""
+    out: List[str] = []
+    lists: List[str] = []  # 当前打开的 <ul> / <ol>
+
+    for block in blocks:
+        if block.kind == "bullet":
+            tag = "ol" if block.marker else "ul"
+            while len(lists) > block.level + 1:
+                out.append(f"</{lists.pop()}>")
+            if len(lists) == block.level + 1 and lists[-1] != tag:
+                out.append(f"</{lists.pop()}>")
+            while len(lists) < block.level + 1:
+                lists.append(tag)
+                out.append(f"<{tag}>")
+            out.append(f"<li>{block.text}</li>")
+            continue
+        while lists:
+            out.append(f"</{lists.pop()}>")
+
+        if block.kind == "paragraph":
+            out.append(f"<p>{block.text}</p>")
+        elif block.kind == "heading":
+            out.append(f"<h{block.level}>{block.text}</h{block.level}>")
+        elif block.kind == "table":
+            header, *rows = block.rows
+            out.append("<table><thead><tr>" + "".join(f"<th>{text}</th>" for text in header) + "</tr></thead><tbody>")
+            out.extend("<tr>" + "".join(f"<td>{text}</td>" for text in row) + "</tr>" for row in rows)
+            out.append("</tbody></table>")
+        elif block.kind == "rule":
+            out.append("<hr/>")
+
+    while lists:
+        out.append(f"</{lists.pop()}>")
+    return "\n".join(out)
+
+
+def report_html(content: str, report_id: Optional[int] = None) -> str:
+    """报告的 HTML 预览"""
+    return to_html(parse_report(content, report_id))
+
+
+def _legacy_format_report_content(report_content, styles):
+    """旧版 MedicalReportPDFGenerator.format_report_content，仅供基准测试对比"""
+    from reportlab.platypus import Paragraph
+
+    sections = []
+    lines = report_content.split('\n')
+
+    current_section = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith('##') or line.startswith('**') and '**' in line:
+            if current_section:
+                sections.append(Paragraph('\n'.join(current_section), styles['CustomBodyText']))
+                current_section = []
+            title_text = line.replace('##', '').replace('**', '').strip()
+            if title_text:
+                sections.append(Paragraph(title_text, styles['SubSectionTitle']))
+
+        elif line.startswith('###') or (line.startswith('-') and ':' in line):
+            if current_section:
+                sections.append(Paragraph('\n'.join(current_section), styles['CustomBodyText']))
+                current_section = []
+            title_text = line.replace('###', '').replace('-', '').strip()
+            if title_text:
+                sections.append(Paragraph(f"• {title_text}", styles['CustomBodyText']))
+
+        else:
+            current_section.append(line)
+
+    if current_section:
+        sections.append(Paragraph('\n'.join(current_section), styles['CustomBodyText']))
+    return sections
+
+
+# 基准测试：python report_markdown.py [行数]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from pdf_generator import get_pdf_renderer
+
+    target_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    section = """## 一、疾病分析
+### 西医诊断分析
+- 可能诊断：原发性肝细胞癌，依据为**乙肝病史**、AFP 明显升高及典型影像学表现
+- 疾病分期：BCLC A 期
+  - 肿瘤单发，最大径 4.5cm
+患者肝功能 Child-Pugh A 级，具备根治性手术条件。
+建议完善术前评估，必要时行肝穿刺活检。
+**中医辨证**
+1. 证型：肝郁脾虚、湿热蕴结
+2. 治法：疏肝健脾、清热利湿
+| 指标 | 结果 | 参考范围 |
+| --- | --- | --- |
+| ALT | 56 U/L | 5-40 U/L |
+| 白蛋白 | 38 g/L | 35-55 g/L |
+
+"""
+    section_lines = section.count("\n")
+    content = section * max(1, target_lines // section_lines)
+    line_count = content.count("\n")
+    renderer = get_pdf_renderer()
+    styles = renderer.styles
+    width = renderer.content_width
+
+    def measure(func, runs=3):
+        func()
+        start = time.perf_counter()
+        for _ in range(runs):
+            result = func()
+        return (time.perf_counter() - start) / runs, result
+
+    print("📝 报告 Markdown 编译基准测试")
+    print("=" * 50)
+    print(f"报告: {line_count} 行，{len(content)} 字符")
+
+    legacy_time, legacy = measure(lambda: _legacy_format_report_content(content, styles))
+    parse_time, blocks = measure(lambda: parse_markdown(content))
+    compile_time, flowables = measure(lambda: to_flowables(blocks, styles, renderer.report_table_style, width))
+    cached_time, _ = measure(lambda: to_flowables(parse_report(content, 1), styles, renderer.report_table_style, width))
+    html_time, _ = measure(lambda: to_html(blocks))
+
+    def build(make_flowables):
+        from io import BytesIO
+        from reportlab.platypus import SimpleDocTemplate
+        SimpleDocTemplate(BytesIO()).build(make_flowables())
+
+    legacy_build_time, _ = measure(lambda: build(lambda: _legacy_format_report_content(content, styles)), runs=1)
+    build_time, _ = measure(lambda: build(lambda: to_flowables(parse_report(content, 1), styles,
+                                                                renderer.report_table_style, width)), runs=1)
+
+    print(f"旧实现 format_report_content: {legacy_time * 1000:8.1f}ms（{len(legacy)} 个 flowable）")
+    print(f"解析 parse_markdown:          {parse_time * 1000:8.1f}ms（{len(blocks)} 个块）")
+    print(f"编译 to_flowables:            {compile_time * 1000:8.1f}ms（{len(flowables)} 个 flowable）")
+    print(f"解析 + 编译:                  {(parse_time + compile_time) * 1000:8.1f}ms")
+    print(f"命中缓存时（只编译）:         {cached_time * 1000:8.1f}ms")
+    print(f"编译 to_html:                 {html_time * 1000:8.1f}ms")
+    print(f"完整排版（旧实现）:           {legacy_build_time * 1000:8.1f}ms")
+    print(f"完整排版（新实现）:           {build_time * 1000:8.1f}ms")
@@ -0,0 +1,393 @@
+"""
+报告正文压缩存储 - 在存储层透明地压缩/解压 reports.report_content
+
+- 默认使用 zstd（安装了 zstandard 时），否则使用标准库 zlib
+- 压缩时使用按历史报告训练的共享字典，报告模板中重复的标题和套话只需存一份；新库先用报告模板骨架
+  生成字典，报告积累到 REPORT_DICT_RETRAIN_MIN_REPORTS 份、之后每增长到上次样本数的
+  REPORT_DICT_RETRAIN_GROWTH 倍时用最近的真实报告重新训练（旧报告仍按各自的字典解压）
+- reports.compression 记录每行的编码方式：NULL 为明文，"zlib:3" 表示 zlib + 3 号字典
+- 注册 SQL 函数 report_text(content, compression)，查询时只在确实需要正文时解压
+- 全文索引 reports_fts（trigram）和 reports_ngram（单字/两字）为无内容（contentless）索引，
+  由应用在写入/删除报告时用明文维护（index_report / unindex_reports），表结构不依赖任何自定义函数，其他进程和 sqlite3 命令行可照常读写
+- 其他进程写入的报告在启动时由 sync_index 补建索引；其他进程删除的报告在索引中留下的条目
+  检索时与 reports 表连接后自然被过滤，rebuild_index 可彻底重建
+"""
+
+import threading
+import zlib
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from config import config
+from database import Database, db
+from search import ngram_text
+
+try:
+    import zstandard
+except ImportError:  # 未安装时退回 zlib
+    zstandard = None
+
+# 报告模板骨架，作为字典的基础内容（与 create_medical_prompt 要求的结构一致）
+REPORT_TEMPLATE_SEED = """
+## 一、疾病分析
+### 西医诊断分析
+- 可能诊断及依据
+- 疾病分期/分级
+- 病理生理机制
+### 中医辨证分析
+- 证型分析
+- 病机分析
+- 体质辨识
+## 二、术前风险评估
+- 年龄因素评估
+- 实验室指标分析
+- 影像学特征评估
+- 既往病史影响
+- 综合风险等级
+## 三、推荐检查项目
+- 必要影像学检查
+- 血液生化指标
+- 肝功能评估
+- 其他辅助检查
+## 四、治疗方案
+### 西医治疗方案
+- 手术方式选择
+- 术前准备措施
+- 药物治疗方案
+- 围手术期管理
+### 中医辅助治疗
+- 辨证论治方案
+- 中药方剂推荐
+- 针灸/推拿辅助
+- 饮食调理建议
+## 五、注意事项
+- 术前注意事项
+- 生活管理建议
+- 随访计划
+- 紧急情况处理
+"""
+
+
+def _resolve_method(method: str) -> str:
+    method = (method or "auto").lower()
+    if method == "auto":
+        return "zstd" if zstandard is not None else "zlib"
+    if method == "zstd" and zstandard is None:
+        print("⚠️ 未安装 zstandard，报告压缩改用 zlib")
+        return "zlib"
+    return method
+
+
+class ReportCodec:
+    """报告正文编解码器"""
+
+    def __init__(self, database: Database, method: str = None, level: int = None,
+                 min_bytes: int = None, dict_size: int = None):
+        self.database = database
+        self.method = _resolve_method(method or config.REPORT_COMPRESSION)
+        self.level = level or config.REPORT_COMPRESSION_LEVEL
+        self.min_bytes = min_bytes if min_bytes is not None else config.REPORT_COMPRESSION_MIN_BYTES
+        self.dict_size = dict_size or config.REPORT_DICT_SIZE
+
+        self._dictionaries: Dict[int, Tuple[str, bytes]] = {}
+        self._sample_counts: Dict[int, int] = {}
+        self._written = 0  # 距上次检查是否需要重新训练后写入的报告数
+        self._active_dict_id: Optional[int] = None
+        self._zstd_dicts: Dict[int, object] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    # ---------- 字典 ----------
+
+    def load_dictionaries(self, conn=None):
+        """
+        从数据库加载字典，当前压缩方式的最新字典作为写入时使用的字典
+
+        conn: 正在使用的连接；在 SQL 函数或事务中解压时传入，避免再从连接池借第二个连接
+        """
+        sql = 'SELECT id, codec, data, sample_count FROM report_dictionaries ORDER BY id'
+        rows = conn.execute(sql).fetchall() if conn is not None else self.database.query_all(sql)
+        with self._lock:
+            self._dictionaries = {row[0]: (row[1], bytes(row[2])) for row in rows}
+            self._sample_counts = {row[0]: row[3] or 0 for row in rows}
+            self._zstd_dicts.clear()
+            active = [dict_id for dict_id, (codec, _) in self._dictionaries.items() if codec == self.method]
+            self._active_dict_id = active[-1] if active else None
+            self._loaded = True
+
+    def _dictionary(self, dict_id: int, conn=None) -> Tuple[str, bytes]:
+        if dict_id not in self._dictionaries:
+            self.load_dictionaries(conn)
+        return self._dictionaries[dict_id]
+
+    def build_dictionary(self, samples: List[str]) -> bytes:
+        """根据样本报告生成字典"""
+        if self.method == "zstd" and len(samples) >= 20:
+            try:
+                trained = zstandard.train_dictionary(self.dict_size, [s.encode("utf-8") for s in samples])
+                return trained.as_bytes()
+            except zstandard.ZstdError:
+                pass
+        # 原始内容字典：模板骨架 + 样本中反复出现的行；zlib 优先匹配靠近末尾的内容，高频行放在最后
+        line_counts = Counter(
+            line.strip() for sample in samples for line in sample.splitlines() if len(line.strip()) >= 4
+        )
+        frequent = [line for line, count in line_counts.most_common() if count > 1]
+        data = REPORT_TEMPLATE_SEED.encode("utf-8")
+        for line in reversed(frequent):
+            encoded = (line + "\n").encode("utf-8")
+            if len(data) + len(encoded) > self.dict_size:
+                break
+            data += encoded
+        return data[-self.dict_size:]
+
+    def train(self, sample_limit: int = None) -> int:
+        """用最近的报告训练新字典并设为当前字典，返回字典 ID"""
+        sample_limit = sample_limit or config.REPORT_DICT_SAMPLE_LIMIT
+        rows = self.database.query_all(
+            'SELECT report_text(report_content, compression) FROM reports ORDER BY id DESC LIMIT ?', (sample_limit,)
+        )
+        data = self.build_dictionary([row[0] for row in rows if row[0]])
+        with self.database.transaction() as conn:
+            dict_id = conn.execute(
+                'INSERT INTO report_dictionaries (codec, data, sample_count) VALUES (?, ?, ?)',
+                (self.method, data, len(rows))
+            ).lastrowid
+        self.load_dictionaries()
+        return dict_id
+
+    def needs_training(self) -> bool:
+        """
+        当前压缩方式还没有字典，或报告数已增长到值得重新训练时返回 True
+
+        字典只含模板骨架（样本数为 0）时，报告达到 REPORT_DICT_RETRAIN_MIN_REPORTS 份后重新训练；
+        之后报告数增长到上次样本数的 REPORT_DICT_RETRAIN_GROWTH 倍时再训练，样本数达到上限后不再训练
+        """
+        if self._active_dict_id is None:
+            return True
+        samples = self._sample_counts.get(self._active_dict_id, 0)
+        if samples >= config.REPORT_DICT_SAMPLE_LIMIT:
+            return False
+        reports = self.database.query_one('SELECT COUNT(*) FROM reports')[0]
+        return reports >= max(config.REPORT_DICT_RETRAIN_MIN_REPORTS, samples * config.REPORT_DICT_RETRAIN_GROWTH)
+
+    def ensure_dictionary(self) -> Optional[int]:
+        """当前压缩方式还没有字典，或报告已积累到需要重新训练时训练新字典，返回当前字典 ID"""
+        if self.method == "none":
+            return None
+        if not self._loaded:
+            self.load_dictionaries()
+        self._written = 0
+        if self.needs_training():
+            self.train()
+        return self._active_dict_id
+
+    def retrain_due(self) -> bool:
+        """距上次检查已写入 REPORT_DICT_CHECK_INTERVAL 份报告时返回 True，由调用方在后台执行 ensure_dictionary"""
+        if self.method == "none" or self._written < config.REPORT_DICT_CHECK_INTERVAL:
+            return False
+        self._written = 0
+        return True
+
+    # ---------- 编解码 ----------
+
+    def _zstd_kwargs(self, dict_id: Optional[int], conn=None) -> dict:
+        """zstd 压缩器/解压器参数；字典对象可跨线程共享，压缩器/解压器不能，每次调用单独创建"""
+        if dict_id is None:
+            return {}
+        if dict_id not in self._zstd_dicts:
+            self._zstd_dicts[dict_id] = zstandard.ZstdCompressionDict(self._dictionary(dict_id, conn)[1])
+        return {"dict_data": self._zstd_dicts[dict_id]}
+
+    def encode(self, text: str) -> Tuple[Union[str, bytes], Optional[str]]:
+        """压缩报告正文，返回 (存储值, compression)；过短或压缩无收益时保存明文"""
+        raw = text.encode("utf-8")
+        if self.method == "none" or len(raw) < self.min_bytes:
+            return text, None
+        self._written += 1
+        if not self._loaded:
+            self.load_dictionaries()
+        dict_id = self._active_dict_id
+
+        if self.method == "zstd":
+            compressed = zstandard.ZstdCompressor(level=self.level, **self._zstd_kwargs(dict_id)).compress(raw)
+        else:
+            kwargs = {"zdict": self._dictionary(dict_id)[1]} if dict_id is not None else {}
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, **kwargs)
+            compressed = compressor.compress(raw) + compressor.flush()
+
+        if len(compressed) >= len(raw):
+            return text, None
+        return compressed, self.method if dict_id is None else f"{self.method}:{dict_id}"
+
+    def decode(self, value: Union[str, bytes, None], compression: Optional[str], conn=None) -> Optional[str]:
+        """解压报告正文（也作为 SQL 函数 report_text 使用，此时 conn 为调用该函数的连接）"""
+        if value is None or not compression:
+            return value if not isinstance(value, bytes) else value.decode("utf-8")
+        method, _, dict_part = compression.partition(":")
+        dict_id = int(dict_part) if dict_part else None
+        if method == "zstd":
+            if zstandard is None:
+                raise RuntimeError("该报告以 zstd 压缩，需要安装 zstandard")
+            return zstandard.ZstdDecompressor(**self._zstd_kwargs(dict_id, conn)).decompress(value).decode("utf-8")
+        kwargs = {"zdict": self._dictionary(dict_id, conn)[1]} if dict_id is not None else {}
+        decompressor = zlib.decompressobj(-15, **kwargs)
+        return (decompressor.decompress(value) + decompressor.flush()).decode("utf-8")
+
+    # ---------- 存量数据 ----------
+
+    def compress_existing(self, batch_size: int = None) -> int:
+        """分批压缩尚未压缩的报告（每批一个事务），返回压缩的行数"""
+        batch_size = batch_size or config.REPORT_COMPRESSION_BATCH_SIZE
+        if self.method == "none":
+            return 0
+        self.ensure_dictionary()
+        last_id, compressed = 0, 0
+        while True:
+            rows = self.database.query_all(
+                'SELECT id, report_content FROM reports WHERE compression IS NULL AND id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            )
+            if not rows:
+                return compressed
+            last_id = rows[-1][0]
+            updates = []
+            for report_id, content in rows:
+                value, compression = self.encode(content)
+                if compression:
+                    updates.append((value, compression, report_id))
+            if updates:
+                with self.database.transaction() as conn:
+                    conn.executemany(
+                        'UPDATE reports SET report_content = ?, compression = ? WHERE id = ?', updates
+                    )
+                compressed += len(updates)
+
+    # ---------- 全文索引 ----------
+
+    def index_report(self, conn, report_id: int, text: str):
+        """为新写入的报告建立索引（与写入报告在同一事务中调用）"""
+        conn.execute('INSERT INTO reports_fts (rowid, report_content) VALUES (?, ?)', (report_id, text))
+        conn.execute('INSERT INTO reports_ngram (rowid, text) VALUES (?, ?)', (report_id, ngram_text(text)))
+
+    def unindex_reports(self, conn, where: str, params: Sequence[Any] = ()) -> int:
+        """
+        删除报告前移除其索引（与删除报告在同一事务中调用），返回移除的行数
+
+        无内容索引删除条目时需要提供原文，这里按 where 条件读出报告并解压。
+        尚未建立索引的报告（其他进程写入、还没有补建）不能执行 'delete'，否则会损坏索引，
+        按影子表（reports_fts_docsize、reports_ngram_docsize）跳过。
+        """
+        rows = conn.execute(
+            f'SELECT id, report_content, compression FROM reports WHERE {where}', params
+        ).fetchall()
+        texts = [(report_id, self.decode(content, compression, conn)) for report_id, content, compression in rows]
+        ids = [report_id for report_id, _ in texts]
+        indexed = self._indexed(conn, "reports_fts", ids)
+        conn.executemany(
+            "INSERT INTO reports_fts (reports_fts, rowid, report_content) VALUES ('delete', ?, ?)",
+            [(report_id, text) for report_id, text in texts if report_id in indexed]
+        )
+        indexed = self._indexed(conn, "reports_ngram", ids)
+        conn.executemany(
+            "INSERT INTO reports_ngram (reports_ngram, rowid, text) VALUES ('delete', ?, ?)",
+            [(report_id, ngram_text(text)) for report_id, text in texts if report_id in indexed]
+        )
+        return len(rows)
+
+    @staticmethod
+    def _indexed(conn, table: str, ids: List[int]) -> Set[int]:
+        """ids 中已写入无内容索引 table 的行"""
+        indexed = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            indexed.update(row[0] for row in conn.execute(
+                f'SELECT id FROM {table}_docsize WHERE id IN ({placeholders})', chunk
+            ))
+        return indexed
+
+    def clear_index(self, conn):
+        """清空索引（删除全部报告时调用）"""
+        conn.execute("INSERT INTO reports_fts (reports_fts) VALUES ('delete-all')")
+        conn.execute("INSERT INTO reports_ngram (reports_ngram) VALUES ('delete-all')")
+
+    def sync_index(self, batch_size: int = None) -> int:
+        """为尚未建立索引的报告（迁移前的存量、其他进程写入的报告）分批补建索引，返回补建的行数"""
+        batch_size = batch_size or config.REPORT_COMPRESSION_BATCH_SIZE
+        indexed = 0
+        while True:
+            with self.database.transaction() as conn:
+                # reports_fts_docsize 是 FTS5 的影子表，每个已索引的行有一条记录
+                rows = conn.execute(
+                    'SELECT id, report_content, compression FROM reports r '
+                    'WHERE NOT EXISTS (SELECT 1 FROM reports_fts_docsize d WHERE d.id = r.id) '
+                    'ORDER BY id LIMIT ?', (batch_size,)
+                ).fetchall()
+                for report_id, content, compression in rows:
+                    self.index_report(conn, report_id, self.decode(content, compression, conn))
+            indexed += len(rows)
+            if len(rows) < batch_size:
+                return indexed
+
+    def rebuild_index(self) -> int:
+        """清空并重建索引（其他进程删除过报告后可手动执行），返回索引的行数"""
+        with self.database.transaction() as conn:
+            self.clear_index(conn)
+        return self.sync_index()
+
+
+def storage_stats(database: Database) -> Dict[str, float]:
+    """报告存储统计：行数、已压缩行数、存储字节数、原文字节数"""
+    row = database.query_one('''
+        SELECT COUNT(*),
+               SUM(compression IS NOT NULL),
+               SUM(LENGTH(CAST(report_content AS BLOB))),
+               SUM(LENGTH(CAST(report_text(report_content, compression) AS BLOB)))
+        FROM reports
+    ''')
+    total, compressed, stored, original = (v or 0 for v in row)
+    return {
+        "reports": total,
+        "compressed_reports": compressed,
+        "stored_bytes": stored,
+        "original_bytes": original,
+        "ratio": round(original / stored, 2) if stored else 1.0
+    }
+
+
+def _register_functions(conn):
+    # 解压时需要加载字典的话在同一个连接上查询，不占用连接池中的其他连接
+    conn.create_function(
+        "report_text", 2, lambda value, compression: report_codec.decode(value, compression, conn),
+        deterministic=True
+    )
+
+
+# 创建全局编解码器，并在每个数据库连接上注册 report_text() 函数
+report_codec = ReportCodec(db)
+db.add_connection_hook(_register_functions)
+
+
+# 基准测试/存量压缩：python report_store.py [--vacuum]
+if __name__ == "__main__":
+    import os
+    import sys
+    import time
+
+    from migrations import apply_migrations
+
+    apply_migrations(db)
+    before = os.path.getsize(db.db_path)
+    print("📦 报告压缩")
+    print("=" * 50)
+    print(f"压缩方式: {report_codec.method}")
+    start = time.perf_counter()
+    count = report_codec.compress_existing()
+    print(f"本次压缩 {count} 份报告，耗时 {time.perf_counter() - start:.2f}s")
+    stats = storage_stats(db)
+    print(f"报告正文: {stats['original_bytes']} -> {stats['stored_bytes']} 字节（{stats['ratio']}x）")
+    if "--vacuum" in sys.argv:
+        with db.connection() as conn:
+            conn.execute('VACUUM')
+        print(f"数据库文件: {before} -> {os.path.getsize(db.db_path)} 字节")
@@ -9,6 +9,7 @@ import seaborn as sns
 from sklearn.preprocessing import StandardScaler, LabelEncoder
 from sklearn.impute import SimpleImputer
 import warnings
+from dataset_schema import missing_required_fields
 warnings.filterwarnings('ignore')
 
 class DataProcessor:
@@ -26,8 +27,12 @@ class DataProcessor:
                 df = pd.read_csv(file_path)
             elif file_path.endswith('.xlsx'):
                 df = pd.read_excel(file_path)
+            elif file_path.endswith('.parquet'):
+                df = pd.read_parquet(file_path)
+            elif file_path.endswith('.ndjson'):
+                df = pd.read_json(file_path, lines=True, dtype={'patient_id': str})
             else:
-                raise ValueError("支持的文件格式: CSV, XLSX")
+                raise ValueError("支持的文件格式: CSV, XLSX, Parquet, NDJSON（/export 导出的文件）")
             
             print(f"✅ 数据加载成功: {df.shape[0]}行, {df.shape[1]}列")
             return df
@@ -37,12 +42,7 @@ class DataProcessor:
     
     def validate_required_fields(self, df):
         """验证必需字段"""
-        required_fields = [
-            'patient_id', 'age', 'sex', 'chief_complaint',
-            'ALT', 'AST', 'AFP', 'imaging_result'
-        ]
-        
-        missing_fields = [field for field in required_fields if field not in df.columns]
+        missing_fields = missing_required_fields(list(df.columns))
         
         if missing_fields:
             print(f"⚠️  缺失必需字段: {missing_fields}")
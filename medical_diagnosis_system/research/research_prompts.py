@@ -2,8 +2,9 @@
 科研场景LLM Prompt模板 - 专业的医疗科研报告生成
 """
 
-from typing import Dict, Any
-import json
+from typing import Dict, Any, List
+
+from evidence_encoder import encode_evidence
 
 class ResearchPromptTemplates:
     """科研场景的LLM Prompt模板集合"""
@@ -15,7 +16,7 @@ class ResearchPromptTemplates:
 你是一位资深的肝胆外科专家和临床研究员，同时精通中医辨证论治。请基于以下科学证据包，生成一份专业的术前评估报告，包含临床诊疗建议和科研分析。
 
 **证据包数据：**
-{json.dumps(evidence_bundle, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence_bundle)}
 
 **请按以下结构生成报告：**
 
@@ -121,10 +122,10 @@ class ResearchPromptTemplates:
 你是一位专业的肝胆外科医生和临床研究专家，精通术后随访管理和中西医结合康复。请基于术前预测模型和术后实际情况，生成综合随访报告。
 
 **术前预测证据包：**
-{json.dumps(evidence_bundle, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence_bundle)}
 
 **手术信息：**
-{json.dumps(surgery_info, ensure_ascii=False, indent=2)}
+{encode_evidence(surgery_info)}
 
 **请生成包含以下内容的术后随访报告：**
 
@@ -195,10 +196,10 @@ class ResearchPromptTemplates:
 你是肝胆外科和肿瘤学专家，精通复发转移的预测和管理。请基于AI模型预测和随访数据，生成专业的复发风险评估报告。
 
 **AI预测证据包：**
-{json.dumps(evidence_bundle, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence_bundle)}
 
 **随访数据：**
-{json.dumps(followup_data, ensure_ascii=False, indent=2)}
+{encode_evidence(followup_data)}
 
 **请生成复发风险评估报告：**
 
@@ -271,10 +272,10 @@ class ResearchPromptTemplates:
 你是医学统计学专家和临床研究员，请基于AI模型结果和队列数据，生成适合学术发表的研究报告摘要。
 
 **模型证据包：**
-{json.dumps(evidence_bundle, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence_bundle)}
 
 **队列数据摘要：**
-{json.dumps(cohort_data, ensure_ascii=False, indent=2)}
+{encode_evidence(cohort_data)}
 
 **请生成学术研究报告：**
 
@@ -393,7 +394,7 @@ class ResearchPromptTemplates:
 你是中西医结合领域的资深专家，精通现代医学循证研究和传统中医理论。请基于AI模型预测结果，深度分析中西医结合治疗方案。
 
 **AI模型证据包：**
-{json.dumps(evidence_bundle, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence_bundle)}
 
 **请生成中西医结合深度分析报告：**
 
@@ -493,10 +494,10 @@ class ResearchPromptTemplates:
 你是医学AI和生物统计学专家，请对机器学习模型的预测结果进行深度解释和临床转化。
 
 **模型预测证据：**
-{json.dumps(evidence_bundle, ensure_ascii=False, indent=2)}
+{encode_evidence(evidence_bundle)}
 
 **SHAP解释性分析：**
-{json.dumps(shap_values, ensure_ascii=False, indent=2)}
+{encode_evidence(shap_values)}
 
 **请生成模型解释性分析报告：**
 
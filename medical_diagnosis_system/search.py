@@ -0,0 +1,236 @@
+"""
+全文检索 - 基于 SQLite FTS5 检索病人信息和报告正文
+
+- patients_fts 为外部内容索引，由触发器与原表保持同步（见 migrations.py）
+- reports_fts 为无内容索引（报告正文可能压缩存储），由应用在写入时维护（见 report_store.py）；
+  报告的摘要在取出当前页之后才解压正文、在 Python 中截取
+- 使用 trigram 分词，中文按连续 3 字切分，无需额外分词库
+- 黄疸、肝癌这类 1~2 个字的检索词由 patients_ngram / reports_ngram 索引：应用把文本拆成单字和相邻两字
+  写入无内容索引（detail=none，只记录命中的行），与病人、报告在同一事务中维护，启动时补建其他进程写入的行
+- 结果按 bm25 相关度排序，返回高亮摘要
+"""
+
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from database import Database
+
+HIGHLIGHT_START = "【"
+HIGHLIGHT_END = "】"
+SNIPPET_TOKENS = 24
+
+PATIENT_FTS_COLUMNS = ("chief_complaint", "history", "imaging")
+# 报告正文可能是压缩存储的，用 report_text() 解压
+REPORT_TEXT = "report_text(r.report_content, r.compression)"
+
+
+# 写入 n-gram 索引的字符：字母、数字和汉字（与 unicode61 分词器的词字符一致，不含下划线）
+_WORD = re.compile(r"[^\W_]+")
+
+
+def ngram_text(*texts: Optional[str]) -> str:
+    """把文本拆成单字和相邻两字（不跨标点和空白），空格分隔后写入 n-gram 索引"""
+    grams: Dict[str, None] = {}
+    for text in texts:
+        for word in _WORD.findall((text or "").lower()):
+            for i, char in enumerate(word):
+                grams[char] = None
+                if i + 1 < len(word):
+                    grams[word[i:i + 2]] = None
+    return " ".join(grams)
+
+
+def parse_query(query: str) -> Tuple[Optional[str], Optional[str], List[str]]:
+    """
+    把用户输入拆成 trigram 索引和 n-gram 索引的 MATCH 表达式
+
+    按空白分词，词与词之间为 AND 关系。3 个字及以上的词作为短语匹配 trigram 索引，避免 FTS5 语法注入；
+    更短的词按字母、数字、汉字切开后匹配 n-gram 索引，不含这些字符的词（如单个标点）被忽略。
+
+    Returns:
+        (trigram MATCH 表达式, n-gram MATCH 表达式, 用于高亮的短词列表)
+    """
+    terms = [t for t in re.split(r"\s+", query.strip()) if t]
+    long_terms = [t for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3 and _WORD.search(t)]
+    match = " AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms) or None
+    grams = [gram for t in short_terms for gram in _WORD.findall(t.lower())]
+    ngram_match = " AND ".join(f'"{gram}"' for gram in dict.fromkeys(grams)) or None
+    return match, ngram_match, short_terms
+
+
+def _make_snippet(text: str, terms: List[str], width: int = 40) -> str:
+    """无 MATCH 表达式时在 Python 中截取包含检索词的片段"""
+    text = (text or "").replace("\n", " ")
+    positions = [text.find(t) for t in terms if t in text]
+    if not positions:
+        return text[:width * 2] + ("…" if len(text) > width * 2 else "")
+    start = max(0, min(positions) - width)
+    snippet = text[start:start + width * 2]
+    for term in terms:
+        snippet = snippet.replace(term, f"{HIGHLIGHT_START}{term}{HIGHLIGHT_END}")
+    return ("…" if start > 0 else "") + snippet + ("…" if start + width * 2 < len(text) else "")
+
+
+def _build_branch(kind: str, match: Optional[str], ngram_match: Optional[str],
+                  scan_limit: int) -> Tuple[str, List[Any]]:
+    """生成单个索引表的查询子句"""
+    if kind == "patient":
+        table, ngram_table = "patients_fts", "patients_ngram"
+        select = "'patient' AS kind, p.id AS patient_id, NULL AS report_id, p.name AS patient_name, p.created_at"
+        join = "JOIN patients p ON p.id = {rowid}"
+        text = " || ' ' || ".join(f"COALESCE(p.{c}, '')" for c in PATIENT_FTS_COLUMNS)
+    else:
+        table, ngram_table = "reports_fts", "reports_ngram"
+        select = "'report' AS kind, r.patient_id, r.id AS report_id, p.name AS patient_name, r.created_at"
+        join = "JOIN reports r ON r.id = {rowid} LEFT JOIN patients p ON p.id = r.patient_id"
+        # 无内容索引中没有正文：摘要留空，取出当前页后再解压正文截取
+        text = "NULL"
+
+    if not match:
+        # 只有短词：n-gram 索引按 rowid 倒序（近似为最新录入优先）取出命中的行，凑够当前页即可停止
+        sql = (
+            f"SELECT {select}, {text} AS snippet, 0.0 AS score "
+            f"FROM (SELECT rowid FROM {ngram_table} WHERE {ngram_table} MATCH ? ORDER BY rowid DESC LIMIT ?) g "
+            f"{join.format(rowid='g.rowid')}"
+        )
+        return sql, [ngram_match, scan_limit]
+
+    snippet = (
+        f"snippet({table}, -1, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', {SNIPPET_TOKENS})"
+        if kind == "patient" else text
+    )
+    sql = (
+        f"SELECT {select}, {snippet} AS snippet, bm25({table}) AS score "
+        f"FROM {table} {join.format(rowid=f'{table}.rowid')} WHERE {table} MATCH ?"
+    )
+    params = [match]
+    if ngram_match:
+        # 一元 + 阻止 IN 下推为 FTS5 的 rowid 约束，否则每个命中的 rowid 都要重新执行一次 MATCH
+        sql += f" AND +{table}.rowid IN (SELECT rowid FROM {ngram_table} WHERE {ngram_table} MATCH ?)"
+        params.append(ngram_match)
+    return sql, params
+
+
+def _report_texts(database: Database, report_ids: List[int]) -> Dict[int, str]:
+    """解压当前页报告的正文"""
+    if not report_ids:
+        return {}
+    placeholders = ",".join("?" * len(report_ids))
+    return dict(database.query_all(
+        f"SELECT r.id, {REPORT_TEXT} FROM reports r WHERE r.id IN ({placeholders})", report_ids
+    ))
+
+
+def search_records(database: Database, query: str, scope: str = "all",
+                   limit: int = 20, offset: int = 0) -> Dict[str, Any]:
+    """
+    检索病人和报告
+
+    Args:
+        database: 数据库实例
+        query: 检索词，空白分隔的多个词需同时命中
+        scope: all / patients / reports
+        limit: 每页条数
+        offset: 偏移量
+
+    Returns:
+        {"results": [...], "has_more": bool, "next_offset": int 或 None}
+    """
+    match, ngram_match, short_terms = parse_query(query)
+    if not match and not ngram_match:
+        return {"results": [], "has_more": False, "next_offset": None}
+
+    kinds = {"all": ("patient", "report"), "patients": ("patient",), "reports": ("report",)}[scope]
+    branches, params = [], []
+    for kind in kinds:
+        sql, branch_params = _build_branch(kind, match, ngram_match, offset + limit + 1)
+        branches.append(sql)
+        params.extend(branch_params)
+
+    # bm25 越小越相关；只有短词时按时间倒序（近似为最新录入优先）
+    order = "score, created_at DESC" if match else "created_at DESC"
+    rows = database.query_all(
+        f"SELECT * FROM ({' UNION ALL '.join(branches)}) ORDER BY {order} LIMIT ? OFFSET ?",
+        (*params, limit + 1, offset)
+    )
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    terms = [t for t in re.split(r"\s+", query.strip()) if t]
+    report_texts = _report_texts(database, [row[2] for row in rows if row[0] == "report"])
+    results = []
+    for kind, patient_id, report_id, patient_name, created_at, snippet, score in rows:
+        if kind == "report":
+            snippet = _make_snippet(report_texts.get(report_id), terms)
+        elif not match:
+            snippet = _make_snippet(snippet, short_terms)
+        results.append({
+            "type": kind,
+            "patient_id": patient_id,
+            "report_id": report_id,
+            "patient_name": patient_name,
+            "created_at": created_at,
+            "snippet": snippet,
+            "score": round(-score, 4) if match else None
+        })
+    return {"results": results, "has_more": has_more, "next_offset": offset + limit if has_more else None}
+
+
+# ---------- 病人 n-gram 索引（由应用维护） ----------
+
+PATIENT_NGRAM_COLUMNS = "id, " + ", ".join(PATIENT_FTS_COLUMNS)
+
+
+def index_patients(conn, patients: Iterable[Sequence[Any]]):
+    """
+    为新写入的病人建立 n-gram 索引（与写入病人在同一事务中调用）
+
+    Args:
+        conn: 当前事务的连接
+        patients: [(病人 ID, 主诉, 既往史, 影像), ...]
+    """
+    conn.executemany(
+        'INSERT INTO patients_ngram (rowid, text) VALUES (?, ?)',
+        [(row[0], ngram_text(*row[1:])) for row in patients]
+    )
+
+
+def unindex_patients(conn, where: str, params: Sequence[Any] = ()) -> int:
+    """
+    删除病人前移除其 n-gram 索引，返回移除的行数
+
+    无内容索引删除条目时需要提供写入时的文本；尚未建立索引的病人（其他进程写入、还没有补建）
+    不能执行 'delete'，否则会损坏索引，按影子表 patients_ngram_docsize 跳过
+    """
+    rows = conn.execute(
+        f'SELECT {PATIENT_NGRAM_COLUMNS} FROM patients WHERE ({where}) '
+        'AND EXISTS (SELECT 1 FROM patients_ngram_docsize d WHERE d.id = patients.id)', params
+    ).fetchall()
+    conn.executemany(
+        "INSERT INTO patients_ngram (patients_ngram, rowid, text) VALUES ('delete', ?, ?)",
+        [(row[0], ngram_text(*row[1:])) for row in rows]
+    )
+    return len(rows)
+
+
+def clear_patient_index(conn):
+    """清空病人 n-gram 索引（删除全部病人时调用）"""
+    conn.execute("INSERT INTO patients_ngram (patients_ngram) VALUES ('delete-all')")
+
+
+def sync_patient_index(database: Database, batch_size: int = 1000) -> int:
+    """为尚未建立 n-gram 索引的病人（升级前的存量、其他进程写入的病人）分批补建索引，返回补建的行数"""
+    indexed = 0
+    while True:
+        with database.transaction() as conn:
+            # patients_ngram_docsize 是 FTS5 的影子表，每个已索引的行有一条记录
+            rows = conn.execute(
+                f'SELECT {PATIENT_NGRAM_COLUMNS} FROM patients p '
+                'WHERE NOT EXISTS (SELECT 1 FROM patients_ngram_docsize d WHERE d.id = p.id) '
+                'ORDER BY id LIMIT ?', (batch_size,)
+            ).fetchall()
+            index_patients(conn, rows)
+        indexed += len(rows)
+        if len(rows) < batch_size:
+            return indexed
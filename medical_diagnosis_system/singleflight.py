@@ -0,0 +1,119 @@
+"""
+单飞（single-flight）请求合并 - 相同指纹的并发调用只访问上游一次
+
+- do(): 并发的相同请求等待同一个上游调用，共享其结果或异常
+- stream(): 并发的相同流式请求共享同一条上游流，后加入者会先收到已生成的片段
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class _StreamFlight:
+    """一条被多个订阅者共享的上游流"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.changed = asyncio.Condition()
+
+    async def publish(self, chunk: str):
+        async with self.changed:
+            self.chunks.append(chunk)
+            self.changed.notify_all()
+
+    async def finish(self, error: Optional[BaseException] = None):
+        async with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+
+
+class SingleFlight:
+    """进程内的请求合并器"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        执行 fn()，同一 key 已有在途调用时直接等待其结果
+
+        上游调用运行在独立任务中，单个等待方被取消不会影响其他等待方。
+        """
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        订阅 fn() 产生的流，同一 key 已有在途流时复用之
+
+        所有订阅者都断开后上游流会被取消。
+        """
+        flight = self._streams.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.ensure_future(self._pump(key, flight, fn))
+        else:
+            self.coalesced += 1
+
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: len(flight.chunks) > index or flight.done)
+                    pending = flight.chunks[index:]
+                    finished, error = flight.done, flight.error
+                for chunk in pending:
+                    yield chunk
+                index += len(pending)
+                if finished and index >= len(flight.chunks):
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                self._release(key, flight)
+                flight.task.cancel()
+
+    async def _pump(self, key: str, flight: _StreamFlight, fn: Callable[[], AsyncIterator[str]]):
+        """把上游流的片段转发给所有订阅者"""
+        error = None
+        upstream = fn()
+        try:
+            async for chunk in upstream:
+                await flight.publish(chunk)
+        except asyncio.CancelledError:
+            error = asyncio.CancelledError()
+        except Exception as e:
+            error = e
+        finally:
+            self._release(key, flight)
+            await upstream.aclose()
+            await flight.finish(error)
+
+    def _release(self, key: str, flight: _StreamFlight):
+        """仅当 key 仍指向该流时移除，避免误删后来新建的流"""
+        if self._streams.get(key) is flight:
+            del self._streams[key]
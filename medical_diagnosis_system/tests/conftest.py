@@ -0,0 +1,42 @@
+"""
+测试公共夹具 - 每个测试使用临时目录中的独立数据库
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config  # noqa: E402
+from database import db  # noqa: E402
+from migrations import apply_migrations  # noqa: E402
+from report_store import report_codec  # noqa: E402
+
+
+def reset_report_codec():
+    """清除编解码器缓存的字典（字典属于上一个测试的数据库）"""
+    report_codec._dictionaries = {}
+    report_codec._zstd_dicts.clear()
+    report_codec._active_dict_id = None
+    report_codec._loaded = False
+
+
+@pytest.fixture
+def empty_db(tmp_path, monkeypatch):
+    """指向临时文件、尚未执行迁移的全局数据库（保留已注册的 report_text() 等 SQL 函数）"""
+    monkeypatch.setattr(config, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    db.close()
+    monkeypatch.setattr(db, "db_path", str(tmp_path / "medical_reports.db"))
+    reset_report_codec()
+    yield db
+    db.close()
+    reset_report_codec()
+
+
+@pytest.fixture
+def migrated_db(empty_db):
+    """已迁移到最新版本的数据库"""
+    apply_migrations(empty_db)
+    return empty_db
@@ -0,0 +1,71 @@
+import json
+import os
+
+from archive import (archive_old_records, archive_stats, delete_archived_patient,
+                     load_archived_patient, partition_path)
+from lab_results import write_lab_results
+from report_store import report_codec
+from search import index_patients, search_records
+
+REPORT = "## 一、疾病分析\n肝细胞癌可能性大，建议增强 MRI 进一步明确。\n" * 20
+
+
+def _add_patient(database, name, created_at, report=REPORT):
+    labs = json.dumps({"AFP": "420 ng/mL"})
+    with database.transaction() as conn:
+        patient_id = conn.execute(
+            "INSERT INTO patients (name, age, sex, chief_complaint, labs, created_at) "
+            "VALUES (?, 55, '男', '右上腹痛', ?, ?)", (name, labs, created_at)
+        ).lastrowid
+        write_lab_results(conn, [(patient_id, labs)])
+        index_patients(conn, [(patient_id, "右上腹痛", None, None)])
+        content, compression = report_codec.encode(report)
+        report_id = conn.execute(
+            "INSERT INTO reports (patient_id, report_content, compression, created_at) VALUES (?, ?, ?, ?)",
+            (patient_id, content, compression, created_at)
+        ).lastrowid
+        report_codec.index_report(conn, report_id, report)
+    return patient_id
+
+
+def test_archive_round_trip(migrated_db):
+    old = _add_patient(migrated_db, "张三", "2020-03-15 08:00:00")
+    recent = _add_patient(migrated_db, "李四", "2999-01-01 00:00:00")
+
+    result = archive_old_records(migrated_db, older_than_days=30, batch_size=10)
+    assert result == {"archived": 1, "partitions": {"2020-03": 1}}
+    assert os.path.exists(partition_path(migrated_db, "2020-03"))
+
+    # 活跃库只剩未归档的病人，报告、检验结果和全文索引随之移除
+    assert migrated_db.query_all('SELECT id FROM patients') == [(recent,)]
+    assert migrated_db.query_one('SELECT COUNT(*) FROM reports WHERE patient_id = ?', (old,)) == (0,)
+    assert migrated_db.query_one('SELECT COUNT(*) FROM lab_results WHERE patient_id = ?', (old,)) == (0,)
+    assert migrated_db.query_one('SELECT COUNT(*) FROM reports_fts_docsize') == (1,)
+    hits = search_records(migrated_db, "肝细胞癌", scope="reports")["results"]
+    assert [hit["patient_id"] for hit in hits] == [recent]
+    assert migrated_db.query_one('SELECT COUNT(*) FROM patients_ngram_docsize') == (1,)
+    assert [hit["patient_id"] for hit in search_records(migrated_db, "腹痛", scope="patients")["results"]] == [recent]
+
+    # 从归档透明读取，报告正文已解压
+    patient, reports = load_archived_patient(migrated_db, old)
+    assert patient[1] == "张三"
+    assert [report[2] for report in reports] == [REPORT]
+    assert archive_stats(migrated_db)["partitions"][0]["patients"] == 1
+
+    # 再次归档不会重复移动
+    assert archive_old_records(migrated_db, older_than_days=30)["archived"] == 0
+
+    assert delete_archived_patient(migrated_db, old) == "张三"
+    assert load_archived_patient(migrated_db, old) is None
+    assert migrated_db.query_one('SELECT COUNT(*) FROM archived_patients') == (0,)
+
+
+def test_recent_report_keeps_patient_active(migrated_db):
+    patient_id = _add_patient(migrated_db, "王五", "2020-03-15 08:00:00")
+    with migrated_db.transaction() as conn:
+        conn.execute(
+            "INSERT INTO reports (patient_id, report_content) VALUES (?, '复查报告')", (patient_id,)
+        )
+
+    assert archive_old_records(migrated_db, older_than_days=30)["archived"] == 0
+    assert load_archived_patient(migrated_db, patient_id) is None
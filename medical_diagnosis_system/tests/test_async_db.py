@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+import pytest
+
+from async_db import AsyncDatabase
+
+
+@pytest.fixture
+def adb(migrated_db):
+    adb = AsyncDatabase(migrated_db, read_workers=2, group_commit_max=16)
+    yield adb
+    adb.close()
+
+
+def _insert(conn, name):
+    return conn.execute(
+        "INSERT INTO patients (name, age, sex, chief_complaint) VALUES (?, 40, '女', '体检')", (name,)
+    ).lastrowid
+
+
+def _insert_then_fail(conn, name):
+    _insert(conn, name)
+    raise ValueError("写入失败")
+
+
+def _names(conn):
+    return [row[0] for row in conn.execute('SELECT name FROM patients ORDER BY id')]
+
+
+def test_failed_write_rolls_back_only_its_savepoint(adb):
+    started, release = threading.Event(), threading.Event()
+
+    def blocker(conn):
+        started.set()
+        release.wait(5)
+        return _insert(conn, "第一批")
+
+    async def scenario():
+        first = asyncio.ensure_future(adb.write(blocker))
+        await asyncio.to_thread(started.wait, 5)
+        # 写线程被第一批占用期间排队的写操作会合并为同一个事务
+        writes = [
+            asyncio.ensure_future(adb.write(_insert, "甲")),
+            asyncio.ensure_future(adb.write(_insert_then_fail, "乙")),
+            asyncio.ensure_future(adb.write(_insert, "丙")),
+        ]
+        while adb.write_queue_depth < len(writes):
+            await asyncio.sleep(0.001)
+        release.set()
+        await first
+        return await asyncio.gather(*writes, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+
+    assert isinstance(results[0], int) and isinstance(results[2], int)
+    assert isinstance(results[1], ValueError)
+    assert (adb.commits, adb.writes) == (2, 4)
+    assert asyncio.run(adb.read(_names)) == ["第一批", "甲", "丙"]
+
+
+def test_read_helpers(adb):
+    async def scenario():
+        await adb.write(_insert, "丁")
+        return await adb.query_one('SELECT COUNT(*) FROM patients'), await adb.query_all('SELECT name FROM patients')
+
+    count, rows = asyncio.run(scenario())
+    assert count == (1,)
+    assert rows == [("丁",)]
@@ -0,0 +1,96 @@
+import asyncio
+
+from chat_history import ConversationHistoryManager, count_message_tokens, estimate_tokens
+
+
+class FakeGateway:
+    """记录摘要请求，按调用次数返回摘要"""
+
+    def __init__(self, fail=False):
+        self.prompts = []
+        self.fail = fail
+
+    async def complete(self, messages, **kwargs):
+        if self.fail:
+            raise RuntimeError("上游不可用")
+        self.prompts.append(messages[-1]["content"])
+        return f"摘要{len(self.prompts)}"
+
+
+def _history(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"问题{i}"})
+        messages.append({"role": "assistant", "content": f"回答{i}"})
+    return messages
+
+
+def _manager(gateway, **kwargs):
+    options = {"max_history_tokens": 10, "keep_last_turns": 2, "summary_step_turns": 3}
+    options.update(kwargs)
+    return ConversationHistoryManager(gateway, **options)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("肝癌") == 2
+    assert estimate_tokens("abcdefgh") == 2
+    assert count_message_tokens([{"role": "user", "content": "肝癌"}]) == 6
+
+
+def test_split_aligns_summary_boundary_to_step():
+    manager = _manager(FakeGateway())
+    assert manager._split(_history(2)) == ([], _history(2))
+    # 超出保留轮数不足一个步长时不摘要
+    assert manager._split(_history(4)) == ([], _history(4))
+    older, recent = manager._split(_history(5))
+    assert (len(older), len(recent)) == (6, 4)
+    # 边界按 3 轮对齐，近期原文保留 2~5 轮
+    for turns in (6, 7):
+        older, recent = manager._split(_history(turns))
+        assert len(older) == 6
+        assert older + recent == _history(turns)
+    assert len(manager._split(_history(8))[0]) == 12
+
+
+def test_short_history_is_sent_unchanged():
+    gateway = FakeGateway()
+    manager = _manager(gateway, max_history_tokens=10_000)
+    messages = asyncio.run(manager.build_messages("系统", _history(10), "新问题"))
+    assert messages == [{"role": "system", "content": "系统"}] + _history(10) + [{"role": "user", "content": "新问题"}]
+    assert gateway.prompts == []
+
+
+def test_summary_is_reused_and_extended_incrementally():
+    gateway = FakeGateway()
+    manager = _manager(gateway)
+    manager.max_history_tokens = 0  # 每次都需要压缩
+
+    async def build(turns):
+        return await manager.build_messages("系统", _history(turns), "新问题")
+
+    messages = asyncio.run(build(5))
+    assert messages[1] == {"role": "system", "content": "以下是此前对话的摘要：\n摘要1"}
+    assert len(gateway.prompts) == 1 and "问题2" in gateway.prompts[0]
+
+    # 边界未移动：复用缓存，不再调用大模型
+    asyncio.run(build(6))
+    asyncio.run(build(7))
+    assert len(gateway.prompts) == 1
+
+    # 边界移动一个步长：在已有摘要上只追加新增的对话
+    messages = asyncio.run(build(8))
+    assert messages[1]["content"].endswith("摘要2")
+    prompt = gateway.prompts[1]
+    assert "【已有摘要】\n摘要1" in prompt
+    assert "问题3" in prompt and "问题2" not in prompt
+
+
+def test_summary_failure_keeps_recent_messages():
+    manager = _manager(FakeGateway(fail=True))
+    messages = asyncio.run(manager.build_messages("系统", _history(5), "新问题"))
+    assert messages[0]["content"] == "系统"
+    assert messages[-1] == {"role": "user", "content": "新问题"}
+    # 没有摘要时按预算从最早的消息开始丢弃，至少保留最后一条
+    assert all(m["role"] != "system" for m in messages[1:])
+    assert messages[-2] == {"role": "assistant", "content": "回答4"}
@@ -0,0 +1,129 @@
+import asyncio
+import csv
+import io
+import json
+import zipfile
+
+import pytest
+
+from data_export import (REPORT_EXPORT_COLUMNS, _zip_entry_name, encode_csv, encode_ndjson, encode_zip, export_watermark,
+                         iter_patient_records, iter_report_records, parse_since, patient_columns, safe_filename)
+from lab_results import write_lab_results
+from report_store import report_codec
+
+REPORT = "## 一、疾病分析\n原发性肝细胞癌可能性大，建议增强 MRI。\n" * 20
+
+
+def _add_patients(database, count, created_at="2024-01-01 08:00:00"):
+    ids = []
+    with database.transaction() as conn:
+        for i in range(count):
+            labs = json.dumps({"ALT": 40 + i, "白蛋白": "38 g/L", "CA199": 20 + i}, ensure_ascii=False)
+            patient_id = conn.execute(
+                "INSERT INTO patients (name, age, sex, chief_complaint, labs, imaging, created_at) "
+                "VALUES (?, 50, '男', '右上腹痛', ?, 'CT 示肝占位', ?)", (f"病人{i}", labs, created_at)
+            ).lastrowid
+            write_lab_results(conn, [(patient_id, labs)])
+            content, compression = report_codec.encode(REPORT)
+            conn.execute(
+                "INSERT INTO reports (patient_id, report_content, compression, created_at) VALUES (?, ?, ?, ?)",
+                (patient_id, content, compression, created_at)
+            )
+            ids.append(patient_id)
+    return ids
+
+
+def test_parse_since():
+    assert parse_since(None) == (0, None)
+    assert parse_since(" 42 ") == (42, None)
+    assert parse_since("2024-01-01T08:00:00Z") == (0, "2024-01-01 08:00:00")
+
+
+def test_export_watermark_rejects_unknown_tables(migrated_db):
+    assert export_watermark(migrated_db, "patients") == 0
+    with pytest.raises(ValueError):
+        export_watermark(migrated_db, "jobs")
+
+
+def test_patients_are_exported_in_keyset_chunks(migrated_db):
+    ids = _add_patients(migrated_db, 5)
+    columns = patient_columns(migrated_db)
+    assert ("CA199", "float") in columns
+    assert "白蛋白" not in {name for name, _ in columns}  # 作为 albumin 导出
+
+    chunks = list(iter_patient_records(migrated_db, columns, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    first = chunks[0][0]
+    assert first["patient_id"] == f"P{ids[0]:04d}"
+    assert (first["ALT"], first["albumin"], first["CA199"]) == (40.0, 38.0, 20.0)
+    assert first["imaging_result"] == "CT 示肝占位"
+
+    # 以上次的截止 ID 作为 since 只导出之后的病人
+    rest = [r["id"] for chunk in iter_patient_records(migrated_db, columns, since=str(ids[2])) for r in chunk]
+    assert rest == ids[3:]
+
+
+def test_watermark_excludes_rows_written_during_export(migrated_db):
+    ids = _add_patients(migrated_db, 3)
+    until = export_watermark(migrated_db, "patients")
+    assert until == ids[-1]
+
+    chunks = iter_patient_records(migrated_db, patient_columns(migrated_db), until=until, chunk_size=2)
+    exported = [r["id"] for r in next(chunks)]
+    later = _add_patients(migrated_db, 2)  # 导出进行中写入的病人留给下一次增量导出
+    exported += [r["id"] for chunk in chunks for r in chunk]
+    assert exported == ids
+
+    next_batch = iter_patient_records(migrated_db, patient_columns(migrated_db), since=str(until))
+    assert [r["id"] for chunk in next_batch for r in chunk] == later
+
+
+def test_legacy_timestamp_since_filters_by_created_at(migrated_db):
+    _add_patients(migrated_db, 2, created_at="2024-01-01 08:00:00")
+    newer = _add_patients(migrated_db, 1, created_at="2024-06-01 08:00:00")
+    records = iter_report_records(migrated_db, since="2024-03-01T00:00:00")
+    assert [r["id"] for chunk in records for r in chunk] == newer
+
+
+def test_reports_are_decompressed_and_encoded(migrated_db):
+    _add_patients(migrated_db, 2)
+    chunks = list(iter_report_records(migrated_db, chunk_size=1))
+    assert [len(chunk) for chunk in chunks] == [1, 1]
+    assert chunks[0][0]["report_content"] == REPORT
+
+    lines = b"".join(encode_ndjson(REPORT_EXPORT_COLUMNS, chunks)).decode("utf-8").splitlines()
+    assert json.loads(lines[0]) == chunks[0][0]
+    rows = list(csv.DictReader(io.StringIO(b"".join(encode_csv(REPORT_EXPORT_COLUMNS, chunks)).decode("utf-8"))))
+    assert [row["report_id"] for row in rows] == ["1", "2"]
+    assert rows[1]["report_content"] == REPORT
+
+
+def test_safe_filename():
+    assert safe_filename("张三/../x") == "张三_.._x"
+    assert safe_filename('a\\b:c*?"<>|\x00d') == "a_b_c_______d"
+    assert safe_filename("..hidden") == "hidden"
+    assert safe_filename(" .. ") == "file"
+    assert safe_filename("", default="report") == "report"
+
+
+def test_zip_entry_names_stay_inside_the_archive():
+    assert _zip_entry_name("/etc/passwd") == "etc/passwd"
+    assert _zip_entry_name("../../x.pdf") == "x.pdf"
+    assert _zip_entry_name("a\\..\\..\\b.pdf") == "a/b.pdf"
+    assert _zip_entry_name("C:/Windows/x.pdf") == "C_/Windows/x.pdf"
+    assert _zip_entry_name("./..") == "file"
+
+
+def test_encode_zip_streams_sanitized_entries():
+    async def files():
+        yield "张三/../../报告.pdf", b"%PDF-1"
+        yield "李四_12.pdf", b"%PDF-2"
+
+    async def collect():
+        return [chunk async for chunk in encode_zip(files())]
+
+    chunks = asyncio.run(collect())
+    assert len(chunks) == 3  # 每个文件写完即输出，最后是中央目录
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.namelist() == ["张三/报告.pdf", "李四_12.pdf"]
+        assert archive.read("李四_12.pdf") == b"%PDF-2"
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pytest
+
+from config import config
+from job_queue import (JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, Job, JobQueue,
+                       RetryableJobError)
+from migrations import MIGRATIONS
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(db_path=str(tmp_path / "jobs.db"), workers=1, lease_seconds=30,
+                    max_attempts=2, poll_interval=0.05)
+
+
+def _expire_lease(queue, job_id):
+    queue._update(job_id, lease_until=time.time() - 1)
+
+
+def test_claim_takes_highest_priority_job_once(queue):
+    batch = queue._insert("report", {"n": 1}, 2, None)
+    interactive = queue._insert("report", {"n": 2}, 0, None)
+
+    job = queue._claim()
+    assert job["id"] == interactive["id"]
+    assert job["status"] == JOB_RUNNING
+    assert job["attempts"] == 1
+    assert job["worker_id"] == queue.worker_id
+    assert job["lease_until"] > time.time()
+
+    assert queue._claim()["id"] == batch["id"]
+    assert queue._claim() is None
+
+
+def test_expired_lease_is_requeued_then_failed(queue):
+    job_id = queue._insert("report", {}, 1, None)["id"]
+
+    queue._claim()
+    assert queue._recover_expired() == 0  # 租约未过期
+    _expire_lease(queue, job_id)
+    assert queue._recover_expired() == 1
+    job = queue.get(job_id)
+    assert (job["status"], job["worker_id"], job["lease_until"]) == (JOB_QUEUED, None, None)
+
+    assert queue._claim()["attempts"] == 2
+    _expire_lease(queue, job_id)
+    assert queue._recover_expired() == 0  # 已达到最大尝试次数
+    assert queue.get(job_id)["status"] == JOB_FAILED
+
+
+def test_idempotency_key_returns_existing_job(queue):
+    first = queue._insert("report", {"n": 1}, 1, "key-1")
+    again = queue._insert("report", {"n": 2}, 1, "key-1")
+    other = queue._insert("report", {"n": 3}, 1, None)
+
+    assert again["id"] == first["id"]
+    assert again["payload"] == {"n": 1}
+    assert other["id"] != first["id"]
+    assert queue.stats() == {JOB_QUEUED: 2}
+
+
+def test_workers_run_and_retry_jobs(queue, monkeypatch):
+    monkeypatch.setattr(config, "JOB_RETRY_BASE_DELAY", 0)
+    calls = []
+
+    async def handler(job):
+        calls.append(job.attempts)
+        await job.checkpoint(step=job.attempts)
+        if job.attempts == 1:
+            raise RetryableJobError("上游暂时不可用")
+        return {"ok": True}
+
+    async def scenario():
+        queue.register("report", handler)
+        await queue.start()
+        try:
+            job = await queue.submit("report", {"n": 1})
+            events = [event async for event in queue.watch(job["id"])]
+        finally:
+            await queue.stop()
+        return events
+
+    events = asyncio.run(scenario())
+
+    assert calls == [1, 2]
+    assert events[-1]["event"] == "done"
+    done = events[-1]["data"]
+    assert done["status"] == JOB_SUCCEEDED
+    assert done["result"] == {"ok": True}
+    assert done["state"] == {"step": 2}
+
+
+def test_retryable_failure_waits_for_backoff(queue, monkeypatch):
+    delays = []
+    monkeypatch.setattr("job_queue.backoff_delay", lambda attempt, base, cap: delays.append(attempt) or 60)
+    job_id = queue._insert("report", {}, 1, None)["id"]
+
+    async def handler(job):
+        raise RetryableJobError("上游暂时不可用")
+
+    queue.register("report", handler)
+    row = queue._claim()
+    asyncio.run(queue._run(Job(queue, row)))
+
+    job = queue.get(job_id)
+    assert job["status"] == JOB_QUEUED
+    assert delays == [1]
+    assert job["available_at"] > time.time() + 50
+    assert queue._claim() is None  # 退避时间未到
+
+    queue._update(job_id, available_at=time.time() - 1)
+    assert queue._claim()["attempts"] == 2
+
+
+def test_jobs_table_is_created_by_migration(queue):
+    conn = queue._connect()
+    try:
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == MIGRATIONS[-1][0]
+        assert "available_at" in {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+    finally:
+        conn.close()
+
+
+def test_submit_rejects_unknown_job_type(queue):
+    with pytest.raises(ValueError):
+        asyncio.run(queue.submit("unknown", {}))
@@ -0,0 +1,91 @@
+import json
+import sqlite3
+
+from lab_results import lab_rows, parse_number, query_cohort, sync_lab_results, write_lab_results
+
+
+def _add_patient(database, name, sex, age, labs):
+    with database.transaction() as conn:
+        patient_id = conn.execute(
+            "INSERT INTO patients (name, age, sex, chief_complaint, labs) VALUES (?, ?, ?, '体检', ?)",
+            (name, age, sex, json.dumps(labs, ensure_ascii=False))
+        ).lastrowid
+        write_lab_results(conn, [(patient_id, json.dumps(labs, ensure_ascii=False))])
+    return patient_id
+
+
+def test_parse_number():
+    assert parse_number(56) == 56.0
+    assert parse_number("420 ng/mL") == 420.0
+    assert parse_number("-1.5e2") == -150.0
+    assert parse_number("阴性") is None
+    assert parse_number(True) is None
+    assert parse_number(None) is None
+
+
+def test_lab_rows_normalizes_values_and_units():
+    rows = lab_rows(7, json.dumps({
+        "ALT": 56,
+        "AFP": "420 ng/mL",
+        "CEA": {"value": 3.2, "unit": "μg/L"},
+        "HBsAg": "阳性",
+        "总胆红素": "18.5",
+        "备注": None,
+    }, ensure_ascii=False))
+    assert sorted(rows) == sorted([
+        (7, "ALT", 56.0, "U/L", "56"),
+        (7, "AFP", 420.0, "ng/mL", "420 ng/mL"),
+        (7, "CEA", 3.2, "μg/L", '{"value":3.2,"unit":"μg/L"}'),
+        (7, "HBsAg", None, None, "阳性"),
+        (7, "总胆红素", 18.5, "μmol/L", "18.5"),
+    ])
+
+
+def test_lab_rows_ignores_non_objects():
+    assert lab_rows(1, "not json") == []
+    assert lab_rows(1, "[1, 2]") == []
+    assert lab_rows(1, None) == []
+    assert lab_rows(1, {"ALT": 40}) == [(1, "ALT", 40.0, "U/L", "40")]
+
+
+def test_query_cohort_filters_and_paginates(migrated_db):
+    high_male = [_add_patient(migrated_db, f"男{i}", "男", 50 + i, {"AFP": 500 + i, "ALT": 30}) for i in range(3)]
+    _add_patient(migrated_db, "男高ALT", "男", 55, {"AFP": 800, "ALT": 90})
+    _add_patient(migrated_db, "女", "女", 60, {"AFP": "600 ng/mL", "ALT": 20})
+    _add_patient(migrated_db, "正常", "男", 45, {"AFP": 5, "ALT": 25})
+    _add_patient(migrated_db, "阴性", "男", 45, {"HBsAg": "阴性"})
+
+    filters = [{"test_name": "AFP", "min": 400}, {"test_name": "ALT", "max": 40}]
+    page = query_cohort(migrated_db, filters, sex="男", limit=2, include_total=True)
+    assert page["total"] == 3
+    assert [p["id"] for p in page["patients"]] == high_male[:2]
+    assert page["has_more"] and page["next_cursor"] == high_male[1]
+    assert page["patients"][0]["labs"]["AFP"] == {"value": 500.0, "unit": "ng/mL"}
+
+    rest = query_cohort(migrated_db, filters, sex="男", after=page["next_cursor"], limit=2)
+    assert [p["id"] for p in rest["patients"]] == high_male[2:]
+    assert not rest["has_more"] and rest["next_cursor"] is None
+
+    assert len(query_cohort(migrated_db, filters, age_min=51)["patients"]) == 3  # 男1、男2、女
+    # 不带 min / max 的条件只要求做过该项检查，无法转为数字的结果按原文返回
+    negative = query_cohort(migrated_db, [{"test_name": "HBsAg"}])["patients"]
+    assert [p["labs"]["HBsAg"] for p in negative] == [{"value": "阴性", "unit": None}]
+
+
+def test_externally_written_patients_are_synced_and_deleted(migrated_db):
+    conn = sqlite3.connect(migrated_db.db_path)
+    patient_id = conn.execute(
+        "INSERT INTO patients (name, age, sex, chief_complaint, labs) VALUES ('外部', 40, '女', '乏力', ?)",
+        (json.dumps({"AFP": 450}),)
+    ).lastrowid
+    conn.commit()
+
+    assert query_cohort(migrated_db, [{"test_name": "AFP", "min": 400}])["patients"] == []
+    assert sync_lab_results(migrated_db) == 1
+    assert sync_lab_results(migrated_db) == 0
+    assert [p["id"] for p in query_cohort(migrated_db, [{"test_name": "AFP", "min": 400}])["patients"]] == [patient_id]
+
+    conn.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
+    conn.commit()
+    conn.close()
+    assert migrated_db.query_one('SELECT COUNT(*) FROM lab_results') == (0,)
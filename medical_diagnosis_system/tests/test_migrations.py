@@ -0,0 +1,109 @@
+import json
+import sqlite3
+
+from lab_results import sync_lab_results
+from migrations import MIGRATIONS, apply_migrations
+from report_store import report_codec
+from search import search_records
+
+LATEST = MIGRATIONS[-1][0]
+
+# 引入迁移之前 init_database() 创建的表结构
+BASELINE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS patients (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        age INTEGER NOT NULL,
+        sex TEXT NOT NULL,
+        chief_complaint TEXT NOT NULL,
+        history TEXT,
+        labs TEXT,
+        imaging TEXT,
+        additional_notes TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        patient_id INTEGER,
+        report_content TEXT NOT NULL,
+        report_type TEXT DEFAULT 'comprehensive',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (patient_id) REFERENCES patients (id)
+    )
+    ''',
+]
+
+
+def _names(database, kind):
+    return {row[0] for row in database.query_all('SELECT name FROM sqlite_master WHERE type = ?', (kind,))}
+
+
+def test_fresh_database_reaches_latest_version(empty_db):
+    assert apply_migrations(empty_db) == LATEST
+    assert empty_db.query_one('PRAGMA user_version')[0] == LATEST
+
+    tables = _names(empty_db, "table")
+    assert {"patients", "reports", "lab_results", "report_dictionaries", "archived_patients",
+            "patients_fts", "reports_fts", "jobs"} <= tables
+    indexes = _names(empty_db, "index")
+    assert {"idx_reports_patient_created", "idx_patients_created", "idx_lab_results_test_value"} <= indexes
+    # 索引与明细由应用维护，不应残留调用自定义函数的触发器
+    assert not {"lab_results_insert", "lab_results_update"} & _names(empty_db, "trigger")
+    assert "reports_text" not in _names(empty_db, "view")
+
+
+def test_apply_migrations_is_idempotent(migrated_db, capsys):
+    capsys.readouterr()
+    assert apply_migrations(migrated_db) == LATEST
+    assert capsys.readouterr().out == ""
+
+
+def test_plain_connection_can_write_after_migrations(migrated_db):
+    """其他进程（未注册 report_text() 等函数的连接）可以照常写入病人和报告"""
+    conn = sqlite3.connect(migrated_db.db_path)
+    try:
+        patient_id = conn.execute(
+            "INSERT INTO patients (name, age, sex, chief_complaint, labs) VALUES ('王五', 60, '男', '乏力', ?)",
+            (json.dumps({"AFP": 500}),)
+        ).lastrowid
+        report_id = conn.execute(
+            "INSERT INTO reports (patient_id, report_content) VALUES (?, '外部写入的报告')", (patient_id,)
+        ).lastrowid
+        conn.execute('DELETE FROM reports WHERE id = ?', (report_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_baseline_schema_upgrade_keeps_data(empty_db):
+    with empty_db.transaction() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(statement)
+        patient_id = conn.execute(
+            "INSERT INTO patients (name, age, sex, chief_complaint, history, labs, imaging) "
+            "VALUES ('张三', 50, '男', '右上腹痛', '乙肝病史', ?, 'CT 示肝占位')",
+            (json.dumps({"AFP": "420 ng/mL", "HBsAg": "阳性"}, ensure_ascii=False),)
+        ).lastrowid
+        conn.execute(
+            "INSERT INTO reports (patient_id, report_content) VALUES (?, '诊断：原发性肝细胞癌')", (patient_id,)
+        )
+
+    assert apply_migrations(empty_db) == LATEST
+
+    assert empty_db.query_one('SELECT name, external_id FROM patients WHERE id = ?', (patient_id,)) == ("张三", None)
+    assert empty_db.query_one('SELECT report_content, compression FROM reports') == ("诊断：原发性肝细胞癌", None)
+    # 存量病人的检验结果明细在启动时补建
+    assert sync_lab_results(empty_db) == 1
+    labs = empty_db.query_all(
+        'SELECT test_name, value, unit, raw_value FROM lab_results WHERE patient_id = ? ORDER BY test_name',
+        (patient_id,)
+    )
+    assert labs == [("AFP", 420.0, "ng/mL", "420 ng/mL"), ("HBsAg", None, None, "阳性")]
+
+    # 存量报告的全文索引在启动时补建
+    assert report_codec.sync_index() == 1
+    results = search_records(empty_db, "肝细胞癌", scope="reports")["results"]
+    assert [r["patient_id"] for r in results] == [patient_id]
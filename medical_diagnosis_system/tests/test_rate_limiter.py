@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from rate_limiter import (PRIORITY_BATCH, PRIORITY_INTERACTIVE, AdaptiveRateLimiter,
+                          UpstreamOverloadedError)
+
+
+def test_disabled_limits_never_wait():
+    limiter = AdaptiveRateLimiter(requests_per_minute=0, tokens_per_minute=0, max_queue=1)
+
+    async def scenario():
+        for _ in range(100):
+            await limiter.acquire(tokens=10_000)
+
+    asyncio.run(scenario())
+    assert limiter.queue_depth == 0
+
+
+def test_waiters_are_released_by_priority():
+    # 每分钟 6000 次（每 10ms 补充一次），清空令牌后所有请求都需要排队
+    limiter = AdaptiveRateLimiter(requests_per_minute=6000, tokens_per_minute=0, max_queue=10)
+    limiter.requests._tokens = 0
+    order = []
+
+    async def request(name, priority):
+        await limiter.acquire(priority=priority)
+        order.append(name)
+
+    async def scenario():
+        batch = [asyncio.ensure_future(request(f"batch-{i}", PRIORITY_BATCH)) for i in range(3)]
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(request("chat", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        assert limiter.queue_depth == 4
+        await asyncio.gather(*batch, interactive)
+
+    asyncio.run(scenario())
+    assert order == ["chat", "batch-0", "batch-1", "batch-2"]
+
+
+def test_full_queue_fails_fast():
+    limiter = AdaptiveRateLimiter(requests_per_minute=1, tokens_per_minute=0, max_queue=1)
+
+    async def scenario():
+        await limiter.acquire()  # 用掉桶中唯一的令牌
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamOverloadedError) as exc_info:
+            await limiter.acquire()
+        waiter.cancel()
+        return exc_info.value
+
+    error = asyncio.run(scenario())
+    assert error.retry_after >= 1
+    assert limiter.rejected == 1
+
+
+def test_throttling_halves_rate_and_recovers():
+    limiter = AdaptiveRateLimiter(requests_per_minute=60, tokens_per_minute=6000, min_scale=0.2)
+
+    limiter.on_throttled()
+    assert limiter.scale == 0.5
+    assert limiter.tokens.scale == 0.5
+    for _ in range(5):
+        limiter.on_throttled()
+    assert limiter.scale == 0.2
+
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.scale == 1.0
+    assert limiter.throttled == 6
+
+
+def test_unused_tokens_are_given_back():
+    limiter = AdaptiveRateLimiter(requests_per_minute=0, tokens_per_minute=1000)
+
+    async def scenario():
+        await limiter.acquire(tokens=800)
+
+    asyncio.run(scenario())
+    assert limiter.tokens.wait_time(800) > 0
+    limiter.release_unused(800, 100)
+    assert limiter.tokens.wait_time(800) == 0
+
+
+def test_cancel_after_grant_refunds_tokens():
+    limiter = AdaptiveRateLimiter(requests_per_minute=60, tokens_per_minute=1000, max_queue=10)
+    limiter.requests._tokens = 0
+
+    async def scenario():
+        waiter = asyncio.ensure_future(limiter.acquire(tokens=800))
+        await asyncio.sleep(0)  # 进入等待队列
+        limiter.requests._tokens = 60
+        await asyncio.sleep(0)  # 分发协程放行，等待方尚未恢复执行
+        assert limiter.tokens.wait_time(800) > 0
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert limiter.tokens.wait_time(1000) == 0
+    assert limiter.requests.wait_time(60) == 0
+
+
+def test_gateway_refunds_when_cancelled_waiting_for_concurrency():
+    from llm_gateway import LLMGateway
+
+    limiter = AdaptiveRateLimiter(requests_per_minute=60, tokens_per_minute=1000)
+    gateway = LLMGateway(api_key="test", max_concurrency=1, rate_limiter=limiter)
+
+    async def scenario():
+        await gateway.semaphore.acquire()  # 并发名额被占满
+        request = asyncio.ensure_future(gateway._open_upstream("complete", 800, PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        assert limiter.tokens.wait_time(800) > 0
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert limiter.tokens.wait_time(1000) == 0
+    assert limiter.requests.wait_time(60) == 0
@@ -0,0 +1,56 @@
+from report_markdown import BOLD_LINE_LEVEL, Block, inline_markup, parse_markdown, parse_report, to_html
+
+
+def test_inline_markup_escapes_before_formatting():
+    assert inline_markup("AFP <20 ng/mL & **升高**") == "AFP &lt;20 ng/mL &amp; <b>升高</b>"
+    assert inline_markup("*斜体* 与 `代码` 与 __加粗__") == "<i>斜体</i> 与 代码 与 <b>加粗</b>"
+    assert inline_markup("2 * 3 * 4") == "2 * 3 * 4"
+
+
+def test_headings_rules_and_paragraphs():
+    blocks = parse_markdown(
+        "# 诊疗报告 #\n## 一、疾病分析\n第一行\n第二行\n\n**中医辨证**：\n---\n#话题标签\n"
+    )
+    assert blocks == [
+        Block("heading", "诊疗报告", 1),
+        Block("heading", "一、疾病分析", 2),
+        Block("paragraph", "第一行<br/>第二行"),
+        Block("heading", "中医辨证", BOLD_LINE_LEVEL),
+        Block("rule"),
+        Block("paragraph", "#话题标签"),
+    ]
+
+
+def test_bullets_keep_markers_and_indent_levels():
+    blocks = parse_markdown("- 乏力\n  * 食欲下降\n      + 体重减轻\n1. 增强 CT\n2) MRI\n3、肝穿刺活检\n10、随访")
+    assert [(b.kind, b.text, b.level, b.marker) for b in blocks] == [
+        ("bullet", "乏力", 0, ""),
+        ("bullet", "食欲下降", 1, ""),
+        ("bullet", "体重减轻", 2, ""),  # 缩进超过最深层级时按最深一级
+        ("bullet", "增强 CT", 0, "1."),
+        ("bullet", "MRI", 0, "2)"),
+        ("bullet", "肝穿刺活检", 0, "3、"),
+        ("bullet", "随访", 0, "10、"),
+    ]
+    # 不是列表标记的数字开头按段落处理
+    assert parse_markdown("2024年复查")[0] == Block("paragraph", "2024年复查")
+
+
+def test_tables_are_padded_to_header_width():
+    blocks = parse_markdown("| 指标 | 结果 |\n|:---|---:|\n| AFP | **420** |\n| ALT |\n")
+    assert blocks == [Block("table", rows=(("指标", "结果"), ("AFP", "<b>420</b>"), ("ALT", "")))]
+    # 没有分隔行的竖线文本不是表格
+    assert parse_markdown("| 只有一行 |") == [Block("paragraph", "| 只有一行 |")]
+
+
+def test_parse_report_caches_by_report_and_content():
+    first = parse_report("## 标题", report_id=1)
+    assert parse_report("## 标题", report_id=1) is first
+    assert parse_report("## 新标题", report_id=1)[0].text == "新标题"
+
+
+def test_to_html_nests_lists():
+    html = to_html(parse_markdown("- 一\n  1. 甲\n  2. 乙\n- 二\n\n结论"))
+    assert html.split("\n") == [
+        "<ul>", "<li>一</li>", "<ol>", "<li>甲</li>", "<li>乙</li>", "</ol>", "<li>二</li>", "</ul>", "<p>结论</p>"
+    ]
@@ -0,0 +1,140 @@
+import sqlite3
+
+import pytest
+
+from config import config
+from report_store import REPORT_TEMPLATE_SEED, ReportCodec, report_codec
+
+REPORT = (
+    "## 一、疾病分析\n### 西医诊断分析\n- 可能诊断：原发性肝细胞癌，AFP 明显升高。\n"
+    "### 中医辨证分析\n- 证型分析：肝郁脾虚，湿热内蕴。\n" * 8
+)
+
+
+@pytest.fixture
+def codec(migrated_db):
+    return ReportCodec(migrated_db, method="zlib", min_bytes=64)
+
+
+def _add_reports(database, count, text=REPORT):
+    with database.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO reports (patient_id, report_content) VALUES (1, ?)", [(f"{i}\n{text}",) for i in range(count)]
+        )
+
+
+def test_round_trip_without_dictionary(codec):
+    value, compression = codec.encode(REPORT)
+    assert compression == "zlib"
+    assert len(value) < len(REPORT.encode("utf-8"))
+    assert codec.decode(value, compression) == REPORT
+
+
+def test_short_or_uncompressible_text_is_stored_plain(codec):
+    assert codec.encode("短报告") == ("短报告", None)
+    assert codec.decode("短报告", None) == "短报告"
+    assert codec.decode(b"bytes", None) == "bytes"
+    assert codec.decode(None, "zlib") is None
+
+
+def test_method_none_never_compresses(migrated_db):
+    codec = ReportCodec(migrated_db, method="none")
+    assert codec.encode(REPORT) == (REPORT, None)
+    assert codec.ensure_dictionary() is None
+
+
+def test_dictionary_rollover_keeps_old_reports_readable(codec):
+    first = codec.ensure_dictionary()
+    old_value, old_compression = codec.encode(REPORT)
+    assert old_compression == f"zlib:{first}"
+
+    second = codec.train()
+    assert second != first
+    new_value, new_compression = codec.encode(REPORT)
+    assert new_compression == f"zlib:{second}"
+
+    # 另一个进程中的编解码器从数据库加载两份字典
+    other = ReportCodec(codec.database, method="zlib")
+    assert other.decode(old_value, old_compression) == REPORT
+    assert other.decode(new_value, new_compression) == REPORT
+
+
+def test_seed_dictionary_is_retrained_on_real_reports(codec, monkeypatch):
+    monkeypatch.setattr(config, "REPORT_DICT_RETRAIN_MIN_REPORTS", 10)
+    monkeypatch.setattr(config, "REPORT_DICT_RETRAIN_GROWTH", 4)
+    monkeypatch.setattr(config, "REPORT_DICT_SAMPLE_LIMIT", 50)
+
+    seed = codec.ensure_dictionary()  # 新库：没有报告，字典只含模板骨架
+    assert codec._sample_counts[seed] == 0
+    assert codec._dictionaries[seed][1].startswith(REPORT_TEMPLATE_SEED.encode("utf-8"))
+
+    _add_reports(codec.database, 9)
+    assert codec.ensure_dictionary() == seed
+    _add_reports(codec.database, 1)
+    trained = codec.ensure_dictionary()
+    assert trained != seed
+    assert codec._sample_counts[trained] == 10
+    assert "肝郁脾虚".encode("utf-8") in codec._dictionaries[trained][1]
+
+    # 增长到上次样本数的 4 倍时再训练；样本数达到上限后不再训练
+    _add_reports(codec.database, 29)
+    assert codec.ensure_dictionary() == trained
+    _add_reports(codec.database, 1)
+    capped = codec.ensure_dictionary()
+    assert codec._sample_counts[capped] == 40
+    _add_reports(codec.database, 200)
+    latest = codec.ensure_dictionary()
+    assert codec._sample_counts[latest] == 50
+    _add_reports(codec.database, 1000)
+    assert not codec.needs_training()
+
+
+def test_retrain_check_runs_every_interval(codec, monkeypatch):
+    monkeypatch.setattr(config, "REPORT_DICT_CHECK_INTERVAL", 3)
+    codec.ensure_dictionary()
+    results = []
+    for _ in range(6):
+        codec.encode(REPORT)
+        results.append(codec.retrain_due())
+    assert results == [False, False, True, False, False, True]
+
+
+def test_index_follows_writes_and_plain_connections_work(migrated_db):
+    with migrated_db.transaction() as conn:
+        content, compression = report_codec.encode(REPORT)
+        report_id = conn.execute(
+            "INSERT INTO reports (patient_id, report_content, compression) VALUES (1, ?, ?)", (content, compression)
+        ).lastrowid
+        report_codec.index_report(conn, report_id, REPORT)
+
+    def matches(term):
+        return migrated_db.query_all('SELECT rowid FROM reports_fts WHERE reports_fts MATCH ?', (term,))
+
+    assert matches('"肝细胞癌"') == [(report_id,)]
+
+    # 其他进程写入的报告在 sync_index 时补建索引
+    conn = sqlite3.connect(migrated_db.db_path)
+    external = conn.execute("INSERT INTO reports (patient_id, report_content) VALUES (2, '胆管结石术后复查')").lastrowid
+    conn.commit()
+    conn.close()
+    assert matches('"胆管结石"') == []
+    assert report_codec.sync_index() == 1
+    assert matches('"胆管结石"') == [(external,)]
+
+    with migrated_db.transaction() as conn:
+        assert report_codec.unindex_reports(conn, 'id = ?', (report_id,)) == 1
+        conn.execute('DELETE FROM reports WHERE id = ?', (report_id,))
+    assert matches('"肝细胞癌"') == []
+
+
+def test_unindexed_reports_can_be_deleted(migrated_db):
+    """其他进程写入、尚未补建索引的报告直接删除时不能向无内容索引发出 'delete'"""
+    conn = sqlite3.connect(migrated_db.db_path)
+    report_id = conn.execute("INSERT INTO reports (patient_id, report_content) VALUES (1, '外部写入的肝癌报告')").lastrowid
+    conn.commit()
+    conn.close()
+
+    with migrated_db.transaction() as conn:
+        report_codec.unindex_reports(conn, 'id = ?', (report_id,))
+        conn.execute('DELETE FROM reports WHERE id = ?', (report_id,))
+    migrated_db.query_all("INSERT INTO reports_fts (reports_fts) VALUES ('integrity-check')")
@@ -0,0 +1,130 @@
+import sqlite3
+
+import pytest
+
+from report_store import report_codec
+from search import (clear_patient_index, index_patients, ngram_text, parse_query, search_records,
+                    sync_patient_index, unindex_patients)
+
+
+def _add_patient(conn, name, chief_complaint, history="", imaging=""):
+    patient_id = conn.execute(
+        "INSERT INTO patients (name, age, sex, chief_complaint, history, imaging) VALUES (?, 50, '男', ?, ?, ?)",
+        (name, chief_complaint, history, imaging)
+    ).lastrowid
+    index_patients(conn, [(patient_id, chief_complaint, history, imaging)])
+    return patient_id
+
+
+def _add_report(conn, patient_id, text):
+    content, compression = report_codec.encode(text)
+    report_id = conn.execute(
+        "INSERT INTO reports (patient_id, report_content, compression) VALUES (?, ?, ?)",
+        (patient_id, content, compression)
+    ).lastrowid
+    report_codec.index_report(conn, report_id, text)
+    return report_id
+
+
+@pytest.fixture
+def records(migrated_db):
+    with migrated_db.transaction() as conn:
+        jaundice = _add_patient(conn, "张三", "皮肤黄疸两周", "乙肝病史", "CT 示肝右叶占位")
+        epilepsy = _add_patient(conn, "李四", "反复抽搐", "癫痫病史十年")
+        other = _add_patient(conn, "王五", "体检发现胆囊结石")
+        long_report = "## 一、疾病分析\n原发性肝细胞癌可能性大，伴梗阻性黄疸。\n" + "随访计划：定期复查。\n" * 40
+        report = _add_report(conn, jaundice, long_report)
+        _add_report(conn, other, "胆囊结石，建议择期手术。")
+    return {"jaundice": jaundice, "epilepsy": epilepsy, "other": other, "report": report}
+
+
+def _hits(database, query, scope="all"):
+    return [(r["type"], r["patient_id"]) for r in search_records(database, query, scope)["results"]]
+
+
+def test_ngram_text_splits_words_into_unigrams_and_bigrams():
+    assert ngram_text("黄疸，AFP升高") == "黄 黄疸 疸 a af f fp p p升 升 升高 高"
+    assert ngram_text("肝 肝", None, "肝") == "肝"
+
+
+def test_parse_query_routes_terms_by_length():
+    assert parse_query("肝细胞癌 黄疸 CT") == ('"肝细胞癌"', '"黄疸" AND "ct"', ["黄疸", "CT"])
+    assert parse_query('a"b') == ('"a""b"', None, [])
+    assert parse_query("， -") == (None, None, [])
+
+
+def test_short_terms_use_ngram_index(migrated_db, records):
+    assert sorted(_hits(migrated_db, "黄疸")) == [("patient", records["jaundice"]), ("report", records["jaundice"])]
+    assert _hits(migrated_db, "癫痫") == [("patient", records["epilepsy"])]
+    assert _hits(migrated_db, "ct", scope="patients") == [("patient", records["jaundice"])]
+    assert _hits(migrated_db, "黄疸 癫痫") == []
+    assert _hits(migrated_db, "胆", scope="reports") == [("report", records["other"])]
+    assert _hits(migrated_db, "，") == []
+
+
+def test_short_and_long_terms_combine(migrated_db, records):
+    results = search_records(migrated_db, "肝细胞癌 黄疸")["results"]
+    assert [(r["type"], r["report_id"]) for r in results] == [("report", records["report"])]
+    assert "【肝细胞癌】" in results[0]["snippet"] and "【黄疸】" in results[0]["snippet"]
+    assert results[0]["score"] is not None
+    assert _hits(migrated_db, "肝细胞癌 癫痫") == []
+
+
+def test_short_term_snippets_are_highlighted(migrated_db, records):
+    result = search_records(migrated_db, "癫痫", scope="patients")["results"][0]
+    assert "【癫痫】" in result["snippet"]
+    assert result["score"] is None
+
+
+def test_pagination(migrated_db, records):
+    first = search_records(migrated_db, "病史", scope="patients", limit=1)
+    assert first["has_more"] and first["next_offset"] == 1
+    second = search_records(migrated_db, "病史", scope="patients", limit=1, offset=1)
+    assert not second["has_more"]
+    assert {first["results"][0]["patient_id"], second["results"][0]["patient_id"]} == {
+        records["jaundice"], records["epilepsy"]
+    }
+
+
+def test_deleted_rows_leave_the_ngram_index(migrated_db, records):
+    with migrated_db.transaction() as conn:
+        report_codec.unindex_reports(conn, 'patient_id = ?', (records["jaundice"],))
+        conn.execute('DELETE FROM reports WHERE patient_id = ?', (records["jaundice"],))
+        assert unindex_patients(conn, 'id = ?', (records["jaundice"],)) == 1
+        conn.execute('DELETE FROM patients WHERE id = ?', (records["jaundice"],))
+    assert migrated_db.query_all("SELECT rowid FROM reports_ngram WHERE reports_ngram MATCH '黄疸'") == []
+    assert migrated_db.query_all("SELECT rowid FROM patients_ngram WHERE patients_ngram MATCH '黄疸'") == []
+
+    with migrated_db.transaction() as conn:
+        clear_patient_index(conn)
+    assert _hits(migrated_db, "癫痫") == []
+
+
+def test_externally_written_patients_are_indexed_on_sync(migrated_db, records):
+    conn = sqlite3.connect(migrated_db.db_path)
+    patient_id = conn.execute(
+        "INSERT INTO patients (name, age, sex, chief_complaint) VALUES ('赵六', 30, '女', '腹水待查')"
+    ).lastrowid
+    conn.commit()
+    conn.close()
+
+    assert _hits(migrated_db, "腹水") == []
+    assert sync_patient_index(migrated_db) == 1
+    assert sync_patient_index(migrated_db) == 0
+    assert _hits(migrated_db, "腹水") == [("patient", patient_id)]
+
+
+def test_unindexed_patients_can_be_deleted(migrated_db, records):
+    """其他进程写入、尚未补建索引的病人直接删除时不能向无内容索引发出 'delete'"""
+    conn = sqlite3.connect(migrated_db.db_path)
+    patient_id = conn.execute(
+        "INSERT INTO patients (name, age, sex, chief_complaint) VALUES ('赵六', 30, '女', '腹水待查')"
+    ).lastrowid
+    conn.commit()
+    conn.close()
+
+    with migrated_db.transaction() as conn:
+        assert unindex_patients(conn, 'id IN (?, ?)', (patient_id, records["epilepsy"])) == 1
+        conn.execute('DELETE FROM patients WHERE id IN (?, ?)', (patient_id, records["epilepsy"]))
+    migrated_db.query_all("INSERT INTO patients_ngram (patients_ngram) VALUES ('integrity-check')")
+    assert _hits(migrated_db, "黄疸", scope="patients") == [("patient", records["jaundice"])]
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class Upstream:
+    """按测试控制节奏逐段产出的上游流"""
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.calls = 0
+        self.closed = False
+        self.gates = [asyncio.Event() for _ in chunks]
+
+    async def stream(self):
+        self.calls += 1
+        try:
+            for gate, chunk in zip(self.gates, self.chunks):
+                await gate.wait()
+                yield chunk
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.closed = True
+
+    def release(self, count=None):
+        for gate in self.gates[:count]:
+            gate.set()
+
+
+async def _collect(flight, key, upstream, received=None):
+    received = received if received is not None else []
+    async for chunk in flight.stream(key, upstream.stream):
+        received.append(chunk)
+    return received
+
+
+async def _until(predicate):
+    while not predicate():
+        await asyncio.sleep(0)
+
+
+def test_late_joiner_receives_chunks_already_produced():
+    async def scenario():
+        flight = SingleFlight()
+        upstream = Upstream(["a", "b", "c", "d"])
+        early_chunks = []
+        early = asyncio.ensure_future(_collect(flight, "k", upstream, early_chunks))
+        upstream.release(2)
+        await _until(lambda: len(early_chunks) == 2)
+
+        late = asyncio.ensure_future(_collect(flight, "k", upstream))
+        await asyncio.sleep(0)
+        upstream.release()
+        return flight, upstream, await early, await late
+
+    flight, upstream, early, late = asyncio.run(scenario())
+    assert early == late == ["a", "b", "c", "d"]
+    assert upstream.calls == 1
+    assert (flight.leaders, flight.coalesced, flight.in_flight) == (1, 1, 0)
+
+
+def test_error_is_delivered_to_every_subscriber():
+    async def scenario():
+        flight = SingleFlight()
+        upstream = Upstream(["a"], error=RuntimeError("上游断开"))
+        first = asyncio.ensure_future(_collect(flight, "k", upstream))
+        second = asyncio.ensure_future(_collect(flight, "k", upstream))
+        upstream.release()
+        return await asyncio.gather(first, second, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert [str(r) for r in results] == ["上游断开", "上游断开"]
+
+
+def test_upstream_cancelled_when_all_subscribers_leave():
+    async def scenario():
+        flight = SingleFlight()
+        upstream = Upstream(["a", "b"])
+        chunks = []
+        subscriber = asyncio.ensure_future(_collect(flight, "k", upstream, chunks))
+        upstream.release(1)
+        await _until(lambda: chunks)
+        subscriber.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await subscriber
+        await _until(lambda: upstream.closed)
+        return flight
+
+    flight = asyncio.run(scenario())
+    assert flight.in_flight == 0
+
+
+def test_finished_stream_is_not_reused():
+    async def scenario():
+        flight = SingleFlight()
+        upstream = Upstream(["a"])
+        upstream.release()
+        first = await _collect(flight, "k", upstream)
+        upstream = Upstream(["b"])
+        upstream.release()
+        second = await _collect(flight, "k", upstream)
+        return flight, first, second
+
+    flight, first, second = asyncio.run(scenario())
+    assert (first, second) == (["a"], ["b"])
+    assert flight.leaders == 2
+
+
+def test_do_shares_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+        gate = asyncio.Event()
+
+        async def fetch():
+            calls.append(1)
+            await gate.wait()
+            return "result"
+
+        waiters = [asyncio.ensure_future(flight.do("k", fetch)) for _ in range(3)]
+        await asyncio.sleep(0)
+        gate.set()
+        return calls, await asyncio.gather(*waiters), flight
+
+    calls, results, flight = asyncio.run(scenario())
+    assert calls == [1]
+    assert results == ["result"] * 3
+    assert (flight.leaders, flight.coalesced, flight.in_flight) == (1, 2, 0)
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """用固定的文本片段代替大模型流式输出；fail=True 时输出一段后报错"""
+    options = {"fail": False}
+
+    async def fake_stream(messages, **kwargs):
+        yield "第一段"
+        if options["fail"]:
+            raise RuntimeError("上游连接中断")
+        yield "第二段"
+
+    monkeypatch.setattr(main.llm_gateway, "stream", fake_stream)
+    return options
+
+
+def _collect(calls, stop_after=None):
+    """消费流式响应；stop_after 为读取的事件数，之后模拟客户端断开"""
+
+    async def on_complete(text):
+        calls.append(("complete", text))
+        return {"success": True}
+
+    async def on_error():
+        calls.append("discard")
+
+    async def scenario():
+        response = main.stream_llm_response([], 0.2, 100, on_complete, {"patient_id": 1}, on_error=on_error)
+        events = []
+        async for event in response.body_iterator:
+            events.append(event.split("\n", 1)[0])
+            if len(events) == stop_after:
+                break
+        await response.body_iterator.aclose()
+        await asyncio.gather(*main.background_tasks)
+        return events
+
+    return asyncio.run(scenario())
+
+
+def test_completed_stream_saves_result(upstream):
+    calls = []
+    events = _collect(calls)
+    assert events == ["event: start", 'data: {"delta": "第一段"}', 'data: {"delta": "第二段"}', "event: done"]
+    assert calls == [("complete", "第一段第二段")]
+
+
+def test_upstream_failure_discards_before_error_event(upstream):
+    upstream["fail"] = True
+    calls = []
+    assert _collect(calls)[-1] == "event: error"
+    assert calls == ["discard"]
+
+
+@pytest.mark.parametrize("stop_after", [1, 2])
+def test_client_disconnect_discards(upstream, stop_after):
+    calls = []
+    assert len(_collect(calls, stop_after=stop_after)) == stop_after
+    assert calls == ["discard"]